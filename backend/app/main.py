@@ -1,33 +1,66 @@
 import os
+import asyncio
 import contextlib
 from dotenv import load_dotenv
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from redis.asyncio import Redis
-from psycopg_pool import AsyncConnectionPool
+from fastapi.responses import ORJSONResponse
 
 from backend.database import db
-from backend.app.routers import users, inference, auth, payments
+from backend.app.routers import users, inference, auth, payments, autoscaling, admin
+from backend.app.services import (
+    autoscaler, backend_metrics, balances, jobs, partitions, readiness, rollups, tracing, upstream
+)
+from backend.app.services.capture import capture
+from backend.app.services.chat_template import render_messages
+from backend.app.services.connections import manager
+from backend.app.services.drain import DrainMiddleware, drainer
+from backend.app.services.lora import adapters
+from backend.app.services.model_registry import registry
+from backend.app.services.loop_monitor import monitor
+from backend.app.services.profiler import ProfilingMiddleware, profiler
+from backend.app.services.shadow import shadow
+from backend.app.services.usage_emitter import emitter
+from backend.app.services.warmup import warmer
 
 # Load env variables
 load_dotenv()
 
 
+async def warm_chat_templates():
+    """Render the bare system prefix of every registered model into the prefix cache."""
+    for tiers in registry.tiers.values():
+        for tier in tiers:
+            render_messages(tier.model, [{"role": "user", "content": ""}])
+
+
+readiness.register_cache_loader(warm_chat_templates)
+
+# Replicas that come up or restart get the hottest system prompts prefilled
+backend_metrics.on_ready(warmer.on_ready)
+
+# Periodic database maintenance
+jobs.register("usage_rollups", rollups.refresh_rollups, rollups.ROLLUP_INTERVAL)
+jobs.register("logs_partitions", partitions.maintain, partitions.MAINTENANCE_INTERVAL)
+jobs.register("balance_sync", balances.balance_sync.sync, balances.BALANCE_SYNC_INTERVAL)
+jobs.register("balance_ledger", balances.balance_sync.check_ledger, balances.BALANCE_LEDGER_INTERVAL)
+jobs.register("autoscaler", autoscaler.evaluate, autoscaler.AUTOSCALE_INTERVAL, postgres=False)
+
+
 @contextlib.asynccontextmanager
 async def lifespan(fastapi_app: FastAPI):
     # On Startup
     print("Application starting up...")
 
-    # Initialize Redis
-    db.redis_client = Redis(host="localhost", port=6379, db=0, decode_responses=True)
-    try:
-        await db.redis_client.ping()
-        print("Successfully connected to Redis.")
-    except Exception as e:                                                                           # pylint: disable=broad-exception-caught
-        print(f"Failed to connect to Redis: {e}")
+    # Event-loop lag monitor, and the loop thread the on-demand profiler samples
+    profiler.attach(asyncio.get_running_loop())
+    monitor.start()
+
+    # Finished spans are exported in batches (TRACE_EXPORT=file|otlp)
+    tracing.exporter.start()
 
-    # Initialize PostgreSQL Connection Pool
+    # PostgreSQL connection string
     POSTGRES_PASSWD = os.getenv("POSTGRESS_PASSWD")                                                  # pylint: disable=invalid-name
     if not POSTGRES_PASSWD:
         raise ValueError("POSTGRESS_PASSWD environment variable not set.")
@@ -35,27 +68,63 @@ async def lifespan(fastapi_app: FastAPI):
     POSTGRES_CONN_STRING = (                                                                         # pylint: disable=invalid-name
         f"postgresql://postgres:{POSTGRES_PASSWD}" "@localhost:5432/rainference"
     )
-    db.psql_pool = AsyncConnectionPool(conninfo=POSTGRES_CONN_STRING, open=False)
-    try:
-        await db.psql_pool.open()  # Open the pool connections
-        print("PostgreSQL connection pool created.")
-    except Exception as e:
-        print(f"Failed to connect to PostgreSQL: {e}")
+
+    # Connect Redis and PostgreSQL, pre-warm the upstream client and load hot
+    # caches in the background; /readyz reports when all of it is done
+    readiness.start(POSTGRES_CONN_STRING)
+
+    # Usage rollups and logs partition maintenance (wait for the pools by themselves)
+    jobs.start()
+
+    # Usage records are shipped to Redis in batches, spooled to disk while it is down
+    emitter.start()
+
+    # A sample of completions is written out as replayable traces (CAPTURE_SAMPLE_RATE)
+    capture.start()
+
+    # Which LoRA adapters each base-model replica has loaded
+    adapters.start(registry.adapter_replicas())
+
+    # SIGTERM drains in-flight work before the server shuts down
+    drainer.install_signal_handler()
 
     yield  # The application runs here
 
     # --- On Shutdown ---
     print("Application shutting down...")
+    # Usually done already on SIGTERM; covers other ways of stopping
+    await drainer.drain()
+    # Balances debited by the drained requests go to Postgres now
+    await balances.balance_sync.stop()
+    await readiness.stop()
+    profiler.stop()
+    await monitor.stop()
+    jobs.stop()
+    await emitter.stop()
+    await capture.stop()
+    await adapters.stop()
+    await shadow.stop()
+    await warmer.stop()
+    await manager.stop()
+    await backend_metrics.stop()
+    await upstream.close_client()
+    await tracing.exporter.stop()
     if db.redis_client:
         await db.redis_client.close()
         print("Redis connection closed.")
     if db.psql_pool:
         await db.psql_pool.close()
         print("PostgreSQL connection pool closed.")
+    if db.psql_replica_pool:
+        await db.psql_replica_pool.close()
 
 
 # Initialize FastAPI
-app = FastAPI(title="FastAPI Backend", lifespan=lifespan)
+app = FastAPI(
+    title="FastAPI Backend",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # Configure CORS for frontend
 origins = os.getenv("CORS_ORIGINS", "").split(",") if os.getenv("CORS_ORIGINS") else []
@@ -65,17 +134,42 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
+# Profiles sampled or "X-Profile"-tagged requests (see /admin/profile)
+app.add_middleware(ProfilingMiddleware)
+
+# Counts in-flight requests, and turns new ones away while draining
+app.add_middleware(DrainMiddleware)
+
+# Outermost: one root span per request, trace id returned as "X-Trace-Id"
+app.add_middleware(tracing.TracingMiddleware)
+
 
 # Include your routers
 app.include_router(users.router)
 app.include_router(inference.router)
 app.include_router(auth.router)
 app.include_router(payments.router)
+app.include_router(autoscaling.router)
+app.include_router(admin.router)
 
 
 # root endpoint for health check
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the FastAPI backend!"}
+
+
+# Liveness: the process and its event loop are up
+@app.get("/livez")
+async def livez():
+    return {"status": "ok"}
+
+
+# Readiness: Postgres pool filled, Redis and upstream pre-warmed, caches loaded
+@app.get("/readyz")
+async def readyz():
+    status = readiness.state.as_dict()
+    return ORJSONResponse(content=status, status_code=200 if status["ready"] else 503)
@@ -0,0 +1,140 @@
+import hmac
+import time
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+
+from backend.app.services.balances import balance_sync
+from backend.app.services.capture import capture
+from backend.app.services.drain import drainer
+from backend.app.services.embeddings import embedder
+from backend.app.services.loop_monitor import monitor
+from backend.app.services.lora import adapters
+from backend.app.services.profiler import ADMIN_TOKEN, profiler
+from backend.app.services.shadow import shadow
+from backend.app.services.warmup import warmer
+
+
+def require_admin(authorization: str = Header(None)):
+    """Admin endpoints take "Authorization: Bearer <ADMIN_TOKEN>" and are off without one."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Admin API is not configured")
+    if not authorization or not hmac.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid or missing admin token")
+
+
+router = APIRouter(
+    prefix="/admin",
+    default_response_class=ORJSONResponse,
+    dependencies=[Depends(require_admin)],
+)
+
+
+@router.post("/profile/window")
+async def profile_window(
+    duration: float = Query(30, gt=0, le=600),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    reset: bool = Query(True),
+):
+    """Sample everything the event loop does for `duration` seconds."""
+    if reset:
+        profiler.reset()
+    profiler.start_window(duration, interval_ms / 1000)
+    return profiler.status()
+
+
+@router.post("/profile/sample")
+async def profile_sample(
+    rate: float = Query(0.01, gt=0, le=1),
+    duration: float = Query(300, gt=0, le=3600),
+    reset: bool = Query(True),
+):
+    """Profile a `rate` fraction of the requests arriving in the next `duration` seconds."""
+    if reset:
+        profiler.reset()
+    profiler.start_sampling(rate, duration)
+    return profiler.status()
+
+
+@router.post("/profile/stop")
+async def profile_stop():
+    profiler.stop()
+    return profiler.status()
+
+
+@router.get("/profile/status")
+async def profile_status():
+    return profiler.status()
+
+
+@router.get("/profile")
+async def profile_download():
+    """Samples in folded-stack format, for flamegraph.pl, speedscope or inferno."""
+    filename = f"gateway-{time.strftime('%Y%m%dT%H%M%S')}.folded"
+    return PlainTextResponse(
+        profiler.folded(),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get("/loop")
+async def loop_stats():
+    """Event-loop lag and the stacks of recent slow callbacks."""
+    return monitor.stats()
+
+
+@router.get("/lora")
+async def lora_residency():
+    """LoRA adapters, the replicas each is loaded on, and load/eviction counts."""
+    return adapters.stats()
+
+
+@router.get("/balances")
+async def balance_sync_stats():
+    """Balances waiting to be flushed to Postgres, and the last ledger mismatches."""
+    return await balance_sync.stats()
+
+
+@router.get("/embeddings")
+async def embedding_stats():
+    """Embedding cache occupancy and hit rate, and how well inputs are batched."""
+    return embedder.stats()
+
+
+@router.get("/shadow")
+async def shadow_comparison():
+    """TTFT, tokens/s and error rates of mirrored requests, production next to candidate."""
+    return shadow.stats()
+
+
+@router.get("/capture")
+async def capture_status():
+    """Traffic capture: sample rate, traces written and dropped, the file being written."""
+    return capture.stats()
+
+
+@router.get("/warmup")
+async def warmup_status():
+    """Hottest system-prompt prefixes per worker, and the replicas warmed with them."""
+    return warmer.stats()
+
+
+@router.post("/drain")
+async def drain_start(wait: bool = Query(False)):
+    """Take this worker out of rotation and let in-flight work finish; `wait` until it has."""
+    if wait:
+        await drainer.drain()
+    else:
+        drainer.start()
+    return drainer.stats()
+
+
+@router.post("/drain/resume")
+async def drain_resume():
+    drainer.resume()
+    return drainer.stats()
+
+
+@router.get("/drain")
+async def drain_status():
+    return drainer.stats()
@@ -3,18 +3,20 @@ import logging
 import uuid
 
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel
 from redis.asyncio import Redis
 from redis.exceptions import RedisError
 import psycopg2
-from psycopg import AsyncConnection
 from dotenv import load_dotenv
 import httpx
 
-from backend.database.db import get_psql_conn, get_redis_client
+from backend.database import queries
+from backend.database.db import PsqlSession, get_psql_writer, get_redis_client
+from backend.app.services import balances
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 # Security scheme
 security = HTTPBearer()
@@ -34,8 +36,18 @@ load_dotenv()
 GITHUB_CLIENT_ID = os.getenv("GITHUB_CLIENT_ID")
 GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
 
-if not GITHUB_CLIENT_ID or not GITHUB_CLIENT_SECRET:
-    raise RuntimeError("Missing GitHub OAuth environment variables")
+
+def github_credentials():
+    """
+    Return the GitHub OAuth client id and secret.
+
+    Checked when OAuth is used rather than at import, so a gateway without
+    OAuth configured still starts and serves inference.
+    """
+    if not GITHUB_CLIENT_ID or not GITHUB_CLIENT_SECRET:
+        logger.error("Missing GitHub OAuth environment variables")
+        raise HTTPException(status_code=503, detail="GitHub OAuth is not configured")
+    return GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET
 
 
 class GitHubAuthRequest(BaseModel):
@@ -52,7 +64,7 @@ class GitHubAuthRequest(BaseModel):
 ## in $$dolars by default balance is float
 async def create_user(user_email, user_full_name, user_name, balance=1.00):
     redis = await get_redis_client()
-    conn = await get_psql_conn()
+    writer = await get_psql_writer()
 
     try:
         # Generate user details
@@ -69,27 +81,26 @@ async def create_user(user_email, user_full_name, user_name, balance=1.00):
             user_fname = None
             user_lname = None
 
-        # Open a cursor using context manager to ensure proper handling
-        async with conn.cursor() as cursor:
-            # Insert user data into the 'users' table
-            query = """
-            INSERT INTO users (
-                user_id, user_name, llm_api_token, bearer_token, fname, lname, email, balance
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            values = (
-                user_id,
-                user_name,
-                api_token,
-                bearer_token,
-                user_fname,
-                user_lname,
-                user_email,
-                balance,
-            )
+        # Insert user data into the 'users' table
+        query = """
+        INSERT INTO users (
+            user_id, user_name, llm_api_token, bearer_token, fname, lname, email, balance,
+            opening_balance
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        values = (
+            user_id,
+            user_name,
+            api_token,
+            bearer_token,
+            user_fname,
+            user_lname,
+            user_email,
+            balance,
+            balance,  # the opening balance of the ledger
+        )
 
-            await cursor.execute(query, values)  # Execute the query
-            await conn.commit()  # Commit the transaction
+        await writer.execute(query, values)  # Execute and commit
 
         print(f"User {user_name} added successfully!")
 
@@ -127,7 +138,7 @@ async def create_user(user_email, user_full_name, user_name, balance=1.00):
 # Function to regenerate API token (replace with actual regeneration logic)
 async def regenerate_api_token(current_token: str):
     redis = await get_redis_client()
-    conn = await get_psql_conn()
+    writer = await get_psql_writer()
 
     try:
         # Check if the Bearer token is valid (it maps to a user ID)
@@ -136,59 +147,35 @@ async def regenerate_api_token(current_token: str):
         if not user_id:
             return "Invalid token", None
 
-        # Retrieve the current API token from the user's data
-        async with conn.cursor() as cursor:
-            # Define the query to fetch the llm_api_token for a given user_id
-            query = """
-            SELECT llm_api_token, balance
-            FROM users
-            WHERE user_id = %s
-            """
-            await cursor.execute(query, (user_id,)) # Execute the query with the user_id param
-
-            # Fetch the result
-            result = await cursor.fetchone()
-
-            if result:
-                old_api_token, balance = result  # Unpack the result
-            else:
-                # If no result, return None (user not found)
-                return "No API token or balance found for the user", None
-            
+        # Retrieve the current API token from the user's data (primary, it is about to change)
+        result = await writer.fetchone(queries.USER_TOKEN_AND_BALANCE, (user_id,))
+
+        if result:
+            old_api_token, balance, balance_version = result  # Unpack the result
+        else:
+            # If no result, return None (user not found)
+            return "No API token or balance found for the user", None
+
         # Generate a new API token
         new_api_token = str(uuid.uuid4())  # Create a new unique API token
 
         # Update a new llm_api_key in psql database
-        async with conn.cursor() as cursor:
-            # Define the query to update the llm_api_token for a given user_id
-            query = """
-            UPDATE users
-            SET llm_api_token = %s
-            WHERE user_id = %s
-            """
-
-            # Execute the update query with parameters
-            await cursor.execute(query, (new_api_token, user_id))
-
-            # Commit the transaction to make the change persistent
-            await conn.commit()
-
-            if cursor.rowcount == 0:
-                await conn.rollback()
-                return f"No user found with user_id: {user_id}", None
-
-            await conn.commit()
-
-        # Remove the old API token -> user mapping before updating the user data
-        await redis.delete(f"llm_api_token:{old_api_token}")
-
-        # Set the new API token to user ID mapping in redis
-        await redis.hset(
-            f"llm_api_token:{new_api_token}",
-            mapping={
-                "user_id": user_id,
-                "balance": str(balance),
-            },
+        query = """
+        UPDATE users
+        SET llm_api_token = %s
+        WHERE user_id = %s
+        """
+
+        # Execute the update query with parameters, committed on success
+        updated = await writer.execute(query, (new_api_token, user_id))
+
+        if updated == 0:
+            return f"No user found with user_id: {user_id}", None
+
+        # Move the user data to the new token in Redis; the balance there may be
+        # ahead of Postgres (write-behind), so it is carried over as is
+        await balances.move(
+            redis, old_api_token, new_api_token, seed=(user_id, balance, balance_version)
         )
 
         # Return success status with the new API token
@@ -212,10 +199,11 @@ async def regenerate_api_token(current_token: str):
 async def github_auth(
     request_data: GitHubAuthRequest,
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    writer: PsqlSession = Depends(get_psql_writer),
 ):
     github_token_url = "https://github.com/login/oauth/access_token"
     github_code = request_data.code
+    client_id, client_secret = github_credentials()
 
     try:
         # Check if the code has already been used (stored in Redis temporarily)
@@ -235,8 +223,8 @@ async def github_auth(
                 github_token_url,
                 headers={"Accept": "application/json"},
                 data={
-                    "client_id": GITHUB_CLIENT_ID,
-                    "client_secret": GITHUB_CLIENT_SECRET,
+                    "client_id": client_id,
+                    "client_secret": client_secret,
                     "code": github_code,
                 },
             )
@@ -314,19 +302,16 @@ async def github_auth(
         #    raise HTTPException(status_code=400, detail="Missing required GitHub user information")
 
         # Query to check if the user exists
-        async with conn.cursor() as cursor:
-            query = "SELECT user_id, llm_api_token, bearer_token FROM users WHERE email = %s"
-            await cursor.execute(query, (user_email,))
-            user_data = await cursor.fetchone()
-
-            if user_data:
-                # User exists, return their information
-                return {
-                    "status": "success",
-                    "user_id": user_data[0],
-                    "api_token": user_data[1],
-                    "bearer_token": user_data[2],
-                }
+        user_data = await writer.fetchone(queries.USER_BY_EMAIL, (user_email,))
+
+        if user_data:
+            # User exists, return their information
+            return {
+                "status": "success",
+                "user_id": user_data[0],
+                "api_token": user_data[1],
+                "bearer_token": user_data[2],
+            }
 
         user_id, api_token, bearer_token = await create_user(
             user_email, user_full_name, user_name
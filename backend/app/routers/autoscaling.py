@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from redis.exceptions import RedisError
+
+from backend.app.routers.admin import require_admin
+from backend.app.services import autoscaler
+
+router = APIRouter(default_response_class=ORJSONResponse, dependencies=[Depends(require_admin)])
+
+DEPLOYMENT = "llama-8b"
+
+
+def _metric(name: str, value: float, timestamp: str) -> dict:
+    return {
+        "metricName": name,
+        "metricLabels": {"deployment": DEPLOYMENT},
+        "timestamp": timestamp,
+        # Kubernetes quantities are strings; milli-units keep the precision
+        "value": f"{round(value * 1000)}m",
+    }
+
+
+@router.get("/autoscaling/metrics")
+async def autoscaling_metrics():
+    """
+    External-metrics style view of LLM load for an HPA/KEDA scaler.
+
+    `rainference_desired_replicas` is already the recommendation (with
+    hysteresis and startup-aware cooldowns applied), so the scaler should
+    target an AverageValue of 1 on it. The raw inputs are exported alongside
+    for dashboards.
+
+    Only reads the recommendation the autoscaler job stored in Redis, so
+    every worker and pod answers the same. A 503 (missing or stale
+    recommendation) makes KEDA keep the current replica count. Takes the
+    admin token, as a bearer token in the ScaledObject's authentication.
+    """
+    try:
+        stored = await autoscaler.recommendation()
+    except RedisError as e:
+        raise HTTPException(status_code=503, detail="Autoscaling state unavailable") from e
+    if stored is None:
+        raise HTTPException(status_code=503, detail="No current autoscaling recommendation")
+    desired, observation = stored
+    timestamp = datetime.fromtimestamp(observation.timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+    return {
+        "kind": "ExternalMetricValueList",
+        "apiVersion": "external.metrics.k8s.io/v1beta1",
+        "metadata": {},
+        "desiredReplicas": desired,
+        "items": [
+            _metric("rainference_desired_replicas", desired, timestamp),
+            _metric("rainference_queue_depth", observation.queue_depth, timestamp),
+            _metric("rainference_demand_tokens_per_second", observation.demand_tps, timestamp),
+            _metric(
+                "rainference_replica_capacity_tokens_per_second",
+                observation.replica_capacity_tps or autoscaler.CONFIG.default_capacity_tps,
+                timestamp,
+            ),
+            _metric("rainference_ready_replicas", observation.ready_replicas, timestamp),
+        ],
+    }
@@ -1,21 +1,36 @@
-import os
+import time
+import asyncio
+import uuid
 import logging
 from decimal import Decimal
-import json
 
-from typing import List, Dict, Any
+from typing import List, Optional, Tuple
 
 from fastapi import APIRouter, Header, Request, WebSocket, HTTPException, WebSocketDisconnect
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from redis.exceptions import RedisError
-import httpx
+import orjson
 from dotenv import load_dotenv
 
 from backend.database.db import get_redis_client
+from backend.app.services.capture import Trace, capture
+from backend.app.services.chat_format import ChatStreamTranslator, completion_to_chat
+from backend.app.services.chat_template import render_messages, template_for
+from backend.app.services.coalesce import coalesce
+from backend.app.services import balances, deadlines, embeddings, tracing, upstream
+from backend.app.services.connections import manager
+from backend.app.services.drain import drainer
+from backend.app.services.fastjson import extract_usage_fields, read_json
+from backend.app.services.lora import adapters
+from backend.app.services.model_registry import allows_fallback, registry
+from backend.app.services.multiplex import MultiplexSession
+from backend.app.services.shadow import shadow
+from backend.app.services.usage_emitter import emitter
+from backend.app.services.warmup import warmer
 
 load_dotenv()
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 # Set up logging
 logging.basicConfig(
@@ -26,47 +41,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-class ConnectionManager:
-    def __init__(self):
-        # A dictionary to map api_tokens to a list of WebSocket connections
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, identifier: str, websocket: WebSocket):
-        """Add a new WebSocket connection for a given identifier."""
-        await websocket.accept()
-        if identifier not in self.active_connections:
-            self.active_connections[identifier] = []
-        self.active_connections[identifier].append(websocket)
-        print(f"New WebSocket connection for {identifier}")  # Debugging log
-
-    def disconnect(self, identifier: str, websocket: WebSocket):
-        """Remove a specific WebSocket connection for an identifier."""
-        if identifier in self.active_connections:
-            self.active_connections[identifier].remove(websocket)
-
-            # Remove identifier if no connections remain
-            if not self.active_connections[identifier]:
-                del self.active_connections[identifier]
-            print(f"Disconnected WebSocket for {identifier}")  # Debugging log
-
-    async def send_to(self, identifier: str, message: dict):
-        """Send a message to all WebSocket connections for an identifier."""
-        if identifier in self.active_connections:
-            for websocket in self.active_connections[identifier]:
-                await websocket.send_json(message)
-                print(f"Sent message to {identifier}")  # Debugging log
-
-    async def broadcast(self, message: dict):
-        """Send a message to all active WebSocket connections."""
-        for connections in self.active_connections.values():
-            for websocket in connections:
-                await websocket.send_json(message)
-                print("Broadcasted message to all connections")  # Debugging log
-
-
-manager = ConnectionManager()
-
-
 async def validate_token(token: str) -> bool:
     """
     Validates if the provided API token exists in Redis and has sufficient balance.
@@ -77,36 +51,78 @@ async def validate_token(token: str) -> bool:
     Returns:
         bool: True if the token is valid and has a balance > 0.00, otherwise False.
     """
-    redis = await get_redis_client()
-    try:
-        # Check if the token exists in Redis
-        user_info = await redis.hgetall(f"llm_api_token:{token}")
+    with tracing.span("validate_token"):
+        redis = await get_redis_client()
+        try:
+            # Check if the token exists in Redis
+            user_info = await redis.hgetall(f"llm_api_token:{token}")
+
+            user_id = user_info.get("user_id")
+            if not user_id:
+                return False  # Token does not exist
+
+            # Retrieve and validate balance
+            balance_str = user_info.get("balance")
+            if not balance_str or not balance_str.strip():
+                return False  # Balance field missing or invalid
+
+            balance = Decimal(balance_str)
+
+            if balance > Decimal("0.0001"):
+                return user_id  # Return user_id if balance is valid
+            return False  # Balance is too low
+
+        except RedisError as redis_err:
+            logger.exception(
+                "Redis error occurred while validating token %s: %s", token, str(redis_err)
+            )
+            return False
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            logger.exception(
+                "Unexpected error occurred while validating token %s: %s", token, str(e)
+            )
+            return False
 
-        user_id = user_info.get("user_id")
-        if not user_id:
-            return False  # Token does not exist
 
-        # Retrieve and validate balance
-        balance_str = user_info.get("balance")
-        if not balance_str or not balance_str.strip():
-            return False  # Balance field missing or invalid
+def build_prompt(model: str, data: dict) -> Tuple[str, bool]:
+    """
+    Build the upstream prompt from a request body.
 
-        balance = Decimal(balance_str)
+    OpenAI-style `messages` are rendered with the model's chat template; a
+    raw `prompt` is passed through untouched.
 
-        if balance > Decimal("0.0001"):
-            return user_id  # Return user_id if balance is valid
-        return False  # Balance is too low
+    Args:
+        model (str): The base model, whose chat template applies (also for adapters).
+        data (dict): The request body.
 
-    except RedisError as redis_err:
-        logger.exception(
-            "Redis error occurred while validating token %s: %s", token, str(redis_err)
-        )
-        return False
-    except Exception as e:                                                                           # pylint: disable=broad-exception-caught
-        logger.exception(
-            "Unexpected error occurred while validating token %s: %s", token, str(e)
-        )
-        return False
+    Returns:
+        Tuple[str, bool]: The prompt and whether vLLM should add special tokens.
+
+    Raises:
+        ValueError: If `messages` is malformed.
+    """
+    messages = data.get("messages")
+    if messages:
+        rendered = render_messages(model, messages, data.get("tools"))
+        # Hot system prompts are replayed into replicas that join later
+        warmer.observe(model, rendered)
+        # The rendered template already starts with the BOS token
+        return rendered.prompt, False
+    return data.get("prompt", ""), True
+
+
+def tool_template(model: str, data: dict) -> Optional[str]:
+    """
+    The chat template whose tool-call syntax the output is parsed with, or
+    None if the request offered no tools (or forbade calling them).
+
+    Args:
+        model (str): The base model, whose chat template applies (also for adapters).
+        data (dict): The request body.
+    """
+    if data.get("messages") and data.get("tools") and data.get("tool_choice") != "none":
+        return template_for(model)
+    return None
 
 
 async def perform_inference(
@@ -116,31 +132,44 @@ async def perform_inference(
     temperature: float,
     stream: bool,
     websocket: WebSocket,
+    add_special_tokens: bool = True,
+    urls: Optional[List[str]] = None,
+    deadline: Optional[float] = None,
+    capture_trace: Optional[Trace] = None,
+    chat: bool = False,
+    tools: Optional[str] = None,
 ):
     try:
-        print(
-            f"Starting inference for model: {model}, prompt: {prompt}, stream: {stream}"
-        )  # Debugging log
+        logger.debug("Starting inference for model %s, stream: %s", model, stream)
 
         # Use `stream_kube_data` to handle both streaming and non-streaming cases
-        async for data in stream_kube_data(
+        chunks = stream_kube_data(
             model,
             prompt,
             max_tokens,
             temperature,
             stream=str(stream),
             bool_stream=stream,
-        ):
+            add_special_tokens=add_special_tokens,
+            urls=urls,
+            deadline=deadline,
+            capture_trace=capture_trace,
+            chat=chat,
+            tools=tools,
+        )
+        if stream:
+            # Fewer, larger frames instead of one per upstream chunk
+            chunks = coalesce(chunks)
+        async for data in chunks:
             try:
                 data = data.decode("utf-8").strip()  # Decode chunk bytes to string
 
                 if stream:
-                    print(f"Streaming token: {data}")  # Debugging log
                     await websocket.send_json(data)
 
                 else:
-                    # print(f"Received full response: {response_data}")  # Debugging log
-                    await websocket.send_json(data)
+                    # Forward the upstream body as is, it is already JSON
+                    await websocket.send_text(data)
                     break  # Exit after one message for non-streaming
 
             except Exception as e:                                                                    # pylint: disable=broad-exception-caught
@@ -155,8 +184,48 @@ async def perform_inference(
         await websocket.send_json({"error": f"An unexpected error occurred: {str(e)}"})
 
 
-# Kubernetes server URL
-KUBE_URL = os.getenv("KUBE_SERVER_URL")
+async def multiplexed_inference(
+    session: MultiplexSession, request_id: str, data: dict, deadline: Optional[float] = None,
+    capture_trace: Optional[Trace] = None,
+):
+    """
+    Run one request of a multiplexed socket, sending its output as frames
+    tagged with `request_id`. Errors propagate to the session, which turns
+    them into an error frame for this id only.
+    """
+    resolution = registry.resolve(data.get("model"), allows_fallback(data))
+    model = resolution.model
+    prompt, add_special_tokens = build_prompt(resolution.base_model, data)
+    stream = str(data.get("stream", True)).lower() == "true"
+
+    if resolution.fallback:
+        await session.send(
+            request_id, "served_model", served_model=model, requested_model=resolution.alias
+        )
+
+    chunks = stream_kube_data(
+        model,
+        prompt,
+        data.get("max_tokens", 11),
+        data.get("temperature", 0.7),
+        stream=str(stream),
+        bool_stream=stream,
+        add_special_tokens=add_special_tokens,
+        urls=resolution.urls,
+        deadline=deadline,
+        capture_trace=capture_trace,
+        chat=bool(data.get("messages")),
+        tools=tool_template(resolution.base_model, data),
+    )
+    if stream:
+        chunks = coalesce(chunks)
+    async for chunk in chunks:
+        if stream:
+            await session.send(request_id, "chunk", data=chunk.decode("utf-8").strip())
+        else:
+            # Embed the body as is, without decoding it again
+            await session.send(request_id, "response", data=orjson.Fragment(chunk))
+            break
 
 
 # Function to stream data from Kubernetes server to the client
@@ -167,7 +236,21 @@ async def stream_kube_data(
     temperature: float,
     stream: str,
     bool_stream: bool,
+    add_special_tokens: bool = True,
+    urls: Optional[List[str]] = None,
+    deadline: Optional[float] = None,
+    capture_trace: Optional[Trace] = None,
+    chat: bool = False,
+    tools: Optional[str] = None,
 ):
+    """
+    Send one request upstream and yield its output: raw SSE chunks when
+    streaming, else the whole body. With `chat`, the request came as chat
+    messages and the output is rewritten from the completions format into
+    the chat one (`chat.completion` / `chat.completion.chunk`). `tools` is
+    the chat template of a request that offered tools (see tool_template);
+    calls in the output are then returned as `tool_calls`.
+    """
     request_data = {
         "model": model,
         "prompt": prompt,
@@ -175,50 +258,107 @@ async def stream_kube_data(
         "temperature": temperature,
         "stream": stream,
     }
+    if not add_special_tokens:
+        request_data["add_special_tokens"] = False
+
+    measurement = None
+    # Replicas a LoRA adapter was placed on, held until the request ends
+    placed: Optional[List[str]] = None
+    # Ended explicitly: a generator cannot own the current-span context
+    kube_span = tracing.start_span(
+        "stream_kube_data",
+        **{"llm.model": model, "llm.max_tokens": max_tokens, "llm.stream": bool_stream},
+    )
+    try:
+        adapter = adapters.get(model)
+        if adapter is not None:
+            # Replicas that have the LoRA adapter loaded, after loading it if it was cold
+            urls = placed = await adapters.place(adapter, urls or upstream.UPSTREAM_URLS, deadline)
+            kube_span.set("lora.adapter", adapter.name)
+            kube_span.event("lora_placed", replicas=len(urls))
+
+        # A sample is also sent to a candidate deployment, and production's
+        # answer is measured to compare against it
+        measurement = shadow.mirror(model, request_data)
+        if capture_trace is not None:
+            capture_trace.begin(request_data, urls or upstream.UPSTREAM_URLS)
 
-    async with httpx.AsyncClient() as client:
         if bool_stream:
-            # Streaming response
-            async with client.stream("POST", KUBE_URL, json=request_data) as response:
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail="Error from Kubernetes server",
-                    )
-
-                # Yield data as it streams
-                async for chunk in response.aiter_bytes():
-                    yield chunk
+            # Streaming response, retried on another replica until the first byte
+            first = True
+            translator = ChatStreamTranslator(tools) if chat else None
+            async for chunk in upstream.stream(
+                request_data, urls, parent=kube_span, deadline=deadline
+            ):
+                if first:
+                    first = False
+                    kube_span.event("first_token")
+                if measurement is not None:
+                    measurement.chunk(chunk)
+                if capture_trace is not None:
+                    capture_trace.chunk(chunk)
+                if translator is not None:
+                    chunk = translator.feed(chunk)
+                    if not chunk:
+                        continue  # an event split across chunks, sent once complete
+                yield chunk
+            if translator is not None:
+                rest = translator.flush()
+                if rest:
+                    yield rest
+            if measurement is not None:
+                measurement.done()
+            if capture_trace is not None:
+                capture_trace.done()
         else:
-            # Non-streaming response
-            response = await client.post(KUBE_URL, json=request_data)
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail="Error from Kubernetes server",
-                )
-
-            # Return raw JSON response
-            yield response.json()
-
-
-# Function to push log data to Redis with expiration
-async def push_log_to_redis(log_data):
-
-    redis = await get_redis_client()
-    # Serialize the log data into JSON
-    log_data_json = json.dumps(log_data)
-
-    # Push log data to the Redis list
-    await redis.lpush("logs_buffer", log_data_json)
+            # Non-streaming response, retried/hedged across replicas
+            backend, response = await upstream.post(
+                request_data, urls, parent=kube_span, deadline=deadline
+            )
+            kube_span.set("upstream.url", backend.url)
+            kube_span.end()
+            if measurement is not None:
+                measurement.body(response.content)
+                measurement.done()
+            if capture_trace is not None:
+                capture_trace.body(response.content)
+                capture_trace.done()
+
+            # Return the raw JSON body, callers decode only what they need
+            yield completion_to_chat(response.content, tools) if chat else response.content
+    except GeneratorExit:
+        # The client went away mid-stream
+        if capture_trace is not None:
+            capture_trace.done("cancelled")
+        raise
+    except BaseException as e:
+        kube_span.record_error(e)
+        cancelled = isinstance(e, asyncio.CancelledError)
+        if measurement is not None and not cancelled:
+            measurement.failed(repr(e))
+        if capture_trace is not None:
+            capture_trace.done("cancelled" if cancelled else "error", None if cancelled else repr(e))
+        raise
+    finally:
+        kube_span.end()
+        if placed is not None:
+            # The adapter may be evicted from these replicas again
+            adapters.release(model, placed)
 
 
 @router.websocket("/v1/chat/completions")
 async def websocket_endpoint(websocket: WebSocket):
     # Step 1: Extract the token from WebSocket headers
     token = websocket.headers.get("Authorization")
+    # Requests on this socket continue the client's trace, if it sent one
+    traceparent = websocket.headers.get("traceparent")
+    # Default timeout of every request on this socket; a "timeout" field can shorten it
+    socket_timeout = websocket.headers.get(deadlines.TIMEOUT_HEADER)
 
-    val_token = await validate_token(token)
+    with tracing.span(
+        "websocket_endpoint.connect", traceparent=traceparent, kind=tracing.KIND_SERVER
+    ):
+        val_token = await validate_token(token)
 
     if not token or not val_token:
         await websocket.close(code=1008, reason="Invalid or missing token")
@@ -226,33 +366,106 @@ async def websocket_endpoint(websocket: WebSocket):
 
     # Step 2: Connect the WebSocket for this token
     await manager.connect(token, websocket)
-    print(f"Client connected with token: {token}")
+
+    # Requests that carry an "id" run concurrently on this socket
+    session = MultiplexSession(websocket)
 
     try:
         while True:
             # Step 3: Receive JSON message from the client
             data = await websocket.receive_json()
-            print(f"Received: {data}")
+
+            if isinstance(data, dict) and "id" in data:
+                request_id = str(data["id"])
+                logger.debug("Multiplexed frame for request %s", request_id)
+                if data.get("type") == "cancel":
+                    if not await session.cancel(request_id):
+                        await session.send(request_id, "error", error="No running request with this id")
+                    continue
+                if drainer.draining:
+                    # The socket is closed once running requests finish
+                    await session.send(request_id, "error", error="Server is restarting, reconnect")
+                    continue
+                try:
+                    deadline = deadlines.deadline_from(
+                        time.monotonic(), data.get("timeout"), socket_timeout
+                    )
+                except ValueError as e:
+                    await session.send(request_id, "error", error=str(e))
+                    continue
+                capture_trace = capture.sample("websocket", data, val_token)
+                await session.submit(
+                    request_id,
+                    lambda request_id=request_id, data=data, deadline=deadline, trace=capture_trace: (
+                        multiplexed_inference(session, request_id, data, deadline, trace)
+                    ),
+                    traceparent=data.get("traceparent") or traceparent,
+                    deadline=deadline,
+                )
+                continue
+
+            # Requests without an id keep the original one-at-a-time protocol
+            if drainer.draining:
+                await websocket.send_json({"error": "Server is restarting, reconnect"})
+                continue
+            received = time.monotonic()
+            try:
+                deadline = deadlines.deadline_from(
+                    received, data.get("timeout"), socket_timeout
+                )
+            except ValueError as e:
+                await websocket.send_json({"error": str(e)})
+                continue
 
             # Extract model and parameters
-            model = data.get("model", "default-model")
-            prompt = data.get("prompt", [])
+            resolution = registry.resolve(data.get("model"), allows_fallback(data))
+            model = resolution.model
             max_tokens = data.get("max_tokens", 11)
             temperature = data.get("temperature", 0.7)
             stream = data.get("stream", True)
+            try:
+                prompt, add_special_tokens = build_prompt(resolution.base_model, data)
+            except ValueError as e:
+                await websocket.send_json({"error": str(e)})
+                continue
+
+            if resolution.fallback:
+                # Tell the client which model actually serves this request
+                await websocket.send_json(
+                    {"served_model": model, "requested_model": resolution.alias}
+                )
 
             # Step 4: Send data to Kubernetes server
             # Step 5: Stream response back to the client
-            await perform_inference(
-                model, prompt, max_tokens, temperature, stream, websocket
-            )
+            with drainer.track(), tracing.span(
+                "websocket_endpoint.request",
+                traceparent=data.get("traceparent") or traceparent,
+                kind=tracing.KIND_SERVER,
+            ):
+                await perform_inference(
+                    model,
+                    prompt,
+                    max_tokens,
+                    temperature,
+                    stream,
+                    websocket,
+                    add_special_tokens=add_special_tokens,
+                    urls=resolution.urls,
+                    deadline=deadline,
+                    capture_trace=capture.sample("websocket", data, val_token, received),
+                    chat=bool(data.get("messages")),
+                    tools=tool_template(resolution.base_model, data),
+                )
 
     except WebSocketDisconnect:
         # Step 6: Disconnect the specific WebSocket for this token
-        manager.disconnect(token, websocket)
-        print(f"Client with token {token} disconnected")
+        await session.close()
+        await manager.disconnect(token, websocket)
+        logger.debug("WebSocket client disconnected")
     except Exception as e:                                                                           # pylint: disable=broad-exception-caught
         print(f"Error in websocket connection: {str(e)}")
+        await session.close()
+        await manager.disconnect(token, websocket)
         await websocket.close(code=1011, reason="Internal server error")
 
 
@@ -266,8 +479,10 @@ async def chat_completions(request: Request, authorization: str = Header(None)):
         authorization (str): Bearer token for API authentication.
 
     Returns:
-        JSONResponse or StreamingResponse: Depending on the "stream" parameter.
+        Response or StreamingResponse: Depending on the "stream" parameter.
     """
+    # The client's timeout covers everything from here on, auth included
+    received = time.monotonic()
     try:
         # Ensure Authorization header is provided
         if not authorization:
@@ -277,18 +492,39 @@ async def chat_completions(request: Request, authorization: str = Header(None)):
 
         # Extract and validate the token
         token = authorization.strip()
-        user_id = validate_token(token)
+        user_id = await validate_token(token)
         if not user_id:
             raise HTTPException(
                 status_code=401, detail="Invalid or insufficient balance for the token"
             )
 
         # Get JSON data from the incoming request
-        data = await request.json()
+        data = await read_json(request)
+
+        # A "timeout" field or X-Request-Timeout header (seconds) sets a deadline
+        try:
+            deadline = deadlines.deadline_from(
+                received, request.headers.get(deadlines.TIMEOUT_HEADER), data.get("timeout")
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+        # A sample of requests is written out as traces for replay
+        capture_trace = capture.sample("http", data, user_id, received)
+
+        # Resolve the model alias to a deployment tier (possibly a fallback)
+        resolution = registry.resolve(data.get("model"), allows_fallback(data))
+        model = resolution.model
+        served_headers = {
+            "X-Served-Model": model,
+            "X-Model-Fallback": str(resolution.fallback).lower(),
+        }
 
         # Extract parameters from the incoming request
-        model = data.get("model", "meta-llama/Llama-3.1-8B-Instruct")
-        prompt = data.get("prompt", "")
+        try:
+            prompt, add_special_tokens = build_prompt(resolution.base_model, data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
         max_tokens = data.get("max_tokens", 50)
         temperature = data.get("temperature", 0.2)
         stream = data.get("stream", "True")  # Defaults to "True" if not provided
@@ -297,44 +533,190 @@ async def chat_completions(request: Request, authorization: str = Header(None)):
 
         # Validate required fields
         if not prompt:
-            raise HTTPException(status_code=400, detail="Prompt is required")
+            raise HTTPException(status_code=400, detail="Prompt or messages is required")
+
+        # The root span opened by TracingMiddleware
+        request_span = tracing.current()
+        if request_span is not None:
+            request_span.set("user.id", user_id)
+            request_span.set("llm.model", model)
+            request_span.set("llm.stream", bool_stream)
+
+        # Chat messages get chat-format responses, a raw prompt completion ones
+        chat = bool(data.get("messages"))
+        tools = tool_template(resolution.base_model, data)
 
-        # Streaming or non-streaming response
         # Streaming or non-streaming response
         if bool_stream:
+            # Wait for the first chunk so upstream errors still map to a status code
+            chunks = await upstream.prime(
+                stream_kube_data(
+                    model,
+                    prompt,
+                    max_tokens,
+                    temperature,
+                    stream,
+                    bool_stream,
+                    add_special_tokens=add_special_tokens,
+                    urls=resolution.urls,
+                    deadline=deadline,
+                    capture_trace=capture_trace,
+                    chat=chat,
+                    tools=tools,
+                )
+            )
             return StreamingResponse(
-            stream_kube_data(
-                model, prompt, max_tokens, temperature, stream, bool_stream
-            ),
-            media_type="application/json",
+                coalesce(chunks),
+                media_type="text/event-stream" if chat else "application/json",
+                headers=served_headers,
             )
 
         # Non-streaming response (accumulate and return the full output)
-        response_data: Dict[str, Any] = {}
+        started = time.perf_counter()
+        raw_response = b""
         async for chunk in stream_kube_data(
-            model, prompt, max_tokens, temperature, stream, bool_stream
-            ):
-            response_data = chunk  # Just store the response directly
+            model,
+            prompt,
+            max_tokens,
+            temperature,
+            stream,
+            bool_stream,
+            add_special_tokens=add_special_tokens,
+            urls=resolution.urls,
+            deadline=deadline,
+            capture_trace=capture_trace,
+            chat=chat,
+            tools=tools,
+        ):
+            raw_response = chunk  # The body as returned to the client
 
-        # Now response_data is the dictionary from response.json()
+        # Only the id/model/usage fields are decoded, never the choices
+        response_fields = extract_usage_fields(raw_response)
+        usage = response_fields["usage"]
 
         # Extract relevant fields for logging
         log_data = {
-            "prompt_tokens": response_data.get("usage", {}).get("prompt_tokens"),
-            "completion_tokens": response_data.get("usage", {}).get(
-                "completion_tokens"
-            ),
-            "total_tokens": response_data.get("usage", {}).get("total_tokens"),
-            "timestamp": response_data.get("created"),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "total_tokens": usage.get("total_tokens"),
+            "timestamp": response_fields.get("created"),
             "user_id": user_id,
-            "model": response_data.get("model"),
-            "log_id": response_data.get("id"),
+            "model": response_fields.get("model"),
+            "log_id": response_fields.get("id"),
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
         }
 
-        # Push the log data to Redis
-        await push_log_to_redis(log_data)
+        # Charged to the Redis balance; Postgres catches up on the next flush
+        spending = balances.price(
+            model, usage.get("prompt_tokens"), usage.get("completion_tokens"), resolution.base_model
+        )
+        if spending is not None:
+            log_data["spending"] = spending
+            await balances.debit(token, spending)
+
+        # Queue the log for Redis; never delays or fails the response
+        with tracing.span("usage.emit", **{"usage.total_tokens": log_data["total_tokens"] or 0}):
+            emitter.emit(log_data)
 
-        # Return the complete response data as JSON
-        return JSONResponse(content=response_data)
+        # Return the body without re-serializing it
+        return Response(
+            content=raw_response, media_type="application/json", headers=served_headers
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {e}") from e
+
+
+@router.post("/v1/embeddings")
+async def create_embeddings(request: Request, authorization: str = Header(None)):
+    """
+    OpenAI-compatible embeddings endpoint.
+
+    Inputs are served from the content-hash cache where possible, and the
+    rest are batched with those of concurrent requests into shared
+    upstream calls. Cached inputs are metered like fresh ones.
+
+    Args:
+        request (Request): Incoming HTTP request with JSON payload.
+        authorization (str): Bearer token for API authentication.
+
+    Returns:
+        dict: The embeddings, in the order of the inputs, with token usage.
+    """
+    received = time.monotonic()
+    if not embeddings.EMBEDDING_URLS:
+        raise HTTPException(status_code=503, detail="Embeddings are not configured")
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization header is required")
+
+    user_id = await validate_token(authorization.strip())
+    if not user_id:
+        raise HTTPException(
+            status_code=401, detail="Invalid or insufficient balance for the token"
+        )
+
+    data = await read_json(request)
+    try:
+        deadline = deadlines.deadline_from(
+            received, request.headers.get(deadlines.TIMEOUT_HEADER), data.get("timeout")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    model = data.get("model") or embeddings.EMBEDDING_MODEL
+    inputs = data.get("input")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if (
+        not isinstance(inputs, list)
+        or not inputs
+        or not all(isinstance(text, str) and text for text in inputs)
+    ):
+        raise HTTPException(
+            status_code=400, detail="input must be a non-empty string or list of strings"
+        )
+    if len(inputs) > embeddings.EMBEDDING_MAX_INPUTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {embeddings.EMBEDDING_MAX_INPUTS} inputs per request",
+        )
+    encoding_format = data.get("encoding_format") or "float"
+    if encoding_format not in ("float", "base64"):
+        raise HTTPException(status_code=400, detail="encoding_format must be float or base64")
+    dimensions = data.get("dimensions")
+    if dimensions is not None and (not isinstance(dimensions, int) or dimensions <= 0):
+        raise HTTPException(status_code=400, detail="dimensions must be a positive integer")
+
+    started = time.perf_counter()
+    vectors = await embeddings.embedder.embed(model, inputs, dimensions, deadline)
+    tokens = sum(count for count, _ in vectors)
+
+    log_data = {
+        "prompt_tokens": tokens,
+        "completion_tokens": 0,
+        "total_tokens": tokens,
+        "timestamp": int(time.time()),
+        "user_id": user_id,
+        "model": model,
+        "log_id": f"embd-{uuid.uuid4().hex}",
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    spending = balances.price(model, tokens, 0)
+    if spending is not None:
+        log_data["spending"] = spending
+        await balances.debit(authorization.strip(), spending)
+
+    with tracing.span("usage.emit", **{"usage.total_tokens": tokens}):
+        emitter.emit(log_data)
+
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index,
+             "embedding": embeddings.encode(packed, encoding_format)}
+            for index, (_, packed) in enumerate(vectors)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
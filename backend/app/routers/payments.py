@@ -1,15 +1,15 @@
 import os
 import logging
 
-import stripe
-from stripe.error import StripeError
 from fastapi import HTTPException, Request, Header, APIRouter, Depends
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from redis.asyncio import Redis
-from psycopg import AsyncConnection
-
-from backend.database.db import get_redis_client, get_psql_conn
+from backend.database import queries
+from backend.database.db import PsqlSession, get_redis_client, get_psql_reader, get_psql_writer
+from backend.app.services import balances
+from backend.app.services.response_cache import BILLING_VERSION_KEY, bump_version, cached_json
 
 # Load env variables
 load_dotenv()
@@ -23,10 +23,24 @@ logging.basicConfig(
 )
 
 # Config Stripe env variables
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 stripe_product_id = os.getenv("STRIPE_PRODUCT_ID")
 stripe_webhook_secret = os.getenv("STRIPE_ENDPOINT_SECRET")
 
+_stripe_module = None
+
+
+def get_stripe():
+    """
+    Import and configure the Stripe SDK on first use, so it does not
+    slow down gateway startup.
+    """
+    global _stripe_module                                                                            # pylint: disable=global-statement
+    if _stripe_module is None:
+        import stripe                                                                                # pylint: disable=import-outside-toplevel
+        stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+        _stripe_module = stripe
+    return _stripe_module
+
 
 # pydatic models
 class PaymentIntentRequest(BaseModel):
@@ -34,14 +48,15 @@ class PaymentIntentRequest(BaseModel):
 
 
 # define the router
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 
 @router.get("/get-billing-data")
 async def get_balance(
+    request: Request,
     authorization: str = Header(None),
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    reader: PsqlSession = Depends(get_psql_reader),
 ):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid or missing authorization token")
@@ -57,32 +72,31 @@ async def get_balance(
                 status_code=400, detail="User not found for the given token"
             )
 
-        # Fetch the user's balance from the database
-        async with conn.cursor() as cursor:
-            query = """
-            SELECT balance 
-            FROM users
-            WHERE user_id = %s 
-            """
-            await cursor.execute(query, (user_id,))
-            # Fetch the result
-            result = await cursor.fetchone()
+        async def load_billing():
+            # Fetch the user's balance from the database
+            result = await reader.fetchone(queries.USER_BALANCE, (user_id,))
             if not result:
                 raise HTTPException(
                     status_code=404, detail="Balance not found for user"
                 )
             balance = result[0]
 
-        # Check if billing history exists in Redis
-        billing_history = await redis.lrange(f"billing_history:{user_id}", 0, -1)
+            # Check if billing history exists in Redis
+            billing_history = await redis.lrange(f"billing_history:{user_id}", 0, -1)
+
+            # If billing history is not found, default to an empty list
+            if not billing_history:
+                billing_history = []  # Default to empty list
 
-        # If billing history is not found, default to an empty list
-        if not billing_history:
-            billing_history = []  # Default to empty list
+            return {"balance": float(balance), "billingHistory": billing_history}
 
-        # Return the balance and billing history as a response
-        return {"balance": float(balance), "billingHistory": billing_history}
+        # Served from Redis until a payment changes the balance
+        return await cached_json(
+            request, redis, "billing_data", user_id, BILLING_VERSION_KEY, load_billing
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         # Log the exception message for debugging
         print(f"Error occurred: {str(e)}")
@@ -101,6 +115,7 @@ async def create_payment_intent(
             status_code=401, detail="Invalid or missing authorization token"
         )
 
+    stripe = get_stripe()
     try:
         bearer_token = authorization.split(" ")[1]  # Extract the token
         user_id = await redis.get(f"bearer_token:{bearer_token}")
@@ -116,7 +131,7 @@ async def create_payment_intent(
             },
         )
         return {"clientSecret": payment_intent.client_secret}
-    except StripeError as e:
+    except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
@@ -132,6 +147,7 @@ async def create_checkout_session(
             status_code=401, detail="Invalid or missing authorization token"
         )
 
+    stripe = get_stripe()
     try:
         # Log the incoming data for debugging
         print(f"Received request: {request}")
@@ -175,7 +191,7 @@ async def create_checkout_session(
 async def stripe_webhook(
     request: Request,
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    writer: PsqlSession = Depends(get_psql_writer),
 ):
     payload = await request.body()
     sig_header = request.headers.get("Stripe-Signature")
@@ -185,6 +201,7 @@ async def stripe_webhook(
     if not endpoint_secret:
         raise HTTPException(status_code=500, detail="Stripe endpoint secret not set")
 
+    stripe = get_stripe()
     try:
         # Verify Stripe webhook signature
         event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
@@ -196,51 +213,60 @@ async def stripe_webhook(
             # Extract metadata
             user_id = session["metadata"].get("user_id")
             amount_paid = round(session["amount_total"] / 100, 2)  # Amount in dollars
+            payment_id = session["id"]
+
+            # Record the credit and update the balance in one transaction on the primary
+            async with writer.connection() as conn:
+                # Stripe retries webhooks; a payment already in the ledger is not credited again
+                async with conn.cursor() as cursor:
+                    query = """
+                    INSERT INTO balance_credits (payment_id, user_id, amount)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (payment_id) DO NOTHING
+                    RETURNING payment_id;
+                    """
+                    await cursor.execute(query, (payment_id, user_id, amount_paid))
+                    if not await cursor.fetchone():
+                        await conn.rollback()
+                        return {"status": "success", "message": "Payment already credited"}
+
+                # Fetch the stored balance and llm_api_token, locking the row
+                async with conn.cursor() as cursor:
+                    query = """
+                    SELECT balance, balance_version, llm_api_token
+                    FROM users
+                    WHERE user_id=%s
+                    FOR UPDATE
+                    """
+                    await cursor.execute(query, (user_id,))
+                    result = await cursor.fetchone()
+
+                if not result:
+                    await conn.rollback()
+                    raise HTTPException(status_code=404, detail="User not found")
+                current_balance, balance_version, api_token = result
+
+                # Redis holds the live balance (spend is debited there); credit it
+                # there and store the result, which the write-behind flush would
+                # otherwise bring over
+                new_balance, new_version = await balances.credit(
+                    redis, api_token, amount_paid, payment_id,
+                    seed=(user_id, current_balance or 0, balance_version),
+                )
 
-            # Fetch current balance and llm_api_token from Postgres (use 0.0 if not found)
-            async with conn.cursor() as cursor:
-                query = """
-                SELECT balance , llm_api_token
-                FROM users
-                WHERE user_id=%s
-                """
-                await cursor.execute(query, (user_id,))
-                result = await cursor.fetchone()
-                current_balance, api_token = result
-
-            if result:
-                current_balance, api_token = result
-                current_balance = float(current_balance) if current_balance else 0.0
-            else:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            # Update the balance
-            new_balance = round(current_balance + amount_paid, 2)
-
-            # Update the balance in psql
-            async with conn.cursor() as cursor:
-                query = """
-                UPDATE users
-                SET balance = %s
-                WHERE user_id=%s
-                RETURNING balance;
-                """
-                await cursor.execute(query, (new_balance, user_id))
+                # Update the balance in psql, unless a newer one is there already
+                async with conn.cursor() as cursor:
+                    query = """
+                    UPDATE users
+                    SET balance = %s, balance_version = %s
+                    WHERE user_id=%s AND balance_version < %s;
+                    """
+                    await cursor.execute(query, (new_balance, new_version, user_id, new_version))
 
                 # Commit the transaction to make the update persistent
                 await conn.commit()
 
-                psql_balance = await cursor.fetchone()
-
-            # Check if balance was successfully updated
-            if not psql_balance:
-                await conn.rollback()  # In case of an error, rollback the transaction
-                raise HTTPException(
-                    status_code=500, detail="Failed to update balance in psql database"
-                )
-
-            # Update the balance in Redis
-            await redis.hset(f"llm_api_token:{api_token}", "balance", new_balance)
+            await bump_version(redis, BILLING_VERSION_KEY, user_id)
 
             # Log to confirm successful update
             print(f"Updated balance for user {user_id}: {new_balance}")
@@ -1,16 +1,24 @@
 import logging
 import traceback
+import datetime as dt
+from typing import Optional
+
+import psycopg
 import psycopg2
-from psycopg import AsyncConnection
 
-from fastapi import APIRouter, Depends, Header, Request, HTTPException
+from fastapi import APIRouter, Depends, Header, Query, Request, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from redis.asyncio import Redis
 
-from backend.database.db import get_redis_client, get_psql_conn
+from backend.database import queries
+from backend.database.db import PsqlSession, get_redis_client, get_psql_reader
+from backend.app.services import rollups
+from backend.app.services.response_cache import (
+    ROLLUP_VERSION_KEY, USAGE_VERSION_KEY, cached_json
+)
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 # Security scheme
 security = HTTPBearer()
@@ -28,7 +36,7 @@ logger = logging.getLogger(__name__)
 async def get_info(
     authorization: str = Header(None),
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    reader: PsqlSession = Depends(get_psql_reader),
 ):
 
     if not authorization or not authorization.startswith("Bearer "):
@@ -47,13 +55,7 @@ async def get_info(
 
     try:
         # get the user data from psql
-        async with conn.cursor() as cursor:
-            query = """
-            SELECT user_id, user_name, llm_api_token, bearer_token, fname, lname, email, balance
-            FROM users WHERE user_id = %s
-            """
-            await cursor.execute(query, (user_id,))
-            user_data = await cursor.fetchone()
+        user_data = await reader.fetchone(queries.USER_PROFILE, (user_id,))
 
         if not user_id:
             return {"error": "user data not found"}
@@ -90,7 +92,7 @@ async def get_info(
 async def get_api_keys(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    reader: PsqlSession = Depends(get_psql_reader),
 ):
     try:
         current_token = credentials.credentials
@@ -102,28 +104,18 @@ async def get_api_keys(
             raise HTTPException(status_code=400, detail="Invalid Bearer token")
 
         # Retrieve user data from psql
-        async with conn.cursor() as cursor:
-            # Define the query to fetch the llm_api_token for a given user_id
-            query = """
-                SELECT llm_api_token,fname, user_name
-                FROM users
-                WHERE user_id = %s
-                """
-            await cursor.execute(query, (user_id,))  # Execute the query with the user_id param
-
-            # Fetch the result
-            result = await cursor.fetchone()
-
-            if result:
-                return {
-                    "api_token": result[0],  # llm_api_token
-                    "fname": result[1],  # fname
-                    "user_name": result[2],  # user_name
-                }
+        result = await reader.fetchone(queries.USER_API_KEY, (user_id,))
 
-            raise HTTPException(
-                status_code=404, detail="No API token found for the user"
-            )
+        if result:
+            return {
+                "api_token": result[0],  # llm_api_token
+                "fname": result[1],  # fname
+                "user_name": result[2],  # user_name
+            }
+
+        raise HTTPException(
+            status_code=404, detail="No API token found for the user"
+        )
 
     except psycopg2.Error as db_err:
         logger.exception("Database error occurred while regenerating API token: %s", str(db_err))
@@ -138,7 +130,7 @@ async def get_api_keys(
 async def get_balance(
     authorization: str = Header(None),
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    reader: PsqlSession = Depends(get_psql_reader),
 ):
 
     if not authorization or not authorization.startswith("Bearer "):
@@ -155,15 +147,7 @@ async def get_balance(
 
     # Fetch the user's balance from the database
     try:
-        async with conn.cursor() as cursor:
-            query = """
-            SELECT balance 
-            FROM users
-            WHERE user_id = %s 
-            """
-            await cursor.execute(query, (user_id,))
-            # Fetch the result
-            result = await cursor.fetchone()
+        result = await reader.fetchone(queries.USER_BALANCE, (user_id,))
 
         if result:
             current_balance = float(result[0])
@@ -187,7 +171,7 @@ async def get_balance(
 async def get_usage_dashboard(
     request: Request,
     redis: Redis = Depends(get_redis_client),
-    conn: AsyncConnection = Depends(get_psql_conn),
+    reader: PsqlSession = Depends(get_psql_reader),
 ):
     auth_header = request.headers.get("Authorization")
 
@@ -202,36 +186,113 @@ async def get_usage_dashboard(
     if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid or expired bearer token")
 
-    query = """
-    SELECT
-        model,
-        SUM(total_tokens) AS total_tokens,
-        SUM(spending) AS total_spending
-    FROM logs
-    WHERE user_id = %s
-        AND timestamp >= NOW() - INTERVAL '1 month'
-    GROUP BY model
-    ORDER BY total_tokens DESC;
-    """
+    async def load_usage():
+        result = await reader.fetchall(queries.USAGE_LAST_MONTH, (user_id,))
+        usage_data = [
+            {
+                "model": row[0],
+                "total_tokens": float(row[1]),
+                "total_spending": float(row[2]),
+            }
+            for row in result
+        ]
+        return {"usage_data": usage_data}
 
     try:
-        async with conn.cursor() as cursor:
-            await cursor.execute(query, (user_id,))
-            result = await cursor.fetchall()
-
-            usage_data = [
-                {
-                    "model": row[0],
-                    "total_tokens": float(row[1]),
-                    "total_spending": float(row[2]),
-                }
-                for row in result
-            ]
-
-            return JSONResponse(content={"usage_data": usage_data})
+        # Served from Redis until new usage for this user is ingested
+        return await cached_json(
+            request, redis, "usage_dashboard", user_id, USAGE_VERSION_KEY, load_usage
+        )
 
     except Exception as e:                                                                           # pylint: disable=broad-exception-caught
 
         print("Error in /usage_dashboard:", traceback.format_exc())
-        await conn.rollback()
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        return ORJSONResponse(content={"error": str(e)}, status_code=500)
+
+
+def parse_time(value: Optional[str], default: dt.datetime) -> dt.datetime:
+    """ISO 8601 timestamp from a query parameter; naive values are UTC."""
+    if not value:
+        return default
+    try:
+        parsed = dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp: {value}") from e
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt.timezone.utc)
+
+
+@router.get("/usage/timeseries")
+async def get_usage_timeseries(
+    request: Request,
+    granularity: str = Query("hour"),
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = Query(None),
+    model: Optional[str] = Query(None),
+    redis: Redis = Depends(get_redis_client),
+    reader: PsqlSession = Depends(get_psql_reader),
+):
+    """
+    Usage over time from the hourly/daily rollups.
+
+    Buckets are dense (empty ones are zero) and widened to a multiple of
+    `granularity` when the range would otherwise exceed
+    rollups.TIMESERIES_MAX_POINTS, so any range costs the same to serve.
+    Raw logs are never scanned here.
+    """
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        raise HTTPException(
+            status_code=401, detail="Missing or invalid Authorization header"
+        )
+
+    bearer_token = auth_header.split("Bearer ")[1]
+    user_id = await redis.get(f"bearer_token:{bearer_token}")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired bearer token")
+
+    if granularity not in rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail="granularity must be 'hour' or 'day'")
+
+    now = dt.datetime.now(dt.timezone.utc)
+    default_span = dt.timedelta(days=7 if granularity == "hour" else 90)
+    end = parse_time(to, now)
+    start = parse_time(from_, end - default_span)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    start, end, step = rollups.plan_series(granularity, start, end)
+
+    async def load_series():
+        rows = await reader.fetchall(
+            queries.USAGE_TIMESERIES[granularity],
+            {"user_id": user_id, "model": model, "start": start, "end": end, "step": step},
+        )
+        points = [
+            {
+                "timestamp": row[0],
+                "requests": int(row[1]),
+                "total_tokens": int(row[2]),
+                "spending": float(row[3]),
+                **rollups.latency_percentiles(row[4]),
+            }
+            for row in rows
+        ]
+        return {
+            "granularity": granularity,
+            "bucket_seconds": int(step.total_seconds()),
+            "from": start,
+            "to": end,
+            "model": model,
+            "points": points,
+        }
+
+    # The aligned range keeps the cache key stable between polls
+    cache_name = (
+        f"usage_timeseries:{granularity}:{start.isoformat()}:{end.isoformat()}:{model or '*'}"
+    )
+    try:
+        return await cached_json(
+            request, redis, cache_name, user_id, ROLLUP_VERSION_KEY, load_series
+        )
+    except psycopg.Error as e:
+        logger.error("Database error while fetching usage time series: %s", e)
+        raise HTTPException(status_code=500, detail="Database error occurred") from e
@@ -0,0 +1,277 @@
+import os
+import math
+import time
+import logging
+from dataclasses import asdict, dataclass, field, replace
+
+from typing import Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+
+from backend.database import db
+from backend.app.services import upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AutoscalerConfig:
+    """
+    Tuning for `compute_desired_replicas`.
+
+    Attributes:
+        min_replicas (int): Floor for the recommendation.
+        max_replicas (int): Ceiling for the recommendation.
+        target_queue_per_replica (float): Queued requests one replica may carry.
+        target_utilization (float): Fraction of measured capacity to plan for.
+        default_capacity_tps (float): Per-replica tokens/sec until one is measured.
+        tolerance (float): Relative band around the current target that is ignored.
+        startup_seconds (float): Time for a new replica to load the model and pass probes.
+        scale_down_stabilization (float): How long load must stay low before a scale-down;
+            the highest recommendation inside it bounds how far down to go.
+        scale_down_cooldown (float): Minimum time between two scale-downs.
+        scale_down_step (int): Most replicas removed per decision.
+    """
+    min_replicas: int = 1
+    max_replicas: int = 8
+    target_queue_per_replica: float = 8.0
+    target_utilization: float = 0.8
+    default_capacity_tps: float = 1500.0
+    tolerance: float = 0.1
+    startup_seconds: float = 240.0
+    scale_down_stabilization: float = 300.0
+    scale_down_cooldown: float = 300.0
+    scale_down_step: int = 1
+
+
+@dataclass(frozen=True)
+class LoadObservation:
+    """
+    What the gateway saw at one evaluation.
+
+    Attributes:
+        timestamp (float): Seconds; the same clock for every observation fed to one state.
+        queue_depth (float): Requests admitted but waiting for an engine slot.
+        demand_tps (float): Tokens/sec currently being generated.
+        ready_replicas (int): Replicas passing health checks.
+        replica_capacity_tps (float, optional): Measured tokens/sec of one saturated replica.
+    """
+    timestamp: float
+    queue_depth: float
+    demand_tps: float
+    ready_replicas: int
+    replica_capacity_tps: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class ScalerState:
+    """
+    Memory carried between evaluations.
+
+    Attributes:
+        desired (int): The current recommendation (includes replicas still starting).
+        last_scale_up (float): When the recommendation last went up.
+        last_scale_down (float): When the recommendation last went down.
+        low_since (float, optional): Since when the load has been below the tolerance band.
+        recent (tuple): (timestamp, raw recommendation) pairs inside the stabilization window.
+    """
+    desired: int
+    last_scale_up: float = -math.inf
+    last_scale_down: float = -math.inf
+    low_since: Optional[float] = None
+    recent: Tuple[Tuple[float, float], ...] = field(default_factory=tuple)
+
+
+def raw_replicas(observation: LoadObservation, config: AutoscalerConfig) -> float:
+    """Replicas needed for the observed load, before hysteresis and bounds."""
+    capacity = observation.replica_capacity_tps or config.default_capacity_tps
+    for_throughput = observation.demand_tps / (capacity * config.target_utilization)
+    for_queue = observation.queue_depth / config.target_queue_per_replica
+    return max(for_throughput, for_queue)
+
+
+def compute_desired_replicas(
+    observation: LoadObservation, state: ScalerState, config: AutoscalerConfig
+) -> ScalerState:
+    """
+    Turn one observation into the next replica recommendation.
+
+    Scale-ups happen as soon as the load leaves the tolerance band. The
+    recommendation already counts replicas that are still starting, so a
+    load spike seen again while they boot does not stack another
+    scale-up on top. Scale-downs need the load to stay low for the whole
+    stabilization window, never happen within `startup_seconds` of a
+    scale-up (the new replicas have not had a chance to take load yet),
+    respect the cooldown, and remove at most `scale_down_step` replicas.
+
+    Pure function: no clock, no I/O, so it can be driven by synthetic traces.
+
+    Args:
+        observation (LoadObservation): The current load.
+        state (ScalerState): The state returned by the previous call.
+        config (AutoscalerConfig): Tuning.
+
+    Returns:
+        ScalerState: The new state; `desired` is the recommendation.
+    """
+    now = observation.timestamp
+    raw = raw_replicas(observation, config)
+    recent = tuple(
+        (t, r) for t, r in state.recent if now - t < config.scale_down_stabilization
+    ) + ((now, raw),)
+    state = replace(state, recent=recent)
+    current = max(config.min_replicas, min(config.max_replicas, state.desired))
+
+    if raw > current * (1 + config.tolerance):
+        target = min(config.max_replicas, math.ceil(raw))
+        if target > current:
+            return replace(state, desired=target, last_scale_up=now, low_since=None)
+        return replace(state, desired=current, low_since=None)
+
+    if raw >= current * (1 - config.tolerance):
+        return replace(state, desired=current, low_since=None)
+
+    low_since = now if state.low_since is None else state.low_since
+    state = replace(state, desired=current, low_since=low_since)
+    stable = now - low_since >= config.scale_down_stabilization
+    settled = now - state.last_scale_up >= config.startup_seconds
+    cooled = now - state.last_scale_down >= config.scale_down_cooldown
+    if stable and settled and cooled:
+        ceiling = math.ceil(max(r for _, r in recent))
+        target = max(config.min_replicas, ceiling, current - config.scale_down_step)
+        if target < current:
+            return replace(state, desired=target, last_scale_down=now, low_since=None)
+    return state
+
+
+# --- Runtime: feeds the pure model from the backend_metrics snapshots ---
+CONFIG = AutoscalerConfig(
+    min_replicas=int(os.getenv("AUTOSCALE_MIN_REPLICAS", "1")),
+    max_replicas=int(os.getenv("AUTOSCALE_MAX_REPLICAS", "8")),
+    target_queue_per_replica=float(os.getenv("AUTOSCALE_TARGET_QUEUE_PER_REPLICA", "8")),
+    target_utilization=float(os.getenv("AUTOSCALE_TARGET_UTILIZATION", "0.8")),
+    default_capacity_tps=float(os.getenv("AUTOSCALE_DEFAULT_CAPACITY_TPS", "1500")),
+    tolerance=float(os.getenv("AUTOSCALE_TOLERANCE", "0.1")),
+    startup_seconds=float(os.getenv("AUTOSCALE_STARTUP_SECONDS", "240")),
+    scale_down_stabilization=float(os.getenv("AUTOSCALE_SCALE_DOWN_WINDOW", "300")),
+    scale_down_cooldown=float(os.getenv("AUTOSCALE_SCALE_DOWN_COOLDOWN", "300")),
+    scale_down_step=int(os.getenv("AUTOSCALE_SCALE_DOWN_STEP", "1")),
+)
+
+# How often one gateway worker re-evaluates (a jobs.register job)
+AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", "10"))
+# A stored recommendation older than this is not served
+AUTOSCALE_STALE_AFTER = float(os.getenv("AUTOSCALE_STALE_AFTER", "60"))
+
+# Smoothing for the measured per-replica capacity
+CAPACITY_EWMA_ALPHA = 0.2
+
+# The ScalerState and learned capacity carried between evaluations, and the
+# latest recommendation with the observation behind it. Shared by all
+# gateway workers, so one state machine drives the scaler.
+STATE_KEY = "autoscaler:state"
+RECOMMENDATION_KEY = "autoscaler:recommendation"
+
+
+def _dump_state(state: ScalerState, capacity_tps: Optional[float]) -> bytes:
+    values = asdict(state)
+    # JSON has no infinity; "never" is stored as null
+    for name in ("last_scale_up", "last_scale_down"):
+        if math.isinf(values[name]):
+            values[name] = None
+    return orjson.dumps({"state": values, "capacity_tps": capacity_tps})
+
+
+def _load_state(raw: Optional[str]) -> Tuple[Optional[ScalerState], Optional[float]]:
+    if not raw:
+        return None, None
+    stored = orjson.loads(raw)
+    values = stored["state"]
+    for name in ("last_scale_up", "last_scale_down"):
+        if values.get(name) is None:
+            values[name] = -math.inf
+    values["recent"] = tuple(tuple(pair) for pair in values.get("recent") or ())
+    return ScalerState(**values), stored.get("capacity_tps")
+
+
+def observe(capacity_tps: Optional[float]) -> LoadObservation:
+    """
+    Build an observation from the latest scrapes.
+
+    The queue is vLLM's waiting count plus requests this worker has sent
+    that no engine reports as running yet. Capacity is learned only from
+    replicas that had a queue, since an idle replica's throughput says
+    nothing about what it could do; `capacity_tps` is the estimate so far.
+    The timestamp is wall-clock time, as the state is carried across
+    workers and pods.
+    """
+    queue_depth = 0.0
+    demand_tps = 0.0
+    ready = 0
+    for url in upstream.UPSTREAM_URLS:
+        backend = upstream.get_backend(url)
+        load = backend.fresh_load()
+        if load is None:
+            queue_depth += backend.inflight
+            continue
+        if not load.healthy:
+            continue
+        ready += 1
+        queue_depth += load.waiting + max(0.0, backend.inflight - load.running - load.waiting)
+        if load.generation_tps is not None:
+            demand_tps += load.generation_tps
+            if load.waiting > 0 and load.generation_tps > 0:
+                capacity_tps = (
+                    load.generation_tps if capacity_tps is None
+                    else (1 - CAPACITY_EWMA_ALPHA) * capacity_tps
+                    + CAPACITY_EWMA_ALPHA * load.generation_tps
+                )
+
+    return LoadObservation(
+        timestamp=time.time(),
+        queue_depth=queue_depth,
+        demand_tps=demand_tps,
+        ready_replicas=ready,
+        replica_capacity_tps=capacity_tps,
+    )
+
+
+async def evaluate():
+    """
+    Scheduled job: run one autoscaling decision against live data.
+
+    Runs on one gateway worker per AUTOSCALE_INTERVAL (the jobs lock). The
+    state is read from and written back to Redis, so hysteresis and
+    cooldowns hold whichever worker or pod runs the next evaluation, and
+    the recommendation is stored for /autoscaling/metrics to serve.
+    """
+    redis = db.redis_client
+    state, capacity_tps = _load_state(await redis.get(STATE_KEY))
+    observation = observe(capacity_tps)
+    if state is None:
+        state = ScalerState(desired=max(CONFIG.min_replicas, observation.ready_replicas))
+    state = compute_desired_replicas(observation, state, CONFIG)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.set(STATE_KEY, _dump_state(state, observation.replica_capacity_tps))
+        pipe.set(
+            RECOMMENDATION_KEY,
+            orjson.dumps({"desired": state.desired, "observation": asdict(observation)}),
+        )
+        await pipe.execute()
+    logger.debug("Autoscaling recommendation: %d replicas", state.desired)
+
+
+async def recommendation() -> Optional[Tuple[int, LoadObservation]]:
+    """The stored recommendation and its observation; None if missing or stale."""
+    redis = db.redis_client
+    raw = await redis.get(RECOMMENDATION_KEY) if redis is not None else None
+    if not raw:
+        return None
+    stored = orjson.loads(raw)
+    observation = LoadObservation(**stored["observation"])
+    if time.time() - observation.timestamp > AUTOSCALE_STALE_AFTER:
+        return None
+    return stored["desired"], observation
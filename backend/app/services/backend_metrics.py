@@ -0,0 +1,260 @@
+import os
+import time
+import asyncio
+import logging
+
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from backend.app.services import upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_INTERVAL = float(os.getenv("UPSTREAM_SCRAPE_INTERVAL", "2"))
+SCRAPE_TIMEOUT = float(os.getenv("UPSTREAM_SCRAPE_TIMEOUT", "1"))
+
+# vLLM metric name -> LoadSnapshot field. Values are summed over label sets.
+# Newer vLLM releases renamed gpu_cache_usage_perc to kv_cache_usage_perc.
+METRICS = {
+    "vllm:num_requests_running": "running",
+    "vllm:num_requests_waiting": "waiting",
+    "vllm:gpu_cache_usage_perc": "kv_cache_usage",
+    "vllm:kv_cache_usage_perc": "kv_cache_usage",
+    "vllm:generation_tokens_total": "generation_tokens",
+    "vllm:request_queue_time_seconds_sum": "queue_time_sum",
+    "vllm:request_queue_time_seconds_count": "queue_time_count",
+}
+
+
+# Info gauge whose labels list the LoRA adapters with running or waiting
+# requests; one sample per change, the newest has the largest value
+LORA_INFO_METRIC = "vllm:lora_requests_info"
+
+
+# Called with a backend that just became healthy, or whose engine restarted
+_ready_hooks: List[Callable[[upstream.Backend], None]] = []
+
+
+def on_ready(hook: Callable[[upstream.Backend], None]):
+    """Have `hook` called (on the event loop) whenever a replica (re)joins."""
+    _ready_hooks.append(hook)
+
+
+class LoadSnapshot:
+    """Engine state of one replica as of its last scrape."""
+
+    def __init__(self, healthy: bool, running: float = 0.0, waiting: float = 0.0,
+                 kv_cache_usage: float = 0.0, generation_tokens: Optional[float] = None,
+                 queue_time_sum: Optional[float] = None, queue_time_count: Optional[float] = None,
+                 active_adapters: FrozenSet[str] = frozenset()):
+        self.healthy = healthy
+        self.running = running
+        self.waiting = waiting
+        self.kv_cache_usage = kv_cache_usage
+        # Counter of tokens generated since the engine started
+        self.generation_tokens = generation_tokens
+        # Tokens/sec generated since the previous scrape, None if unknown
+        self.generation_tps: Optional[float] = None
+        # Queue-time histogram totals, and the mean queue wait derived from them
+        self.queue_time_sum = queue_time_sum
+        self.queue_time_count = queue_time_count
+        self.queue_wait: Optional[float] = None
+        # LoRA adapters with requests running or queued, from any gateway worker
+        self.active_adapters = active_adapters
+        self.scraped_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.scraped_at
+
+    def as_dict(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "running": self.running,
+            "waiting": self.waiting,
+            "kv_cache_usage": self.kv_cache_usage,
+            "generation_tps": self.generation_tps,
+            "queue_wait": self.queue_wait,
+            "age_seconds": round(self.age(), 3),
+        }
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """
+    Pull the load gauges out of a Prometheus text exposition.
+
+    Args:
+        text (str): Body of vLLM's /metrics.
+
+    Returns:
+        Dict[str, float]: LoadSnapshot field -> value, for the metrics present.
+    """
+    values: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line[0] == "#":
+            continue
+        name_end = line.find("{")
+        if name_end == -1:
+            name_end = line.find(" ")
+        field = METRICS.get(line[:name_end])
+        if field is None:
+            continue
+        try:
+            value = float(line.rsplit(" ", 1)[-1])
+        except ValueError:
+            continue
+        if field == "kv_cache_usage":
+            # One value per served model; the busiest one is what matters
+            values[field] = max(values.get(field, 0.0), value)
+        else:
+            values[field] = values.get(field, 0.0) + value
+    return values
+
+
+def parse_active_adapters(text: str) -> FrozenSet[str]:
+    """LoRA adapters the newest vllm:lora_requests_info sample lists as running or waiting."""
+    newest, labels = None, ""
+    for line in text.splitlines():
+        if not line.startswith(LORA_INFO_METRIC + "{"):
+            continue
+        label_end = line.rfind("}")
+        try:
+            value = float(line[label_end + 1:])
+        except ValueError:
+            continue
+        if newest is None or value > newest:
+            newest, labels = value, line[len(LORA_INFO_METRIC) + 1:label_end]
+    active = set()
+    for label in ("running_lora_adapters", "waiting_lora_adapters"):
+        start = labels.find(f'{label}="')
+        if start == -1:
+            continue
+        start += len(label) + 2
+        active.update(name for name in labels[start:labels.find('"', start)].split(",") if name)
+    return frozenset(active)
+
+
+async def scrape(backend: upstream.Backend) -> LoadSnapshot:
+    """Poll /health and /metrics of one replica."""
+    client = upstream.get_client()
+    try:
+        health, metrics = await asyncio.gather(
+            client.get(f"{backend.base_url}/health", timeout=SCRAPE_TIMEOUT),
+            client.get(f"{backend.base_url}/metrics", timeout=SCRAPE_TIMEOUT),
+        )
+    except httpx.HTTPError as e:
+        logger.debug("Scrape of %s failed: %r", backend.base_url, e)
+        return LoadSnapshot(healthy=False)
+
+    if health.status_code != 200:
+        return LoadSnapshot(healthy=False)
+    if metrics.status_code != 200:
+        # Healthy but no metrics: routable, load unknown
+        return LoadSnapshot(healthy=True)
+    return LoadSnapshot(
+        healthy=True, active_adapters=parse_active_adapters(metrics.text), **parse_metrics(metrics.text)
+    )
+
+
+def _queue_wait(previous: Optional[LoadSnapshot], snapshot: LoadSnapshot) -> Optional[float]:
+    """Mean time spent queued by the requests vLLM scheduled since the previous scrape."""
+    if not snapshot.healthy:
+        return None
+    if snapshot.waiting == 0:
+        return 0.0
+    if (
+        previous is None
+        or previous.queue_time_count is None
+        or snapshot.queue_time_count is None
+        or snapshot.queue_time_count < previous.queue_time_count
+    ):
+        return None
+    scheduled = snapshot.queue_time_count - previous.queue_time_count
+    if scheduled == 0:
+        # Nothing left the queue, the wait is at least what it was
+        return previous.queue_wait
+    return (snapshot.queue_time_sum - previous.queue_time_sum) / scheduled
+
+
+async def scrape_all():
+    """Refresh the load snapshot of every known backend."""
+    for url in upstream.UPSTREAM_URLS:
+        upstream.get_backend(url)
+    known = list(upstream.backends.values())
+    snapshots = await asyncio.gather(*(scrape(backend) for backend in known))
+    for backend, snapshot in zip(known, snapshots):
+        previous = backend.load
+        if (
+            previous is not None
+            and previous.generation_tokens is not None
+            and snapshot.generation_tokens is not None
+            and snapshot.generation_tokens >= previous.generation_tokens
+        ):
+            elapsed = snapshot.scraped_at - previous.scraped_at
+            if elapsed > 0:
+                snapshot.generation_tps = (
+                    snapshot.generation_tokens - previous.generation_tokens
+                ) / elapsed
+        snapshot.queue_wait = _queue_wait(previous, snapshot)
+        if backend.load and backend.load.healthy != snapshot.healthy:
+            logger.info(
+                "Backend %s is now %s",
+                backend.base_url,
+                "healthy" if snapshot.healthy else "unhealthy",
+            )
+        # A replica that came up, or restarted between two scrapes (its
+        # token counter went back), starts with empty caches
+        restarted = (
+            previous is not None
+            and previous.generation_tokens is not None
+            and snapshot.generation_tokens is not None
+            and snapshot.generation_tokens < previous.generation_tokens
+        )
+        joined = snapshot.healthy and (previous is None or not previous.healthy or restarted)
+        backend.load = snapshot
+        # The /health poll doubles as the probe of an open breaker whose
+        # cooldown has passed, off the request path and once per replica
+        if backend.breaker.probe_due():
+            if snapshot.healthy:
+                backend.breaker.half_open()
+            else:
+                backend.breaker.record_failure()
+        if joined:
+            for hook in _ready_hooks:
+                try:
+                    hook(backend)
+                except Exception as e:                                                               # pylint: disable=broad-exception-caught
+                    logger.exception("Ready hook failed for %s: %s", backend.base_url, e)
+
+
+_scraper_task: Optional[asyncio.Task] = None
+
+
+async def _run():
+    while True:
+        try:
+            await scrape_all()
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            logger.exception("Backend scrape loop failed: %s", e)
+        await asyncio.sleep(SCRAPE_INTERVAL)
+
+
+def start():
+    """Start the background scraper."""
+    global _scraper_task                                                                             # pylint: disable=global-statement
+    if _scraper_task is None:
+        _scraper_task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _scraper_task                                                                             # pylint: disable=global-statement
+    if _scraper_task is not None:
+        _scraper_task.cancel()
+        try:
+            await _scraper_task
+        except asyncio.CancelledError:
+            pass
+        _scraper_task = None
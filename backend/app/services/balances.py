@@ -0,0 +1,320 @@
+import os
+import time
+import logging
+from collections import deque
+from decimal import Decimal
+
+from typing import Deque, Dict, List, Optional, Tuple
+
+import orjson
+from redis.asyncio import Redis
+from redis.exceptions import RedisError, ResponseError
+from dotenv import load_dotenv
+
+from backend.database import db, queries
+from backend.app.services.response_cache import BILLING_VERSION_KEY
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Tokens whose Redis balance changed since the last flush to Postgres
+BALANCE_DIRTY_KEY = "balance_dirty"
+# Tokens of the flush under way; left behind by a crash, it is replayed first
+BALANCE_SYNCING_KEY = "balance_syncing"
+# user_id -> when its balance last reached Postgres, for the ledger check
+BALANCE_CHECK_KEY = "balance_check"
+# Marks a payment as credited in Redis, so a retried webhook is a no-op
+CREDIT_KEY = "balance_credit:{payment_id}"
+CREDIT_KEY_TTL = 7 * 24 * 3600
+
+BALANCE_SYNC_INTERVAL = float(os.getenv("BALANCE_SYNC_INTERVAL", "2"))
+BALANCE_SYNC_BATCH = int(os.getenv("BALANCE_SYNC_BATCH", "1000"))
+BALANCE_LEDGER_INTERVAL = float(os.getenv("BALANCE_LEDGER_INTERVAL", "300"))
+# Accounts are checked once their balance has not moved for this long, so
+# usage logs and rollups have caught up with the spend
+BALANCE_LEDGER_SETTLE = float(os.getenv("BALANCE_LEDGER_SETTLE", "900"))
+BALANCE_LEDGER_BATCH = int(os.getenv("BALANCE_LEDGER_BATCH", "500"))
+BALANCE_LEDGER_TOLERANCE = Decimal(os.getenv("BALANCE_LEDGER_TOLERANCE", "0.01"))
+
+# Applies a balance change, marks the token dirty and bumps the balance's
+# version, atomically. A token without a balance is seeded from ARGV[3..5]
+# (the Postgres row) if given, and left alone otherwise. With KEYS[3], the
+# change is applied once per key.
+_ADJUST = """
+if redis.call('HEXISTS', KEYS[1], 'balance') == 0 then
+    if ARGV[3] == '' then
+        return false
+    end
+    redis.call('HSET', KEYS[1], 'balance', ARGV[3], 'version', ARGV[4], 'user_id', ARGV[5])
+end
+if KEYS[3] and not redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[6]) then
+    return {redis.call('HGET', KEYS[1], 'balance'), redis.call('HGET', KEYS[1], 'version') or '0', 0}
+end
+local balance = redis.call('HINCRBYFLOAT', KEYS[1], 'balance', ARGV[1])
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('SADD', KEYS[2], ARGV[2])
+return {balance, version, 1}
+"""
+
+
+def _load_prices() -> Dict[str, dict]:
+    raw = os.getenv("MODEL_PRICES")
+    path = os.getenv("MODEL_PRICES_FILE")
+    if raw:
+        return orjson.loads(raw)
+    if path:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    return {}
+
+
+# USD per million tokens by model name: {"<model>": {"prompt": 0.1, "completion": 0.2}}
+MODEL_PRICES: Dict[str, dict] = _load_prices()
+
+
+def price(model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int],
+          base_model: Optional[str] = None) -> Optional[float]:
+    """
+    What a request costs, in USD.
+
+    Args:
+        model (str): The model that served it (a LoRA adapter's name, for adapters).
+        prompt_tokens (int): Prompt tokens used.
+        completion_tokens (int): Completion tokens used.
+        base_model (str, optional): Priced instead when `model` has no price.
+
+    Returns:
+        Optional[float]: The cost, or None if the model is not priced (not charged).
+    """
+    rates = MODEL_PRICES.get(model) or (MODEL_PRICES.get(base_model) if base_model else None)
+    if not rates:
+        return None
+    return (
+        (prompt_tokens or 0) * float(rates.get("prompt", 0))
+        + (completion_tokens or 0) * float(rates.get("completion", 0))
+    ) / 1_000_000
+
+
+def _token_key(token: str) -> str:
+    return f"llm_api_token:{token}"
+
+
+async def _adjust(redis: Redis, token: str, delta: float,
+                  seed: Optional[Tuple[str, Decimal, int]] = None,
+                  payment_id: Optional[str] = None) -> Optional[Tuple[Decimal, int, bool]]:
+    """Run _ADJUST; returns (balance, version, applied), or None for an unknown token."""
+    keys = [_token_key(token), BALANCE_DIRTY_KEY]
+    if payment_id:
+        keys.append(CREDIT_KEY.format(payment_id=payment_id))
+    user_id, balance, version = seed or ("", "", 0)
+    result = await redis.eval(
+        _ADJUST, len(keys), *keys,
+        f"{delta:.10f}", token, str(balance), str(version), user_id, CREDIT_KEY_TTL,
+    )
+    if result is None:
+        return None
+    return Decimal(result[0]), int(result[1]), bool(result[2])
+
+
+async def debit(token: str, amount: float) -> Optional[Decimal]:
+    """
+    Charge `amount` to the token's balance in Redis; Postgres follows on
+    the next flush. Never raises: a failed debit is logged, and the
+    ledger check reports the account once it settles.
+
+    Returns:
+        Optional[Decimal]: The new balance, or None if nothing was charged.
+    """
+    if not amount:
+        return None
+    redis = db.redis_client
+    try:
+        if redis is None:
+            raise RedisError("Redis client not initialized")
+        result = await _adjust(redis, token, -amount)
+    except RedisError as e:
+        logger.error("Could not debit %.6f USD, Redis unavailable: %s", amount, e)
+        return None
+    if result is None:
+        # Token revoked or regenerated while the request ran
+        logger.warning("Could not debit %.6f USD, the token has no balance in Redis", amount)
+        return None
+    return result[0]
+
+
+async def credit(redis: Redis, token: str, amount: float, payment_id: str,
+                 seed: Tuple[str, Decimal, int]) -> Tuple[Decimal, int]:
+    """
+    Credit a payment to the token's balance in Redis, once per payment.
+
+    Args:
+        redis (Redis): Redis client.
+        token (str): The user's API token.
+        amount (float): Amount paid, in USD.
+        payment_id (str): Identifies the payment; a repeated id credits nothing.
+        seed (tuple): (user_id, balance, balance_version) from Postgres, used
+            if Redis has no balance for the token.
+
+    Returns:
+        Tuple[Decimal, int]: The balance and its version after the credit.
+    """
+    balance, version, _ = await _adjust(redis, token, amount, seed, payment_id)
+    return balance, version
+
+
+async def move(redis: Redis, old_token: str, new_token: str, seed: Tuple[str, Decimal, int]):
+    """
+    Carry a balance over to a regenerated token, unflushed changes included.
+    If Redis has no balance for the old token, it is seeded from `seed`,
+    the (user_id, balance, balance_version) row in Postgres.
+    """
+    try:
+        await redis.rename(_token_key(old_token), _token_key(new_token))
+    except ResponseError:
+        user_id, balance, version = seed
+        await redis.hset(
+            _token_key(new_token),
+            mapping={"user_id": user_id, "balance": str(balance), "version": version},
+        )
+    # A flush of the old token would find nothing to write
+    await redis.sadd(BALANCE_DIRTY_KEY, new_token)
+
+
+class BalanceSync:
+    """
+    Write-behind of Redis balances to users.balance.
+
+    Spend and payments change the balance in Redis, which `validate_token`
+    reads, and add the token to a dirty set. Every BALANCE_SYNC_INTERVAL
+    one gateway worker renames the dirty set to a processing set and
+    writes the current balances of its tokens to Postgres, a batch per
+    UPDATE. Tokens leave the processing set only after their batch has
+    committed, so a crash mid-flush is replayed on the next run. Each
+    balance carries a version, bumped with every change, and Postgres
+    only takes a snapshot newer than its own; replays and overlapping
+    flushes are therefore harmless.
+
+    Separately, accounts whose balance has settled are checked against the
+    ledger (opening balance + credits - spending in the logs).
+    """
+
+    def __init__(self):
+        self.flushes = 0
+        self.flushed = 0
+        self.stale = 0
+        self.checked = 0
+        self.mismatched = 0
+        self.mismatches: Deque[dict] = deque(maxlen=50)
+
+    async def sync(self):
+        """Flush changed balances to Postgres, replaying an interrupted flush first."""
+        redis = db.redis_client
+        if redis is None or db.psql_pool is None:
+            return
+        if not await redis.exists(BALANCE_SYNCING_KEY):
+            try:
+                await redis.rename(BALANCE_DIRTY_KEY, BALANCE_SYNCING_KEY)
+            except ResponseError:
+                return  # nothing changed since the last flush
+        while True:
+            tokens = await redis.srandmember(BALANCE_SYNCING_KEY, BALANCE_SYNC_BATCH)
+            if not tokens:
+                break
+            await self._flush(redis, tokens)
+        self.flushes += 1
+
+    async def _flush(self, redis: Redis, tokens: List[str]):
+        async with redis.pipeline(transaction=False) as pipe:
+            for token in tokens:
+                pipe.hmget(_token_key(token), "user_id", "balance", "version")
+            rows = await pipe.execute()
+
+        # user_id -> (balance, version); regenerated tokens may share a user
+        snapshot: Dict[str, Tuple[Decimal, int]] = {}
+        for user_id, balance, version in rows:
+            if not user_id or not balance:
+                continue  # token deleted since it was marked
+            version = int(version or 0)
+            if user_id not in snapshot or snapshot[user_id][1] < version:
+                snapshot[user_id] = (Decimal(balance), version)
+
+        if snapshot:
+            writer = await db.get_psql_writer()
+            updated = await writer.execute(
+                queries.BALANCE_SYNC,
+                (
+                    list(snapshot),
+                    [balance for balance, _ in snapshot.values()],
+                    [version for _, version in snapshot.values()],
+                ),
+            )
+            self.flushed += updated
+            self.stale += len(snapshot) - updated
+
+        now = time.time()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.srem(BALANCE_SYNCING_KEY, *tokens)
+            if snapshot:
+                pipe.zadd(BALANCE_CHECK_KEY, {user_id: now for user_id in snapshot})
+                # The billing view shows users.balance
+                for user_id in snapshot:
+                    pipe.incr(BILLING_VERSION_KEY.format(user_id=user_id))
+            await pipe.execute()
+
+    async def check_ledger(self):
+        """Compare settled balances in Postgres with what the ledger adds up to."""
+        redis = db.redis_client
+        if redis is None or db.psql_pool is None:
+            return
+        user_ids = await redis.zrangebyscore(
+            BALANCE_CHECK_KEY, "-inf", time.time() - BALANCE_LEDGER_SETTLE,
+            start=0, num=BALANCE_LEDGER_BATCH,
+        )
+        if not user_ids:
+            return
+        writer = await db.get_psql_writer()
+        rows = await writer.fetchall(queries.BALANCE_LEDGER, (user_ids,))
+        for user_id, balance, expected in rows:
+            self.checked += 1
+            if abs(balance - expected) <= BALANCE_LEDGER_TOLERANCE:
+                continue
+            self.mismatched += 1
+            self.mismatches.append(
+                {"user_id": user_id, "balance": float(balance), "ledger": float(expected),
+                 "checked_at": int(time.time())}
+            )
+            logger.warning(
+                "Balance of user %s is %s, the ledger says %s", user_id, balance, expected
+            )
+        # Checked again after their next change
+        await redis.zrem(BALANCE_CHECK_KEY, *user_ids)
+
+    async def stop(self):
+        """Flush on shutdown, so a deploy does not leave the last debits to another worker."""
+        try:
+            await self.sync()
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            logger.exception("Final balance flush failed: %s", e)
+
+    async def stats(self) -> dict:
+        redis = db.redis_client
+        pending = {}
+        if redis is not None:
+            pending = {
+                "dirty": await redis.scard(BALANCE_DIRTY_KEY),
+                "syncing": await redis.scard(BALANCE_SYNCING_KEY),
+                "awaiting_check": await redis.zcard(BALANCE_CHECK_KEY),
+            }
+        return {
+            **pending,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "stale": self.stale,
+            "checked": self.checked,
+            "mismatched": self.mismatched,
+            "recent_mismatches": list(self.mismatches),
+        }
+
+
+balance_sync = BalanceSync()
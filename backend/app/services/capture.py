@@ -0,0 +1,360 @@
+import os
+import re
+import glob
+import gzip
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import datetime as dt
+from collections import deque
+
+from typing import Any, Deque, List, Optional
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+from backend.app.services import upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Fraction of completion requests captured; 0 turns capture off
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "0"))
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "captures")
+# "redacted": prompts are kept with PII masked; "none": only their lengths
+CAPTURE_CONTENT = os.getenv("CAPTURE_CONTENT", "redacted")
+# A file is closed and a new one started past either limit (bytes before compression)
+CAPTURE_ROTATE_BYTES = int(os.getenv("CAPTURE_ROTATE_BYTES", str(64 * 1024 * 1024)))
+CAPTURE_ROTATE_SECONDS = float(os.getenv("CAPTURE_ROTATE_SECONDS", "3600"))
+# Closed files kept per directory, oldest deleted first
+CAPTURE_KEEP_FILES = int(os.getenv("CAPTURE_KEEP_FILES", "168"))
+CAPTURE_FLUSH_INTERVAL = float(os.getenv("CAPTURE_FLUSH_INTERVAL", "1"))
+# Traces waiting to be written; past that, new ones are dropped
+CAPTURE_QUEUE_MAX = int(os.getenv("CAPTURE_QUEUE_MAX", "10000"))
+# /tokenize calls in flight while counting the prompts of streamed traces
+CAPTURE_TOKENIZE_CONCURRENCY = int(os.getenv("CAPTURE_TOKENIZE_CONCURRENCY", "4"))
+# Keys user ids are pseudonymized with; a random one (per worker) if unset
+CAPTURE_SALT = os.getenv("CAPTURE_SALT") or os.urandom(16).hex()
+
+# Sampling parameters recorded as the client sent them
+SAMPLING_PARAMS = (
+    "top_p", "top_k", "min_p", "stop", "seed", "n",
+    "presence_penalty", "frequency_penalty", "repetition_penalty",
+)
+
+_REDACTIONS = [
+    (re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"), "<EMAIL>"),
+    (re.compile(r"\b(?:sk|pk|rk|ghp|gho|xox[abp])[-_][A-Za-z0-9_-]{16,}\b"), "<SECRET>"),
+    (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<UUID>"),
+    (re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}\b"), "<IP>"),
+    # Card, account and phone numbers: runs of 7+ digits, spaces and dashes allowed
+    (re.compile(r"(?<!\w)\+?\d(?:[ -]?\d){6,}(?!\w)"), "<NUMBER>"),
+]
+
+
+def redact(text: str) -> str:
+    """Mask e-mail addresses, secrets, ids, IP addresses and long numbers."""
+    for pattern, placeholder in _REDACTIONS:
+        text = pattern.sub(placeholder, text)
+    return text
+
+
+def _redact_content(content: Any) -> Any:
+    if isinstance(content, str):
+        return redact(content) if CAPTURE_CONTENT == "redacted" else len(content)
+    if isinstance(content, list):
+        # Multimodal parts: text is kept like plain content, anything else by type only
+        return [
+            {"type": "text", "text": _redact_content(part.get("text", ""))}
+            if isinstance(part, dict) and part.get("type") == "text"
+            else {"type": part.get("type") if isinstance(part, dict) else "unknown"}
+            for part in content
+        ]
+    return None
+
+
+def pseudonym(user_id: str) -> str:
+    return hashlib.blake2b(
+        str(user_id).encode(), key=CAPTURE_SALT.encode()[:64], digest_size=8
+    ).hexdigest()
+
+
+class Trace:
+    """
+    One captured request. Created by the endpoint when the request is
+    sampled, filled in by stream_kube_data, and queued for writing once
+    the response is over.
+    """
+
+    __slots__ = (
+        "arrived", "source", "user", "data", "model", "stream", "max_tokens", "temperature",
+        "prompt", "add_special_tokens", "urls", "started", "first_at", "completion_tokens",
+        "prompt_tokens", "status", "error", "finished_at",
+    )
+
+    def __init__(self, source: str, data: dict, user_id: str, arrived: float):
+        self.arrived = arrived
+        self.source = source
+        self.user = pseudonym(user_id)
+        self.data = data
+        self.model: Optional[str] = None
+        self.stream = False
+        self.max_tokens = None
+        self.temperature = None
+        self.prompt: Optional[str] = None
+        self.add_special_tokens = True
+        self.urls: List[str] = []
+        self.started = time.perf_counter()
+        self.first_at: Optional[float] = None
+        self.completion_tokens: Optional[int] = None
+        self.prompt_tokens: Optional[int] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+
+    def begin(self, request_data: dict, urls: List[str]):
+        """Record what is sent upstream: the served model and effective parameters."""
+        self.model = request_data["model"]
+        self.stream = str(request_data.get("stream")).lower() == "true"
+        self.max_tokens = request_data.get("max_tokens")
+        self.temperature = request_data.get("temperature")
+        self.prompt = request_data.get("prompt")
+        self.add_special_tokens = request_data.get("add_special_tokens", True)
+        self.urls = urls
+        self.started = time.perf_counter()
+
+    def chunk(self, chunk: bytes):
+        """Count the completion events of a raw SSE chunk, one per token."""
+        events = chunk.count(b"data: {")
+        if events and self.first_at is None:
+            self.first_at = time.perf_counter()
+        self.completion_tokens = (self.completion_tokens or 0) + events
+
+    def body(self, content: bytes):
+        try:
+            usage = orjson.loads(content).get("usage") or {}
+            self.prompt_tokens = usage.get("prompt_tokens")
+            self.completion_tokens = usage.get("completion_tokens")
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
+
+    def done(self, status: str = "ok", error: Optional[str] = None):
+        if self.finished_at is not None:
+            return
+        self.finished_at = time.perf_counter()
+        self.status = status
+        self.error = error[:300] if error else None
+        capture.queue_trace(self)
+
+    def to_dict(self) -> dict:
+        data = self.data
+        record = {
+            "ts": round(self.arrived, 3),
+            "source": self.source,
+            "user": self.user,
+            "model": self.model,
+            "requested_model": data.get("model"),
+            "stream": self.stream,
+            "params": {
+                "max_tokens": self.max_tokens,
+                "temperature": self.temperature,
+                **{key: data[key] for key in SAMPLING_PARAMS if key in data},
+            },
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "ttft_ms": round((self.first_at - self.started) * 1000, 1) if self.first_at else None,
+            "latency_ms": round((self.finished_at - self.started) * 1000, 1),
+            "status": self.status,
+        }
+        if self.error:
+            record["error"] = self.error
+        messages = data.get("messages")
+        if messages:
+            record["messages"] = [
+                {"role": message.get("role"), "content": _redact_content(message.get("content"))}
+                if isinstance(message, dict) else None
+                for message in messages
+            ]
+        else:
+            record["prompt"] = _redact_content(data.get("prompt") or "")
+        return record
+
+
+class TraceFile:
+    """
+    The gzip file traces are appended to. It is written as `*.jsonl.gz.part`
+    and renamed to `*.jsonl.gz` when rotated, so readers only ever see
+    complete files.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.file = None
+        self.path: Optional[str] = None
+        self.opened_at = 0.0
+        self.written = 0
+        self.sequence = 0
+
+    def write(self, lines: List[bytes]):
+        if self.file is not None and (
+            self.written >= CAPTURE_ROTATE_BYTES
+            or time.time() - self.opened_at >= CAPTURE_ROTATE_SECONDS
+        ):
+            self.close()
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            self.sequence += 1
+            self.path = os.path.join(
+                self.directory, f"capture-{stamp}-{os.getpid()}-{self.sequence:04d}.jsonl.gz.part"
+            )
+            self.file = gzip.open(self.path, "ab")                                                   # pylint: disable=consider-using-with
+            self.opened_at = time.time()
+            self.written = 0
+        payload = b"".join(line + b"\n" for line in lines)
+        self.file.write(payload)
+        self.file.flush()
+        self.written += len(payload)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        os.replace(self.path, self.path[: -len(".part")])
+        self.file = None
+        self.path = None
+        self._prune()
+
+    def _prune(self):
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")))
+        for path in files[: max(0, len(files) - CAPTURE_KEEP_FILES)]:
+            os.remove(path)
+
+
+class TrafficCapture:
+    """
+    Writes a sample of production completions as JSONL traces for replay.
+
+    Each trace holds when the request arrived, its sampling parameters,
+    whether it streamed, prompt and completion token counts and timings,
+    plus the prompt with PII masked (or only its length). User ids are
+    replaced by keyed hashes. Traces are queued in memory and written by a
+    background task into gzip files that rotate by size and age. Nothing
+    on the request path waits for the disk.
+    """
+
+    def __init__(self, directory: str = CAPTURE_DIR):
+        self.queue: Deque[Trace] = deque()
+        self.file = TraceFile(directory)
+        self.task: Optional[asyncio.Task] = None
+        self.captured = 0
+        self.dropped = 0
+
+    def sample(self, source: str, data: Any, user_id: str,
+               received: Optional[float] = None) -> Optional[Trace]:
+        """
+        Start a trace for a sampled request.
+
+        Args:
+            source (str): "http" or "websocket".
+            data (dict): The request body or WebSocket message.
+            user_id (str): The authenticated user, stored pseudonymized.
+            received (float, optional): time.monotonic() of arrival, if not now.
+
+        Returns:
+            Optional[Trace]: The trace, or None if the request is not captured.
+        """
+        if CAPTURE_SAMPLE_RATE <= 0 or not isinstance(data, dict):
+            return None
+        if random.random() >= CAPTURE_SAMPLE_RATE:
+            return None
+        arrived = time.time() - (time.monotonic() - received if received else 0)
+        return Trace(source, data, user_id, arrived)
+
+    def queue_trace(self, trace: Trace):
+        if len(self.queue) >= CAPTURE_QUEUE_MAX:
+            self.dropped += 1
+            return
+        self.queue.append(trace)
+
+    def start(self):
+        if CAPTURE_SAMPLE_RATE > 0 and self.task is None:
+            self.task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            await self.flush()
+            await asyncio.to_thread(self.file.close)
+
+    async def _count_prompt(self, trace: Trace, semaphore: asyncio.Semaphore):
+        """Streams report no usage; a replica's /tokenize counts the prompt instead."""
+        if not trace.prompt or not trace.urls:
+            return
+        async with semaphore:
+            # Spread over the least-loaded healthy replicas, like real traffic
+            backend = await upstream.pick_backend(trace.urls)
+            if backend is None:
+                return
+            await self._tokenize(trace, backend)
+
+    async def _tokenize(self, trace: Trace, backend: upstream.Backend):
+        try:
+            response = await upstream.get_client().post(
+                f"{backend.base_url}/tokenize",
+                content=orjson.dumps({
+                    "model": trace.model, "prompt": trace.prompt,
+                    "add_special_tokens": trace.add_special_tokens,
+                }),
+                headers={"Content-Type": "application/json"},
+                timeout=5.0,
+            )
+            if response.status_code == 200:
+                trace.prompt_tokens = orjson.loads(response.content).get("count")
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            logger.debug("Could not count prompt tokens of a captured request: %r", e)
+
+    async def flush(self):
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(500, len(self.queue)))]
+            semaphore = asyncio.Semaphore(CAPTURE_TOKENIZE_CONCURRENCY)
+            await asyncio.gather(*(
+                self._count_prompt(trace, semaphore)
+                for trace in batch if trace.prompt_tokens is None
+            ))
+            # Redaction and compression run off the event loop
+            await asyncio.to_thread(self._write, batch)
+            self.captured += len(batch)
+
+    def _write(self, batch: List[Trace]):
+        self.file.write([orjson.dumps(trace.to_dict()) for trace in batch])
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.exception("Writing captured traffic failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": CAPTURE_SAMPLE_RATE,
+            "content": CAPTURE_CONTENT,
+            "queued": len(self.queue),
+            "captured": self.captured,
+            "dropped": self.dropped,
+            "file": self.file.path,
+        }
+
+
+capture = TrafficCapture()
@@ -0,0 +1,277 @@
+import re
+import json
+import uuid
+
+from typing import Dict, List, Optional, Set, Tuple
+
+import orjson
+
+# Completion ids are reused with the chat prefix OpenAI clients expect
+_COMPLETION_ID_PREFIX = "cmpl-"
+_CHAT_ID_PREFIX = "chatcmpl-"
+
+# How each chat template (chat_template.TEMPLATES) asks the model to call tools:
+# Llama 3.1 answers with nothing but JSON objects, ChatML models may write
+# text first and then <tool_call> blocks
+_PYTHON_TAG = "<|python_tag|>"
+_TOOL_CALL_OPEN = "<tool_call>"
+_TOOL_CALL_BLOCK = re.compile(r"<tool_call>\s*(.*?)\s*</tool_call>", re.DOTALL)
+
+
+def _chat_id(completion_id: Optional[str]) -> Optional[str]:
+    if completion_id and completion_id.startswith(_COMPLETION_ID_PREFIX):
+        return _CHAT_ID_PREFIX + completion_id[len(_COMPLETION_ID_PREFIX):]
+    return completion_id
+
+
+def _json_objects(text: str) -> Optional[List[dict]]:
+    """JSON objects written one after another (Llama separates them by newlines or ';')."""
+    decoder = json.JSONDecoder()
+    objects, position = [], 0
+    while True:
+        while position < len(text) and text[position] in " \t\r\n;":
+            position += 1
+        if position == len(text):
+            return objects
+        try:
+            value, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(value, dict):
+            return None
+        objects.append(value)
+
+
+def parse_tool_calls(text: str, template: str) -> Tuple[Optional[str], List[dict]]:
+    """
+    Split generated text into its plain content and the OpenAI `tool_calls`
+    it makes, in the syntax `template` asks the model to use. Text that
+    does not parse as calls is all content.
+
+    Returns:
+        Tuple[Optional[str], List[dict]]: The content (None if there is only
+        calls) and the calls.
+    """
+    if template == "chatml":
+        start = text.find(_TOOL_CALL_OPEN)
+        if start == -1:
+            return text, []
+        blocks = _TOOL_CALL_BLOCK.findall(text, start)
+        if not blocks or _TOOL_CALL_BLOCK.sub("", text[start:]).strip():
+            return text, []
+        content = text[:start].strip() or None
+        raw_calls = _json_objects("\n".join(blocks))
+    else:
+        body = text.strip()
+        if body.startswith(_PYTHON_TAG):
+            body = body[len(_PYTHON_TAG):].lstrip()
+        if not body.startswith("{"):
+            return text, []
+        content = None
+        raw_calls = _json_objects(body)
+
+    calls = []
+    for raw in raw_calls or ():
+        name = raw.get("name")
+        arguments = raw.get("arguments", raw.get("parameters", {}))
+        if not isinstance(name, str):
+            return text, []
+        if not isinstance(arguments, str):
+            arguments = orjson.dumps(arguments).decode()
+        calls.append({
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": name, "arguments": arguments},
+        })
+    if not calls:
+        return text, []
+    return content, calls
+
+
+def completion_to_chat(body: bytes, tool_template: Optional[str] = None) -> bytes:
+    """
+    Turn a vLLM `text_completion` body into a `chat.completion` one.
+
+    Chat requests are rendered with the gateway's template and sent to the
+    completions endpoint, so the generated text comes back in
+    `choices[].text`; chat clients read `choices[].message.content`. A body
+    that is not a completion (an error) is returned unchanged. With
+    `tool_template`, the chat template of a request that offered tools,
+    calls in the text become `message.tool_calls`.
+    """
+    try:
+        completion = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return body
+    if not isinstance(completion, dict) or completion.get("object") != "text_completion":
+        return body
+
+    choices = []
+    for choice in completion.get("choices") or []:
+        text = choice.get("text") or ""
+        content, calls = parse_tool_calls(text, tool_template) if tool_template else (text, [])
+        message = {"role": "assistant", "content": content}
+        finish_reason = choice.get("finish_reason")
+        if calls:
+            message["tool_calls"] = calls
+            finish_reason = "tool_calls"
+        choices.append({
+            "index": choice.get("index", 0),
+            "message": message,
+            # Completion logprobs do not fit the chat shape
+            "logprobs": None,
+            "finish_reason": finish_reason,
+        })
+    chat = {
+        "id": _chat_id(completion.get("id")),
+        "object": "chat.completion",
+        "created": completion.get("created"),
+        "model": completion.get("model"),
+        "choices": choices,
+    }
+    if completion.get("usage") is not None:
+        chat["usage"] = completion["usage"]
+    return orjson.dumps(chat)
+
+
+class ChatStreamTranslator:
+    """
+    Rewrites a completions SSE stream into `chat.completion.chunk` events.
+
+    Upstream chunks are split wherever the network split them, so partial
+    events are held back until their blank-line terminator arrives. The
+    first delta of each choice carries the assistant role, as OpenAI's do.
+
+    With `tool_template`, text that may be the start of a tool call is held
+    back. Once it is one, the rest of the choice is collected and sent as a
+    single `tool_calls` delta when it finishes; text that turns out not to
+    be a call is sent as content after all.
+    """
+
+    def __init__(self, tool_template: Optional[str] = None):
+        self.tool_template = tool_template
+        self.buffer = b""
+        self.started: Set[int] = set()
+        # choice index -> text not sent yet, and whether it is a tool call
+        self.held: Dict[int, str] = {}
+        self.calling: Set[int] = set()
+        # Content-only choices of Llama, past the point a call could start
+        self.plain: Set[int] = set()
+        self.last: dict = {}
+
+    def feed(self, chunk: bytes) -> bytes:
+        """The complete events of `chunk` (plus what was held back), translated."""
+        self.buffer += chunk
+        end = self.buffer.rfind(b"\n\n")
+        if end == -1:
+            return b""
+        complete, self.buffer = self.buffer[: end + 2], self.buffer[end + 2:]
+        return b"".join(self._event(event) for event in complete.split(b"\n\n") if event)
+
+    def flush(self) -> bytes:
+        """Whatever is left when the upstream stream ends."""
+        rest, self.buffer = self.buffer, b""
+        out = self._event(rest.strip()) if rest.strip() else b""
+        return out + self._release()
+
+    def _split(self, index: int, text: str) -> Tuple[str, str]:
+        """(text to send now, text to hold back) of a choice not yet known to be a call."""
+        if index in self.plain:
+            return text, ""
+        if self.tool_template == "chatml":
+            start = text.find(_TOOL_CALL_OPEN)
+            if start != -1:
+                self.calling.add(index)
+                return text[:start], text[start:]
+            # Hold back a tail that may grow into the opening tag
+            for size in range(min(len(text), len(_TOOL_CALL_OPEN) - 1), 0, -1):
+                if _TOOL_CALL_OPEN.startswith(text[-size:]):
+                    return text[:-size], text[-size:]
+            return text, ""
+        stripped = text.lstrip()
+        if stripped.startswith(("{", _PYTHON_TAG)):
+            self.calling.add(index)
+            return "", text
+        if not stripped or _PYTHON_TAG.startswith(stripped):
+            return "", text
+        self.plain.add(index)
+        return text, ""
+
+    def _delta(self, index: int, text: str, finish_reason: Optional[str]) -> Optional[dict]:
+        """The chat delta of one completion choice, None if there is nothing to send yet."""
+        delta: dict = {}
+        if self.tool_template is None:
+            delta["content"] = text
+        else:
+            held = self.held.pop(index, "") + text
+            if index not in self.calling:
+                text, held = self._split(index, held)
+                if text:
+                    delta["content"] = text
+            if finish_reason is not None and index in self.calling:
+                content, calls = parse_tool_calls(held, self.tool_template)
+                if calls:
+                    delta["tool_calls"] = [{"index": i, **call} for i, call in enumerate(calls)]
+                    finish_reason = "tool_calls"
+                    held = content or ""
+                if held:
+                    delta["content"] = delta.get("content", "") + held
+            elif finish_reason is not None and held:
+                delta["content"] = delta.get("content", "") + held
+            elif held:
+                self.held[index] = held
+            if not delta and finish_reason is None:
+                return None
+
+        if index not in self.started:
+            self.started.add(index)
+            delta = {"role": "assistant", "content": None if "tool_calls" in delta else "", **delta}
+        return {"index": index, "delta": delta, "logprobs": None, "finish_reason": finish_reason}
+
+    def _chunk(self, choices: List[dict], usage: Optional[dict] = None) -> bytes:
+        chunk = {
+            "id": _chat_id(self.last.get("id")),
+            "object": "chat.completion.chunk",
+            "created": self.last.get("created"),
+            "model": self.last.get("model"),
+            "choices": choices,
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        return b"data: " + orjson.dumps(chunk) + b"\n\n"
+
+    def _release(self) -> bytes:
+        """Send text still held back, for a stream that ended without a finish reason."""
+        if not self.held:
+            return b""
+        choices = [
+            {"index": index, "delta": {"content": text}, "logprobs": None, "finish_reason": None}
+            for index, text in sorted(self.held.items())
+        ]
+        self.held.clear()
+        return self._chunk(choices)
+
+    def _event(self, event: bytes) -> bytes:
+        if event == b"data: [DONE]":
+            return self._release() + event + b"\n\n"
+        if not event.startswith(b"data: "):
+            return event + b"\n\n"
+        try:
+            completion = orjson.loads(event[6:])
+        except orjson.JSONDecodeError:
+            return event + b"\n\n"
+        if not isinstance(completion, dict) or completion.get("object") != "text_completion":
+            return event + b"\n\n"
+
+        self.last = completion
+        choices: List[dict] = []
+        for choice in completion.get("choices") or []:
+            delta = self._delta(
+                choice.get("index", 0), choice.get("text") or "", choice.get("finish_reason")
+            )
+            if delta is not None:
+                choices.append(delta)
+        usage = completion.get("usage")
+        if not choices and completion.get("choices") and usage is None:
+            return b""  # every choice is holding its text back
+        return self._chunk(choices, usage)
@@ -0,0 +1,289 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Template used when the requested model does not match any known prefix
+DEFAULT_TEMPLATE = os.getenv("CHAT_TEMPLATE_DEFAULT", "llama3")
+
+# Bounds for the rendered-prefix cache (entries and total characters held)
+PREFIX_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_PREFIX_CACHE_ENTRIES", "4096"))
+PREFIX_CACHE_MAX_CHARS = int(os.getenv("CHAT_PREFIX_CACHE_CHARS", str(64 * 1024 * 1024)))
+
+# Llama 3.1 stamps a date into the system header. It is pinned here so the
+# rendered prefix never changes from one day to the next, which would
+# invalidate every prefix cached upstream.
+LLAMA3_TODAY_DATE = "26 Jul 2024"
+
+VALID_ROLES = {"system", "developer", "user", "assistant", "tool", "ipython"}
+
+
+@dataclass
+class RenderedPrompt:
+    """
+    Result of rendering a `messages` list.
+
+    Attributes:
+        prompt (str): The full prompt, ending with the generation prompt.
+        prefix_hash (str): Hash of the system and tool prefix of the conversation.
+        prefix_len (int): Length in characters of the rendered system and tool prefix.
+    """
+    prompt: str
+    prefix_hash: str
+    prefix_len: int
+
+
+def _canonical(value: Any) -> str:
+    """Serialize a value the same way every time, whatever the client's key order."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def _content_text(content: Any) -> str:
+    """Flatten OpenAI content (a string or a list of parts) into plain text."""
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content.strip()
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                parts.append(str(part.get("text", "")))
+            elif isinstance(part, str):
+                parts.append(part)
+        return "".join(parts).strip()
+    raise ValueError("Message content must be a string or a list of text parts")
+
+
+# --- Llama 3.1 ---
+def _llama3_header(role: str) -> str:
+    return f"<|start_header_id|>{role}<|end_header_id|>\n\n"
+
+
+def _llama3_prefix(system: str, tools: List[dict]) -> str:
+    out = "<|begin_of_text|>" + _llama3_header("system")
+    if tools:
+        out += "Environment: ipython\n"
+    out += f"Cutting Knowledge Date: December 2023\nToday Date: {LLAMA3_TODAY_DATE}\n\n"
+    if tools:
+        out += (
+            "You have access to the following functions. To call a function, please "
+            "respond with JSON for a function call. Respond in the format "
+            '{"name": function name, "parameters": dictionary of argument name and '
+            'its value}. Do not use variables.\n\n'
+        )
+        for tool in tools:
+            out += json.dumps(tool, indent=4, sort_keys=True, ensure_ascii=False) + "\n\n"
+    return out + system + "<|eot_id|>"
+
+
+def _llama3_message(message: dict) -> str:
+    role = message["role"]
+    if role == "assistant" and message.get("tool_calls"):
+        calls = []
+        for call in message["tool_calls"]:
+            function = call.get("function", call)
+            arguments = function.get("arguments", {})
+            if isinstance(arguments, str):
+                arguments = json.loads(arguments or "{}")
+            calls.append(
+                json.dumps(
+                    {"name": function.get("name"), "parameters": arguments},
+                    sort_keys=True,
+                    ensure_ascii=False,
+                )
+            )
+        return _llama3_header("assistant") + "\n".join(calls) + "<|eot_id|>"
+    if role in ("tool", "ipython"):
+        role = "ipython"
+    return _llama3_header(role) + _content_text(message.get("content")) + "<|eot_id|>"
+
+
+def _llama3_generation() -> str:
+    return _llama3_header("assistant")
+
+
+# --- ChatML (Qwen and friends) ---
+def _chatml_prefix(system: str, tools: List[dict]) -> str:
+    if tools:
+        system += "\n\n# Tools\n\n<tools>\n"
+        system += "\n".join(_canonical(tool) for tool in tools)
+        system += "\n</tools>"
+    if not system:
+        return ""
+    return f"<|im_start|>system\n{system}<|im_end|>\n"
+
+
+def _chatml_message(message: dict) -> str:
+    role = "tool" if message["role"] in ("tool", "ipython") else message["role"]
+    if role == "assistant" and message.get("tool_calls"):
+        body = "\n".join(
+            f"<tool_call>\n{_canonical(call.get('function', call))}\n</tool_call>"
+            for call in message["tool_calls"]
+        )
+    else:
+        body = _content_text(message.get("content"))
+    return f"<|im_start|>{role}\n{body}<|im_end|>\n"
+
+
+def _chatml_generation() -> str:
+    return "<|im_start|>assistant\n"
+
+
+# name -> (prefix renderer, message renderer, generation prompt)
+TEMPLATES: Dict[str, Tuple[Callable, Callable, Callable]] = {
+    "llama3": (_llama3_prefix, _llama3_message, _llama3_generation),
+    "chatml": (_chatml_prefix, _chatml_message, _chatml_generation),
+}
+
+# Model name prefix -> template name, first match wins
+MODEL_TEMPLATES: List[Tuple[str, str]] = [
+    ("meta-llama/Llama-3", "llama3"),
+    ("meta-llama/Meta-Llama-3", "llama3"),
+    ("Qwen/", "chatml"),
+]
+
+
+def template_for(model: str) -> str:
+    """Return the name of the chat template used for `model`."""
+    for prefix, name in MODEL_TEMPLATES:
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_TEMPLATE
+
+
+class PrefixCache:
+    """
+    LRU cache of rendered conversation prefixes keyed by a chained hash.
+
+    Every message extends the hash of the conversation before it, so turn N
+    of a conversation finds the prefix rendered on turn N-1 and only renders
+    the messages appended since.
+    """
+
+    def __init__(self, max_entries: int, max_chars: int):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.entries: "OrderedDict[str, str]" = OrderedDict()
+        self.total_chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        rendered = self.entries.get(key)
+        if rendered is not None:
+            self.entries.move_to_end(key)
+        return rendered
+
+    def put(self, key: str, rendered: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        if len(rendered) > self.max_chars:
+            return
+        self.entries[key] = rendered
+        self.total_chars += len(rendered)
+        while len(self.entries) > self.max_entries or self.total_chars > self.max_chars:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_chars -= len(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_chars = 0
+
+
+prefix_cache = PrefixCache(PREFIX_CACHE_MAX_ENTRIES, PREFIX_CACHE_MAX_CHARS)
+
+
+def _chain(previous: str, value: str) -> str:
+    return hashlib.sha256(f"{previous}\x00{value}".encode("utf-8")).hexdigest()
+
+
+def _validate(messages: Any) -> List[dict]:
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages must be a non-empty list")
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in VALID_ROLES:
+            raise ValueError("Each message must be an object with a valid role")
+    return messages
+
+
+def _validate_tools(tools: Any) -> List[dict]:
+    if tools is None:
+        return []
+    if not isinstance(tools, list) or not all(isinstance(tool, dict) for tool in tools):
+        raise ValueError("tools must be a list of objects")
+    return tools
+
+
+def render_messages(
+    model: str, messages: Any, tools: Optional[List[dict]] = None
+) -> RenderedPrompt:
+    """
+    Render OpenAI-style `messages` into the raw prompt for `model`.
+
+    Leading system messages and the tool definitions form the conversation
+    prefix; it is rendered once and memoized, as is the rendered history
+    after each turn. The output for a given prefix is byte-for-byte stable,
+    so vLLM's automatic prefix caching hits on repeat traffic.
+
+    Args:
+        model (str): The model the prompt is rendered for.
+        messages (list): The chat messages.
+        tools (list, optional): OpenAI tool definitions.
+
+    Returns:
+        RenderedPrompt: The prompt and the hash of its system/tool prefix.
+
+    Raises:
+        ValueError: If the messages or tools are malformed.
+    """
+    messages = _validate(messages)
+    tools = _validate_tools(tools)
+    template = template_for(model)
+    render_prefix, render_message, render_generation = TEMPLATES[template]
+
+    # Split leading system messages from the conversation turns
+    split = 0
+    while split < len(messages) and messages[split]["role"] in ("system", "developer"):
+        split += 1
+    system = "\n\n".join(_content_text(m.get("content")) for m in messages[:split])
+    turns = messages[split:]
+
+    prefix_hash = _chain(template, _canonical({"system": system, "tools": tools}))
+    prefix = prefix_cache.get(prefix_hash)
+    if prefix is None:
+        prefix_cache.misses += 1
+        prefix = render_prefix(system, tools)
+        prefix_cache.put(prefix_hash, prefix)
+    else:
+        prefix_cache.hits += 1
+
+    # Chain a hash over every turn, then resume from the longest cached one
+    chain = [prefix_hash]
+    for turn in turns:
+        chain.append(_chain(chain[-1], _canonical(turn)))
+
+    start, rendered = 0, prefix
+    for index in range(len(chain) - 1, 0, -1):
+        cached = prefix_cache.get(chain[index])
+        if cached is not None:
+            start, rendered = index, cached
+            break
+
+    if start < len(turns):
+        rendered += "".join(render_message(turn) for turn in turns[start:])
+        prefix_cache.put(chain[-1], rendered)
+
+    return RenderedPrompt(
+        prompt=rendered + render_generation(),
+        prefix_hash=prefix_hash,
+        prefix_len=len(prefix),
+    )
@@ -0,0 +1,117 @@
+import os
+import asyncio
+from dataclasses import dataclass
+
+from typing import AsyncIterator, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    """
+    When buffered stream output is sent on.
+
+    Attributes:
+        window (float): Seconds to keep collecting after the first buffered
+            chunk. 0 sends every chunk as it arrives.
+        max_bytes (int): Send early once this much is buffered.
+    """
+    window: float = 0.015
+    max_bytes: int = 4096
+
+
+DEFAULT_POLICY = FlushPolicy(
+    window=float(os.getenv("STREAM_COALESCE_WINDOW_MS", "15")) / 1000,
+    max_bytes=int(os.getenv("STREAM_COALESCE_MAX_BYTES", "4096")),
+)
+
+_END = object()
+
+
+async def coalesce(
+    chunks: AsyncIterator[bytes], policy: Optional[FlushPolicy] = None
+) -> AsyncIterator[bytes]:
+    """
+    Merge the chunks of an upstream stream into fewer, larger ones.
+
+    A producer task keeps reading upstream into a queue while the consumer
+    holds each batch open for at most `policy.window` after its first chunk,
+    or until `policy.max_bytes` are buffered. The first chunk of a batch is
+    never delayed by an idle upstream, only by the window. Chunks are only
+    concatenated, so SSE events and their order are preserved.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The upstream stream.
+        policy (FlushPolicy, optional): Defaults to the STREAM_COALESCE_* settings.
+
+    Yields:
+        bytes: Coalesced chunks.
+    """
+    policy = policy or DEFAULT_POLICY
+    if policy.window <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+    # Set on every put; waiting on it (unlike on queue.get) can time out without losing an item
+    ready = asyncio.Event()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+                ready.set()
+            queue.put_nowait(_END)
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            queue.put_nowait(e)
+        ready.set()
+
+    producer = asyncio.create_task(produce())
+    loop = asyncio.get_running_loop()
+    try:
+        finished = False
+        while not finished:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            buffered = [item]
+            size = len(item)
+            deadline = loop.time() + policy.window
+            error = None
+            while size < policy.max_bytes:
+                if queue.empty():
+                    ready.clear()
+                    try:
+                        await asyncio.wait_for(ready.wait(), timeout=deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                item = queue.get_nowait()
+                if item is _END:
+                    finished = True
+                    break
+                if isinstance(item, Exception):
+                    error = item
+                    break
+                buffered.append(item)
+                size += len(item)
+
+            # What was buffered before an upstream error still goes out
+            yield b"".join(buffered)
+            if error is not None:
+                raise error
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import logging
+
+from typing import Dict, List, Optional
+
+import orjson
+from fastapi import WebSocket
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Every worker listens here for messages meant for all sockets
+BROADCAST_CHANNEL = "ws:broadcast"
+
+# Backoff between attempts to re-establish the backplane subscription
+RECONNECT_DELAY = 1.0
+
+
+def channel_for(identifier: str) -> str:
+    """Redis channel for an identifier. Hashed so API tokens never show up in PUBSUB CHANNELS."""
+    return "ws:" + hashlib.sha256(identifier.encode("utf-8")).hexdigest()[:32]
+
+
+def send_lock(websocket: WebSocket) -> asyncio.Lock:
+    """
+    The lock serializing writes to a socket. Multiplexed requests and the
+    backplane listener all write to the same sockets concurrently.
+    """
+    lock = getattr(websocket.state, "send_lock", None)
+    if lock is None:
+        lock = websocket.state.send_lock = asyncio.Lock()
+    return lock
+
+
+class ConnectionManager:
+    """
+    Tracks the WebSocket connections held by this worker and delivers
+    messages to them through a Redis pub/sub backplane.
+
+    `send_to` and `broadcast` publish to Redis; each worker subscribes only
+    to the channels of identifiers it holds sockets for (plus the broadcast
+    channel) and writes to its own sockets. Without a backplane (Redis down
+    or not started) messages are delivered to local sockets only.
+    """
+
+    def __init__(self):
+        # A dictionary to map api_tokens to a list of WebSocket connections
+        self.active_connections: Dict[str, List[WebSocket]] = {}
+        # channel -> identifier, for the identifiers held on this worker
+        self.channels: Dict[str, str] = {}
+        self.redis: Optional[Redis] = None
+        self.pubsub: Optional[PubSub] = None
+        self.listener_task: Optional[asyncio.Task] = None
+
+    async def start(self, redis: Redis):
+        """Attach the backplane and start delivering published messages."""
+        self.redis = redis
+        self.listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """Stop the backplane listener and release its connection."""
+        if self.listener_task:
+            self.listener_task.cancel()
+            try:
+                await self.listener_task
+            except asyncio.CancelledError:
+                pass
+            self.listener_task = None
+        await self._close_pubsub()
+        self.redis = None
+
+    async def connect(self, identifier: str, websocket: WebSocket):
+        """Add a new WebSocket connection for a given identifier."""
+        await websocket.accept()
+        if identifier not in self.active_connections:
+            self.active_connections[identifier] = []
+            channel = channel_for(identifier)
+            self.channels[channel] = identifier
+            await self._subscribe(channel)
+        self.active_connections[identifier].append(websocket)
+        print(f"New WebSocket connection for {identifier}")  # Debugging log
+
+    async def disconnect(self, identifier: str, websocket: WebSocket):
+        """Remove a specific WebSocket connection for an identifier."""
+        if identifier in self.active_connections:
+            if websocket in self.active_connections[identifier]:
+                self.active_connections[identifier].remove(websocket)
+
+            # Remove identifier and its subscription if no connections remain
+            if not self.active_connections[identifier]:
+                del self.active_connections[identifier]
+                channel = channel_for(identifier)
+                self.channels.pop(channel, None)
+                await self._unsubscribe(channel)
+            print(f"Disconnected WebSocket for {identifier}")  # Debugging log
+
+    async def close_all(self, code: int, reason: str):
+        """Close every socket held by this worker; their handlers clean up on disconnect."""
+        sockets = [ws for connections in self.active_connections.values() for ws in connections]
+        for websocket in sockets:
+            try:
+                async with send_lock(websocket):
+                    await websocket.close(code=code, reason=reason)
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.debug("Closing a WebSocket failed: %s", e)
+
+    async def send_to(self, identifier: str, message: dict):
+        """Send a message to all WebSocket connections for an identifier, on any worker."""
+        if await self._publish(channel_for(identifier), identifier, message):
+            return
+        await self.deliver_local(identifier, message)
+
+    async def broadcast(self, message: dict):
+        """Send a message to all active WebSocket connections, on every worker."""
+        if await self._publish(BROADCAST_CHANNEL, None, message):
+            return
+        for identifier in list(self.active_connections):
+            await self.deliver_local(identifier, message)
+
+    async def deliver_local(self, identifier: str, message: dict):
+        """Write a message to the sockets this worker holds for an identifier."""
+        for websocket in list(self.active_connections.get(identifier, [])):
+            try:
+                async with send_lock(websocket):
+                    await websocket.send_json(message)
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.warning("Failed to deliver message to a socket for %s: %s", identifier, e)
+
+    # --- Backplane internals ---
+    async def _publish(self, channel: str, identifier: Optional[str], message: dict) -> bool:
+        if self.redis is None or self.pubsub is None:
+            return False
+        try:
+            await self.redis.publish(channel, orjson.dumps(message))
+            return True
+        except RedisError as e:
+            logger.warning("Backplane publish to %s failed, delivering locally: %s", identifier, e)
+            return False
+
+    async def _subscribe(self, channel: str):
+        if self.pubsub is None:
+            return  # picked up when the listener (re)subscribes
+        try:
+            await self.pubsub.subscribe(channel)
+        except RedisError as e:
+            logger.warning("Backplane subscribe to %s failed: %s", channel, e)
+
+    async def _unsubscribe(self, channel: str):
+        if self.pubsub is None:
+            return
+        try:
+            await self.pubsub.unsubscribe(channel)
+        except RedisError as e:
+            logger.warning("Backplane unsubscribe from %s failed: %s", channel, e)
+
+    async def _close_pubsub(self):
+        if self.pubsub is not None:
+            pubsub, self.pubsub = self.pubsub, None
+            close = getattr(pubsub, "aclose", None) or pubsub.reset
+            try:
+                await close()
+            except RedisError:
+                pass
+
+    async def _listen(self):
+        """Deliver published messages to local sockets, resubscribing after Redis failures."""
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                self.pubsub = pubsub
+                await pubsub.subscribe(BROADCAST_CHANNEL, *self.channels)
+                logger.info("WebSocket backplane subscribed (%d identifiers)", len(self.channels))
+
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None or message.get("type") != "message":
+                        continue
+                    payload = orjson.loads(message["data"])
+                    channel = message["channel"]
+                    if channel == BROADCAST_CHANNEL:
+                        for identifier in list(self.active_connections):
+                            await self.deliver_local(identifier, payload)
+                    elif channel in self.channels:
+                        await self.deliver_local(self.channels[channel], payload)
+
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.warning("WebSocket backplane listener failed, retrying: %s", e)
+                await self._close_pubsub()
+                await asyncio.sleep(RECONNECT_DELAY)
+
+
+manager = ConnectionManager()
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+
+from typing import Any, Awaitable, Optional, TypeVar
+
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Header carrying the client's timeout in seconds, like the "timeout" body field
+TIMEOUT_HEADER = "X-Request-Timeout"
+# Applied when the client sends no timeout; 0 means no deadline
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("DEFAULT_REQUEST_TIMEOUT", "0"))
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT", "3600"))
+# A timeout firing this close to the deadline is blamed on the deadline
+DEADLINE_SLACK = 0.05
+
+
+class DeadlineExceeded(HTTPException):
+    """The client's deadline passed, or cannot be met, before the request finished."""
+
+    def __init__(self, stage: str):
+        super().__init__(status_code=504, detail=f"Request deadline exceeded {stage}")
+
+
+def deadline_from(received: float, *timeouts: Any) -> Optional[float]:
+    """
+    Absolute deadline (on the time.monotonic() clock) of a request.
+
+    Args:
+        received (float): When the request arrived, from time.monotonic().
+        *timeouts: Timeouts in seconds from the header and/or body; None
+            entries are ignored and the smallest of the rest wins.
+
+    Returns:
+        Optional[float]: The deadline, or None if the request has none.
+
+    Raises:
+        ValueError: If a timeout is not a positive number.
+    """
+    given = []
+    for timeout in timeouts:
+        if timeout is None or timeout == "":
+            continue
+        try:
+            seconds = float(timeout)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid timeout: {timeout!r}") from None
+        if not seconds > 0:
+            raise ValueError("Timeout must be a positive number of seconds")
+        given.append(seconds)
+    if given:
+        return received + min(min(given), MAX_REQUEST_TIMEOUT)
+    if DEFAULT_REQUEST_TIMEOUT > 0:
+        return received + DEFAULT_REQUEST_TIMEOUT
+    return None
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until the deadline (negative once passed), None without one."""
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and deadline - time.monotonic() <= DEADLINE_SLACK
+
+
+def check(deadline: Optional[float], stage: str):
+    """Shed the request if its deadline has (all but) passed."""
+    if expired(deadline):
+        raise DeadlineExceeded(stage)
+
+
+def cap(deadline: Optional[float], seconds: float) -> float:
+    """`seconds`, shortened to what is left of the deadline."""
+    left = remaining(deadline)
+    if left is None:
+        return seconds
+    return max(0.001, min(seconds, left))
+
+
+async def wait_for(awaitable: Awaitable[T], deadline: Optional[float], stage: str) -> T:
+    """Await with the deadline as timeout, cancelling the awaitable once it passes."""
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=max(0.0, remaining(deadline)))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(stage) from None
@@ -0,0 +1,186 @@
+import os
+import time
+import signal
+import asyncio
+import logging
+import contextlib
+
+from typing import Iterator, Optional
+
+import orjson
+from dotenv import load_dotenv
+
+from backend.app.services import readiness
+from backend.app.services.connections import manager
+from backend.app.services.usage_emitter import emitter
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How long in-flight streams and generations may run on once draining starts;
+# keep it below the pod's terminationGracePeriodSeconds
+DRAIN_GRACE_PERIOD = float(os.getenv("DRAIN_GRACE_PERIOD", "25"))
+# Still served while draining: probes, and the admin API to watch the drain
+DRAIN_EXEMPT_PREFIXES = ("/livez", "/readyz", "/admin")
+# WebSocket close code "Service Restart": clients should reconnect elsewhere
+WS_CLOSE_SERVICE_RESTART = 1012
+
+
+class Drainer:
+    """
+    Takes the worker out of rotation without cutting off running work.
+
+    Draining flips readiness to false and turns away new requests and
+    sockets. In-flight HTTP requests (streams included) and WebSocket
+    generations may then finish, for up to DRAIN_GRACE_PERIOD. After
+    that the remaining sockets are closed with 1012 and queued usage
+    records are flushed. Connection pools are left to the shutdown that
+    follows.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.inflight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.rejected = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        """Count a block as in-flight work that a drain waits for."""
+        self.inflight += 1
+        self.idle.clear()
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            if self.inflight == 0:
+                self.idle.set()
+
+    def start(self) -> asyncio.Task:
+        """Start draining (once); returns the task that completes when drained."""
+        if self.task is None:
+            self.draining = True
+            readiness.state.draining = True
+            self.started_at = time.monotonic()
+            self.task = asyncio.create_task(self._drain())
+        return self.task
+
+    async def drain(self):
+        """Drain, or wait for the drain already under way."""
+        await asyncio.shield(self.start())
+
+    def resume(self):
+        """Take traffic again, e.g. after an admin drain that is no longer wanted."""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.draining = False
+        readiness.state.draining = False
+        self.started_at = self.finished_at = None
+
+    async def _drain(self):
+        logger.warning("Draining, %d requests in flight", self.inflight)
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=DRAIN_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Drain grace period over, %d requests still in flight", self.inflight
+            )
+        await manager.close_all(WS_CLOSE_SERVICE_RESTART, "Server restarting")
+        await emitter.flush()
+        self.finished_at = time.monotonic()
+        logger.warning("Drained in %.1fs", self.finished_at - self.started_at)
+
+    def install_signal_handler(self):
+        """
+        Drain on SIGTERM, then hand the signal to the handler that was
+        installed before (uvicorn's), which shuts the server down. A second
+        SIGTERM skips the rest of the drain. Call from the main thread.
+        """
+        previous = signal.getsignal(signal.SIGTERM)
+        loop = asyncio.get_running_loop()
+
+        def chain(signum, frame):
+            signal.signal(signal.SIGTERM, previous)
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.raise_signal(signum)
+
+        async def drain_then_exit(signum, frame):
+            await self.drain()
+            chain(signum, frame)
+
+        def on_sigterm(signum, frame):
+            if self.draining:
+                chain(signum, frame)
+                return
+            loop.call_soon_threadsafe(
+                lambda: loop.create_task(drain_then_exit(signum, frame))
+            )
+
+        try:
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            logger.warning("Not on the main thread, SIGTERM will not drain")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "draining": self.draining,
+            "drained": self.finished_at is not None,
+            "inflight": self.inflight,
+            "rejected": self.rejected,
+            "draining_for": round(now - self.started_at, 1) if self.started_at else None,
+            "grace_period": DRAIN_GRACE_PERIOD,
+        }
+
+
+drainer = Drainer()
+
+
+class DrainMiddleware:
+    """
+    Counts in-flight requests for the drainer and, while draining, turns
+    new ones away: HTTP with 503 and "Connection: close", WebSocket
+    handshakes by closing them before they are accepted.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or scope["path"].startswith(DRAIN_EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        if drainer.draining:
+            drainer.rejected += 1
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": WS_CLOSE_SERVICE_RESTART})
+                return
+            body = orjson.dumps({"detail": "Server is shutting down, retry on another instance"})
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"1"),
+                    (b"connection", b"close"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        if scope["type"] == "websocket":
+            # Sockets are closed at the end of a drain; their generations are tracked instead
+            await self.app(scope, receive, send)
+            return
+        with drainer.track():
+            await self.app(scope, receive, send)
@@ -0,0 +1,257 @@
+import os
+import sys
+import base64
+import asyncio
+import hashlib
+import logging
+from array import array
+from collections import OrderedDict
+
+from typing import Dict, List, Optional, Set, Tuple
+
+import orjson
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+from backend.app.services import deadlines, tracing, upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Embedding endpoints of the vLLM replicas serving embedding models, comma separated
+EMBEDDING_URLS: List[str] = [
+    url.strip() for url in os.getenv("EMBEDDING_URLS", "").split(",") if url.strip()
+]
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-m3")
+# Inputs of concurrent requests are collected this long into one upstream call...
+EMBEDDING_BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000
+# ...unless a batch reaches either of these first
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "128"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "200000"))
+# Vector cache size per worker, counting the float32 payloads
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Inputs one request may carry, as in the OpenAI API
+EMBEDDING_MAX_INPUTS = 2048
+
+# Bookkeeping per cache entry (key, tuple, OrderedDict node), on top of the vector
+_ENTRY_OVERHEAD = 120
+
+# (model, dimensions): inputs with the same group can share an upstream call
+Group = Tuple[str, Optional[int]]
+# (prompt tokens, little-endian float32 vector)
+Embedding = Tuple[int, bytes]
+
+
+def cache_key(model: str, dimensions: Optional[int], text: str) -> bytes:
+    return hashlib.blake2b(
+        f"{model}\0{dimensions or ''}\0{text}".encode("utf-8"), digest_size=16
+    ).digest()
+
+
+def pack(vector: List[float]) -> bytes:
+    """float32, little endian: the layout OpenAI's base64 encoding uses."""
+    packed = array("f", vector)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(packed: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(packed)
+    if sys.byteorder != "little":
+        vector.byteswap()
+    return vector.tolist()
+
+
+def encode(packed: bytes, encoding_format: str):
+    """A vector as the API returns it: a list of floats, or base64 of the float32 bytes."""
+    if encoding_format == "base64":
+        return base64.b64encode(packed).decode("ascii")
+    return unpack(packed)
+
+
+def apportion(total: int, weights: List[int]) -> List[int]:
+    """
+    Split `total` in proportion to `weights` into whole numbers that add up
+    to it: every share is rounded down, and the units left over go to the
+    largest remainders. Zero weights all round share equally.
+    """
+    if not weights:
+        return []
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights, weight_sum = [1] * len(weights), len(weights)
+    shares = [total * weight // weight_sum for weight in weights]
+    by_remainder = sorted(
+        range(len(weights)), key=lambda i: total * weights[i] % weight_sum, reverse=True
+    )
+    for i in by_remainder[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+class VectorCache:
+    """LRU cache of embeddings by content hash, bounded by bytes held."""
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[bytes, Embedding]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[Embedding]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: bytes, entry: Embedding):
+        cost = len(entry[1]) + _ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous[1]) + _ENTRY_OVERHEAD
+        self.entries[key] = entry
+        self.size += cost
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted[1]) + _ENTRY_OVERHEAD
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+class EmbeddingBatcher:
+    """
+    Serves embedding inputs from the cache, or in shared upstream batches.
+
+    Cache misses of concurrent requests are queued per model and sent
+    together once the batch window closes or the batch is full. An input
+    already cached, or already on its way upstream for another request,
+    is never sent again; within a batch every input is unique.
+    """
+
+    def __init__(self, cache: VectorCache):
+        self.cache = cache
+        self.queues: Dict[Group, List[Tuple[bytes, str]]] = {}
+        self.queued_chars: Dict[Group, int] = {}
+        self.timers: Dict[Group, asyncio.TimerHandle] = {}
+        # Inputs on their way upstream, shared by every request that wants them
+        self.pending: Dict[bytes, asyncio.Future] = {}
+        self.batches: Set[asyncio.Task] = set()
+        self.upstream_calls = 0
+        self.upstream_inputs = 0
+
+    async def embed(self, model: str, inputs: List[str], dimensions: Optional[int] = None,
+                    deadline: Optional[float] = None) -> List[Embedding]:
+        """
+        Embeddings of `inputs`, in order.
+
+        Raises:
+            HTTPException: The upstream error of a failed batch, or 504 if the
+                deadline passes first.
+        """
+        loop = asyncio.get_running_loop()
+        group = (model, dimensions)
+        keys = [cache_key(model, dimensions, text) for text in inputs]
+        found: Dict[bytes, Embedding] = {}
+        waiting: Dict[bytes, asyncio.Future] = {}
+        for key, text in zip(keys, inputs):
+            if key in found or key in waiting:
+                continue
+            entry = self.cache.get(key)
+            if entry is not None:
+                found[key] = entry
+                continue
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = loop.create_future()
+                self._enqueue(group, key, text)
+            waiting[key] = future
+
+        if waiting:
+            # Shielded: other requests may be waiting on the same inputs
+            results = await deadlines.wait_for(
+                asyncio.gather(*(asyncio.shield(future) for future in waiting.values())),
+                deadline, "waiting for embeddings",
+            )
+            found.update(zip(waiting, results))
+        return [found[key] for key in keys]
+
+    def _enqueue(self, group: Group, key: bytes, text: str):
+        queue = self.queues.setdefault(group, [])
+        queue.append((key, text))
+        self.queued_chars[group] = self.queued_chars.get(group, 0) + len(text)
+        if (len(queue) >= EMBEDDING_BATCH_MAX_INPUTS
+                or self.queued_chars[group] >= EMBEDDING_BATCH_MAX_CHARS):
+            self._flush(group)
+        elif group not in self.timers:
+            self.timers[group] = asyncio.get_running_loop().call_later(
+                EMBEDDING_BATCH_WINDOW, self._flush, group
+            )
+
+    def _flush(self, group: Group):
+        timer = self.timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.queues.pop(group, [])
+        self.queued_chars.pop(group, None)
+        if items:
+            task = asyncio.create_task(self._run_batch(group, items))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def _run_batch(self, group: Group, items: List[Tuple[bytes, str]]):
+        model, dimensions = group
+        payload = {"model": model, "input": [text for _, text in items]}
+        if dimensions:
+            payload["dimensions"] = dimensions
+        self.upstream_calls += 1
+        self.upstream_inputs += len(items)
+        try:
+            with tracing.span("embeddings.batch", **{"llm.model": model, "batch.inputs": len(items)}):
+                _, response = await upstream.post(payload, EMBEDDING_URLS)
+                body = orjson.loads(response.content)
+            rows = sorted(body["data"], key=lambda row: row["index"])
+            if len(rows) != len(items):
+                raise HTTPException(status_code=502, detail="Upstream returned a wrong number of embeddings")
+            # Usage comes per batch; split it by input length for metering.
+            # The per-input counts are estimates, but add up to what the
+            # upstream reported for the batch.
+            total_tokens = int((body.get("usage") or {}).get("prompt_tokens") or 0)
+            tokens = apportion(total_tokens, [len(text) for _, text in items])
+            for (key, _), row, prompt_tokens in zip(items, rows, tokens):
+                entry = (prompt_tokens, pack(row["embedding"]))
+                self.cache.put(key, entry)
+                future = self.pending.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(entry)
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            if not isinstance(e, HTTPException):
+                logger.exception("Embedding batch failed: %s", e)
+                e = HTTPException(status_code=502, detail=f"Embedding upstream failed: {e}")
+            for key, _ in items:
+                future = self.pending.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                    # Retrieved here so requests that went away do not leave a warning
+                    future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "pending_inputs": len(self.pending),
+            "upstream_calls": self.upstream_calls,
+            "upstream_inputs": self.upstream_inputs,
+        }
+
+
+embedder = EmbeddingBatcher(VectorCache())
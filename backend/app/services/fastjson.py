@@ -0,0 +1,98 @@
+import re
+
+from typing import Any, Dict
+
+import orjson
+from fastapi import HTTPException, Request
+
+# How far into a response body to look for the top-level id/model/created
+HEAD_BYTES = 512
+
+_HEAD_FIELD = re.compile(rb'"(id|model|created)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+
+async def read_json(request: Request) -> Any:
+    """
+    Parse the request body with orjson.
+
+    Args:
+        request (Request): The incoming request.
+
+    Returns:
+        Any: The decoded JSON body.
+
+    Raises:
+        HTTPException: 400 if the body is not valid JSON.
+    """
+    body = await request.body()
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON") from e
+
+
+def _usage_object(raw: bytes) -> Any:
+    """Slice the trailing `usage` object out of a response body and decode only that."""
+    key = raw.rfind(b'"usage"')
+    if key == -1:
+        return None
+    colon = raw.index(b":", key + 7)
+    start = colon + 1
+    while raw[start:start + 1] in (b" ", b"\n", b"\r", b"\t"):
+        start += 1
+    if raw.startswith(b"null", start):
+        return None
+
+    depth = 0
+    for end in range(start, len(raw)):
+        char = raw[end]
+        if char == 0x7B:  # {
+            depth += 1
+        elif char == 0x7D:  # }
+            depth -= 1
+            if depth == 0:
+                return orjson.loads(raw[start:end + 1])
+    raise ValueError("Unterminated usage object")
+
+
+def extract_usage_fields(raw: bytes) -> Dict[str, Any]:
+    """
+    Pull `id`, `model`, `created` and `usage` out of a completion body
+    without decoding the whole thing.
+
+    vLLM writes the identifying fields before `choices` and `usage` after
+    it, so only the head and the tail of the body are looked at; the
+    choices (which may hold thousands of tokens and logprobs) are skipped.
+    Falls back to a full decode if the body is laid out differently.
+
+    Args:
+        raw (bytes): The raw upstream response body.
+
+    Returns:
+        Dict[str, Any]: The fields found; `usage` defaults to an empty dict.
+    """
+    try:
+        head = raw[:HEAD_BYTES]
+        choices = head.find(b'"choices"')
+        if choices != -1:
+            head = head[:choices]
+
+        fields: Dict[str, Any] = {}
+        for match in _HEAD_FIELD.finditer(head):
+            key = match.group(1).decode()
+            if key not in fields:
+                fields[key] = orjson.loads(match.group(2))
+
+        fields["usage"] = _usage_object(raw) or {}
+        if "id" in fields and "model" in fields:
+            return fields
+    except (ValueError, orjson.JSONDecodeError):
+        pass
+
+    body = orjson.loads(raw)
+    return {
+        "id": body.get("id"),
+        "model": body.get("model"),
+        "created": body.get("created"),
+        "usage": body.get("usage") or {},
+    }
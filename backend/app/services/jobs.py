@@ -0,0 +1,82 @@
+import time
+import asyncio
+import logging
+import datetime as dt
+
+from typing import Awaitable, Callable, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from redis.exceptions import RedisError
+
+from backend.database import db
+from backend.app.services import readiness
+
+logger = logging.getLogger(__name__)
+
+# How often a due job checks whether the stores it needs are up yet
+JOB_READY_POLL = 0.5
+
+# Periodic database maintenance, registered by the services that own it
+_jobs: dict = {}
+
+scheduler: Optional[AsyncIOScheduler] = None
+
+
+def register(name: str, func: Callable[[], Awaitable[None]], interval: float,
+             postgres: bool = True):
+    """
+    Run `func` every `interval` seconds, starting as soon as the stores it
+    needs are up: Redis always, for the lock, and Postgres unless
+    `postgres` is False.
+
+    Only one gateway worker runs a given job per interval: a Redis lock is
+    taken and left to expire rather than released, so the other workers'
+    timers find it set and skip their turn.
+    """
+    _jobs[name] = (func, interval, postgres)
+
+
+def _ready(postgres: bool) -> bool:
+    checks = readiness.state.checks
+    return checks["redis"] and (not postgres or checks["postgres"])
+
+
+async def _run(name: str, func: Callable[[], Awaitable[None]], interval: float, postgres: bool):
+    # The first run fires at startup, before the stores are up; waiting for
+    # them instead of skipping keeps it from slipping a whole interval
+    give_up = time.monotonic() + interval * 0.9
+    while not _ready(postgres):
+        if time.monotonic() >= give_up:
+            return
+        await asyncio.sleep(JOB_READY_POLL)
+    try:
+        lock_ttl = max(1, int(interval * 0.9))
+        if not await db.redis_client.set(f"lock:job:{name}", "1", nx=True, ex=lock_ttl):
+            return
+    except RedisError as e:
+        logger.warning("Job %s skipped, Redis unavailable: %s", name, e)
+        return
+    try:
+        await func()
+    except Exception as e:                                                                           # pylint: disable=broad-exception-caught
+        logger.exception("Job %s failed: %s", name, e)
+
+
+def start():
+    global scheduler                                                                                 # pylint: disable=global-statement
+    if scheduler is not None:
+        return
+    scheduler = AsyncIOScheduler(timezone="UTC")
+    for name, (func, interval, postgres) in _jobs.items():
+        scheduler.add_job(
+            _run, "interval", args=(name, func, interval, postgres), seconds=interval, id=name,
+            max_instances=1, coalesce=True, next_run_time=dt.datetime.now(dt.timezone.utc),
+        )
+    scheduler.start()
+
+
+def stop():
+    global scheduler                                                                                 # pylint: disable=global-statement
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        scheduler = None
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+from collections import deque
+from typing import Deque, Optional
+
+from dotenv import load_dotenv
+
+from backend.app.services.profiler import folded_stack
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+# How often the loop is pinged; also the watchdog's polling period
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000
+# A callback holding the loop longer than this gets its stack captured
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD_MS", "100")) / 1000
+
+
+class LoopMonitor:
+    """
+    Continuous event-loop lag monitor and slow-callback detector.
+
+    A heartbeat task sleeps for the interval and records how late it
+    wakes up (the loop lag). A watchdog thread checks the heartbeat: when
+    it is overdue by more than the threshold, something is blocking the
+    loop right now, so the watchdog grabs the loop thread's stack, which
+    names the culprit. The cost is one wakeup per interval on each side.
+    """
+
+    def __init__(self):
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.last_beat = time.monotonic()
+        self.lags: Deque[float] = deque(maxlen=600)
+        self.max_lag = 0.0
+        self.slow_callbacks: Deque[dict] = deque(maxlen=20)
+        self.slow_count = 0
+
+    def start(self):
+        """Start monitoring the running loop. Call from the loop thread."""
+        if not LOOP_MONITOR_ENABLED or self.heartbeat_task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopping.clear()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            try:
+                await self.heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat_task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + LOOP_MONITOR_INTERVAL
+            await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.last_beat = now
+            if lag > SLOW_CALLBACK_THRESHOLD and self.slow_callbacks:
+                # Complete the event the watchdog opened for this stall
+                event = self.slow_callbacks[-1]
+                if event.get("duration_ms") is None:
+                    event["duration_ms"] = round(lag * 1000, 1)
+
+    def _watch(self):
+        reported_beat = None
+        while not self.stopping.wait(LOOP_MONITOR_INTERVAL):
+            beat = self.last_beat
+            overdue = time.monotonic() - beat - LOOP_MONITOR_INTERVAL
+            if overdue <= SLOW_CALLBACK_THRESHOLD or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self.loop_thread_id)                                   # pylint: disable=protected-access
+            stack = folded_stack(frame) if frame is not None else ""
+            del frame
+            self.slow_count += 1
+            self.slow_callbacks.append(
+                {"at": time.time(), "blocked_for_ms": round(overdue * 1000, 1),
+                 "duration_ms": None, "stack": stack}
+            )
+            logger.warning(
+                "Event loop blocked for %.0f ms so far in: %s",
+                overdue * 1000, ";".join(stack.split(";")[-3:]) or "?",
+            )
+
+    def stats(self) -> dict:
+        lags = sorted(self.lags)
+
+        def percentile(q: float) -> Optional[float]:
+            if not lags:
+                return None
+            return round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 2)
+
+        return {
+            "enabled": LOOP_MONITOR_ENABLED,
+            "interval_ms": LOOP_MONITOR_INTERVAL * 1000,
+            "lag_ms": {
+                "last": round(self.lags[-1] * 1000, 2) if self.lags else None,
+                "p50": percentile(0.50),
+                "p99": percentile(0.99),
+                "max": round(self.max_lag * 1000, 2),
+            },
+            "slow_callback_threshold_ms": SLOW_CALLBACK_THRESHOLD * 1000,
+            "slow_callbacks": self.slow_count,
+            "recent_slow_callbacks": list(self.slow_callbacks),
+        }
+
+
+monitor = LoopMonitor()
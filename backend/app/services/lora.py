@@ -0,0 +1,345 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import httpx
+import orjson
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+
+from backend.database import db
+from backend.app.services import deadlines, upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Adapters a replica keeps loaded; match vLLM's --max-cpu-loras so they stay cached
+LORA_MAX_PER_REPLICA = int(os.getenv("LORA_MAX_PER_REPLICA", "8"))
+# Once every replica holding an adapter has more queued requests than this,
+# the adapter is loaded on one more replica
+LORA_SPREAD_WAITING = float(os.getenv("LORA_SPREAD_WAITING", "4"))
+LORA_LOAD_TIMEOUT = float(os.getenv("LORA_LOAD_TIMEOUT", "60"))
+# How often residency is re-read from the replicas' /v1/models
+LORA_SYNC_INTERVAL = float(os.getenv("LORA_SYNC_INTERVAL", "15"))
+
+# Per replica: adapter name -> last use by any gateway worker (unix time)
+LORA_USED_KEY = "lora_used:{url}"
+# A worker records a use of the same adapter on the same replica at most this often
+LORA_USED_WRITE_INTERVAL = 1.0
+
+
+class Adapter:
+    """
+    A LoRA fine-tune served on top of a base-model deployment.
+
+    Attributes:
+        name (str): Model name clients request, and vLLM serves it under.
+        base (str): Model alias of the deployment it runs on.
+        path (str): Where the vLLM replicas load the adapter weights from.
+    """
+
+    def __init__(self, name: str, base: str, path: str):
+        self.name = name
+        self.base = base
+        self.path = path
+
+
+class AdapterRegistry:
+    """
+    LoRA adapters, and which replicas have each of them loaded.
+
+    Requests for an adapter go to the replicas that already hold it. A
+    cold adapter, or one whose replicas are all backed up, is loaded on
+    the least-loaded replica of its base deployment through vLLM's
+    /v1/load_lora_adapter. Every replica holds at most
+    LORA_MAX_PER_REPLICA adapters; past that the least recently used idle
+    one is unloaded first. Recency is shared by all gateway workers in
+    Redis. An adapter is busy, and never unloaded, while this worker has
+    requests for it in flight or the replica's last scrape lists it with
+    running or waiting requests (those of other workers). vLLM's
+    /v1/models is the source of truth for residency and is re-read
+    periodically, so the views of several gateway workers converge.
+    """
+
+    def __init__(self, config: Dict[str, dict]):
+        self.adapters: Dict[str, Adapter] = {
+            name: Adapter(name, entry["base"], entry["path"]) for name, entry in config.items()
+        }
+        # Replica url -> adapter names loaded there
+        self.resident: Dict[str, Set[str]] = {}
+        # (replica url, adapter name) -> this worker's requests that may run there
+        self.inflight: Counter = Counter()
+        # (replica url, adapter name) -> when this worker last wrote its use to Redis
+        self.used_written: Dict[Tuple[str, str], float] = {}
+        # One load/unload/sync at a time per replica
+        self.locks: Dict[str, asyncio.Lock] = {}
+        # Replica urls of the base deployments, whose residency is synced
+        self.replicas: set = set()
+        self.loads = 0
+        self.evictions = 0
+        self.sync_task: Optional[asyncio.Task] = None
+
+    def get(self, name: Optional[str]) -> Optional[Adapter]:
+        return self.adapters.get(name) if name else None
+
+    def _lock(self, url: str) -> asyncio.Lock:
+        if url not in self.locks:
+            self.locks[url] = asyncio.Lock()
+        return self.locks[url]
+
+    def _holders(self, adapter: Adapter, urls: List[str]) -> List[str]:
+        return [url for url in urls if adapter.name in self.resident.get(url, ())]
+
+    @staticmethod
+    def _saturated(url: str) -> bool:
+        backend = upstream.get_backend(url)
+        if not backend.breaker.allow():
+            return True
+        load = backend.fresh_load()
+        return load is not None and (not load.healthy or load.waiting > LORA_SPREAD_WAITING)
+
+    async def place(self, adapter: Adapter, urls: List[str],
+                    deadline: Optional[float] = None) -> List[str]:
+        """
+        Replicas a request for `adapter` may go to, loading it first if needed.
+
+        Args:
+            adapter (Adapter): The requested adapter.
+            urls (List[str]): Replicas of its base deployment.
+            deadline (float, optional): The client's deadline, bounds the load.
+
+        Returns:
+            List[str]: The replicas holding the adapter.
+
+        Raises:
+            HTTPException: 502 if the adapter could not be loaded anywhere.
+        """
+        self.replicas.update(urls)
+        holders = self._holders(adapter, urls)
+        # Taken before any await, so a concurrent load cannot evict it meanwhile
+        self._acquire(adapter.name, holders)
+        try:
+            placed = await self._place(adapter, urls, holders, deadline)
+        except BaseException:
+            self.release(adapter.name, holders)
+            raise
+        self._acquire(adapter.name, [url for url in placed if url not in holders])
+        await self._touch(adapter.name, placed)
+        return placed
+
+    async def _place(self, adapter: Adapter, urls: List[str], holders: List[str],
+                     deadline: Optional[float]) -> List[str]:
+        if holders and not all(self._saturated(url) for url in holders):
+            return holders
+
+        candidates = [url for url in urls if url not in holders] or urls
+        # Replicas with a free slot first, so loading does not evict anything
+        roomy = [url for url in candidates if len(self.resident.get(url, ())) < LORA_MAX_PER_REPLICA]
+        backend = await upstream.pick_backend(roomy) if roomy else None
+        backend = backend or await upstream.pick_backend(candidates)
+        if backend is None:
+            if holders:
+                return holders
+            raise HTTPException(status_code=503, detail="No healthy upstream available")
+        if backend.url in holders:
+            # Every replica already holds it, there is nowhere to spread to
+            return holders
+        try:
+            await self._load(backend.url, adapter, deadline)
+        except HTTPException:
+            if holders:
+                # Busy replicas still beat failing the request
+                return holders
+            raise
+        return [*holders, backend.url]
+
+    def _acquire(self, name: str, urls: Iterable[str]):
+        for url in urls:
+            self.inflight[(url, name)] += 1
+
+    def release(self, name: str, urls: Iterable[str]):
+        """End a request placed by `place` on `urls`."""
+        for url in urls:
+            key = (url, name)
+            self.inflight[key] -= 1
+            if self.inflight[key] <= 0:
+                del self.inflight[key]
+
+    def _busy(self, url: str) -> Set[str]:
+        """Adapters on `url` with requests in flight here, or running/queued per the last scrape."""
+        busy = {name for (held_url, name) in self.inflight if held_url == url}
+        load = upstream.get_backend(url).fresh_load()
+        if load is not None:
+            busy.update(load.active_adapters)
+        return busy
+
+    async def _touch(self, name: str, urls: List[str]):
+        """Record a use of the adapter on `urls` for every worker's eviction order."""
+        now = time.time()
+        due = [
+            url for url in urls
+            if now - self.used_written.get((url, name), 0.0) >= LORA_USED_WRITE_INTERVAL
+        ]
+        redis = db.redis_client
+        if not due or redis is None:
+            return
+        for url in due:
+            self.used_written[(url, name)] = now
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for url in due:
+                    pipe.zadd(LORA_USED_KEY.format(url=url), {name: now})
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning("Could not record adapter use in Redis: %s", e)
+
+    async def _victim(self, url: str) -> Optional[str]:
+        """The least recently used idle adapter on `url`, None if all are busy."""
+        busy = self._busy(url)
+        idle = sorted(name for name in self.resident.get(url, ()) if name not in busy)
+        if not idle:
+            return None
+        redis = db.redis_client
+        used = [None] * len(idle)
+        if redis is not None:
+            try:
+                used = await redis.zmscore(LORA_USED_KEY.format(url=url), idle)
+            except RedisError as e:
+                logger.warning("Could not read adapter recency from Redis: %s", e)
+        # Without a shared record, fall back to this worker's own last write
+        return min(
+            zip(idle, used),
+            key=lambda item: item[1] if item[1] is not None
+            else self.used_written.get((url, item[0]), 0.0),
+        )[0]
+
+    async def _post(self, url: str, path: str, body: dict, deadline: Optional[float]):
+        return await upstream.get_client().post(
+            f"{upstream.get_backend(url).base_url}{path}",
+            content=orjson.dumps(body),
+            headers={"Content-Type": "application/json"},
+            timeout=deadlines.cap(deadline, LORA_LOAD_TIMEOUT),
+        )
+
+    async def _load(self, url: str, adapter: Adapter, deadline: Optional[float]):
+        async with self._lock(url):
+            resident = self.resident.setdefault(url, set())
+            if adapter.name in resident:
+                # Loaded by a concurrent request while this one waited
+                return
+            while len(resident) >= LORA_MAX_PER_REPLICA:
+                victim = await self._victim(url)
+                if victim is None:
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"Every adapter slot on {url} is serving requests",
+                    )
+                await self._unload(url, victim, deadline)
+
+            try:
+                response = await self._post(
+                    url, "/v1/load_lora_adapter",
+                    {"lora_name": adapter.name, "lora_path": adapter.path}, deadline,
+                )
+            except httpx.HTTPError as e:
+                raise HTTPException(
+                    status_code=502, detail=f"Could not load adapter {adapter.name}: {e!r}"
+                ) from e
+            # Another gateway worker may have loaded it first
+            if response.status_code != 200 and "already" not in response.text:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Could not load adapter {adapter.name}: {response.text[:300]}",
+                )
+            resident.add(adapter.name)
+            self.loads += 1
+            logger.info("Loaded adapter %s on %s", adapter.name, url)
+
+    async def _unload(self, url: str, name: str, deadline: Optional[float]):
+        """Unload an adapter; call with the replica's lock held."""
+        try:
+            response = await self._post(url, "/v1/unload_lora_adapter", {"lora_name": name}, deadline)
+            if response.status_code not in (200, 404):
+                logger.warning("Unloading adapter %s from %s failed: %s", name, url, response.text[:300])
+        except httpx.HTTPError as e:
+            logger.warning("Unloading adapter %s from %s failed: %r", name, url, e)
+        # Forgotten either way, the next sync corrects the view if it is still there
+        self.resident[url].discard(name)
+        self.evictions += 1
+        logger.info("Evicted adapter %s from %s", name, url)
+
+    async def sync(self):
+        """Re-read which adapters each known replica has loaded."""
+        for url in list(self.replicas):
+            try:
+                response = await upstream.get_client().get(
+                    f"{upstream.get_backend(url).base_url}/v1/models", timeout=5.0
+                )
+                if response.status_code != 200:
+                    continue
+                loaded = [
+                    model["id"] for model in orjson.loads(response.content).get("data", [])
+                    if model.get("parent")
+                ]
+            except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+                logger.debug("Adapter sync of %s failed: %r", url, e)
+                continue
+
+            async with self._lock(url):
+                self.resident[url] = set(loaded)
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.exception("Adapter sync failed: %s", e)
+            await asyncio.sleep(LORA_SYNC_INTERVAL)
+
+    def start(self, replicas: List[str]):
+        """Keep the residency of `replicas`, the base deployments' replicas, in sync."""
+        self.replicas.update(replicas)
+        if self.adapters and self.sync_task is None:
+            self.sync_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            try:
+                await self.sync_task
+            except asyncio.CancelledError:
+                pass
+            self.sync_task = None
+
+    def stats(self) -> dict:
+        return {
+            "adapters": {
+                name: {"base": adapter.base, "replicas": self._holders(adapter, sorted(self.resident))}
+                for name, adapter in self.adapters.items()
+            },
+            "resident": {url: sorted(names) for url, names in self.resident.items()},
+            "inflight": {f"{url} {name}": count for (url, name), count in self.inflight.items()},
+            "max_per_replica": LORA_MAX_PER_REPLICA,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+def _load_config() -> Dict[str, dict]:
+    raw = os.getenv("LORA_ADAPTERS")
+    path = os.getenv("LORA_ADAPTERS_FILE")
+    if raw:
+        return orjson.loads(raw)
+    if path:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    return {}
+
+
+adapters = AdapterRegistry(_load_config())
@@ -0,0 +1,179 @@
+import os
+import logging
+
+from typing import Dict, List, Optional
+
+import orjson
+from dotenv import load_dotenv
+
+from backend.app.services import upstream
+from backend.app.services.lora import Adapter, adapters
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Alias used when a request names no model
+DEFAULT_ALIAS = os.getenv("DEFAULT_MODEL_ALIAS", "meta-llama/Llama-3.1-8B-Instruct")
+
+# Queue wait (seconds) above which opted-in requests move to the next tier
+DEFAULT_MAX_QUEUE_WAIT = float(os.getenv("MODEL_FALLBACK_MAX_QUEUE_WAIT", "2.0"))
+
+# Used when neither MODEL_REGISTRY nor MODEL_REGISTRY_FILE is set.
+# Tiers without "urls" are served by the KUBE_SERVER_URL(S) replicas.
+DEFAULT_REGISTRY = {
+    "meta-llama/Llama-3.1-8B-Instruct": {
+        "aliases": ["default-model", "llama-3.1-8b"],
+        "tiers": [{"model": "meta-llama/Llama-3.1-8B-Instruct"}],
+    },
+}
+
+
+class Tier:
+    """
+    One deployment an alias can be served by.
+
+    Attributes:
+        model (str): Model name the vLLM deployment serves.
+        urls (List[str]): Completion endpoints of its replicas.
+        max_queue_wait (float): Queue wait beyond which opted-in traffic moves on.
+    """
+
+    def __init__(self, model: str, urls: Optional[List[str]] = None,
+                 max_queue_wait: float = DEFAULT_MAX_QUEUE_WAIT):
+        self.model = model
+        self.urls = urls or list(upstream.UPSTREAM_URLS)
+        self.max_queue_wait = max_queue_wait
+        for url in self.urls:
+            upstream.get_backend(url)  # so the scraper picks it up
+
+    def queue_wait(self) -> Optional[float]:
+        """
+        Queue wait a request would see on the tier's best replica, from
+        the scraped vLLM queue-time histogram. None if nothing is known.
+        """
+        waits = []
+        for url in self.urls:
+            load = upstream.get_backend(url).fresh_load()
+            if load is not None and load.healthy and load.queue_wait is not None:
+                waits.append(load.queue_wait)
+        return min(waits) if waits else None
+
+    def overloaded(self) -> bool:
+        wait = self.queue_wait()
+        return wait is not None and wait > self.max_queue_wait
+
+
+class Resolution:
+    """
+    Where a request ends up.
+
+    Attributes:
+        alias (str): The model name the client asked for.
+        tier (Tier): The tier chosen to serve it.
+        fallback (bool): True if a tier other than the primary was chosen.
+        adapter (Adapter, optional): The LoRA adapter requested, run on `tier`.
+    """
+
+    def __init__(self, alias: str, tier: Tier, fallback: bool, adapter: Optional[Adapter] = None):
+        self.alias = alias
+        self.tier = tier
+        self.fallback = fallback
+        self.adapter = adapter
+
+    @property
+    def model(self) -> str:
+        """The model name sent to vLLM: the adapter's, if one was requested."""
+        return self.adapter.name if self.adapter else self.tier.model
+
+    @property
+    def base_model(self) -> str:
+        """The deployment's base model, which decides the chat template."""
+        return self.tier.model
+
+    @property
+    def urls(self) -> List[str]:
+        return self.tier.urls
+
+
+def allows_fallback(data: dict) -> bool:
+    """The request's `allow_fallback` flag; true or "true" (any case), as on the HTTP path."""
+    return str(data.get("allow_fallback", False)).lower() == "true"
+
+
+class ModelRegistry:
+    """Maps public model aliases to ordered deployment tiers."""
+
+    def __init__(self, config: Dict[str, dict]):
+        self.tiers: Dict[str, List[Tier]] = {}
+        for name, entry in config.items():
+            tiers = [
+                Tier(
+                    model=tier["model"],
+                    urls=tier.get("urls"),
+                    max_queue_wait=float(tier.get("max_queue_wait", DEFAULT_MAX_QUEUE_WAIT)),
+                )
+                for tier in entry.get("tiers", [])
+            ] or [Tier(model=name)]
+            for alias in [name, *entry.get("aliases", [])]:
+                self.tiers[alias] = tiers
+
+    def resolve(self, alias: Optional[str], allow_fallback: bool = False) -> Resolution:
+        """
+        Pick the tier to serve `alias`.
+
+        The primary tier is used unless the request opted in to fallback
+        and the primary's queue wait is over its threshold; then the first
+        later tier that is not itself overloaded wins. Unknown names pass
+        straight through to the default replicas, as before. A LoRA
+        adapter resolves to the primary tier of its base model, without
+        fallback, since another model cannot serve the adapter.
+
+        Args:
+            alias (str): The requested model, or None for the default.
+            allow_fallback (bool): Whether the client accepts a cheaper model.
+
+        Returns:
+            Resolution: The chosen tier.
+        """
+        alias = alias or DEFAULT_ALIAS
+        adapter = adapters.get(alias)
+        if adapter is not None:
+            base = self.resolve(adapter.base)
+            return Resolution(alias, base.tier, False, adapter)
+
+        tiers = self.tiers.get(alias)
+        if tiers is None:
+            return Resolution(alias, Tier(model=alias), False)
+
+        if allow_fallback and tiers[0].overloaded():
+            for tier in tiers[1:]:
+                if not tier.overloaded():
+                    logger.info("Falling back from %s to %s", tiers[0].model, tier.model)
+                    return Resolution(alias, tier, True)
+        return Resolution(alias, tiers[0], False)
+
+    def models_on(self, url: str) -> List[str]:
+        """Models of the deployments `url` is a replica of."""
+        return sorted({
+            tier.model for tiers in self.tiers.values() for tier in tiers if url in tier.urls
+        })
+
+    def adapter_replicas(self) -> List[str]:
+        """Replicas of every deployment that LoRA adapters run on."""
+        urls = {url for adapter in adapters.adapters.values() for url in self.resolve(adapter.base).urls}
+        return sorted(urls)
+
+
+def _load_config() -> Dict[str, dict]:
+    raw = os.getenv("MODEL_REGISTRY")
+    path = os.getenv("MODEL_REGISTRY_FILE")
+    if raw:
+        return orjson.loads(raw)
+    if path:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    return DEFAULT_REGISTRY
+
+
+registry = ModelRegistry(_load_config())
@@ -0,0 +1,125 @@
+import os
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Dict, Optional
+
+import orjson
+from dotenv import load_dotenv
+from fastapi import WebSocket
+
+from backend.app.services import deadlines, tracing
+from backend.app.services.connections import send_lock
+from backend.app.services.drain import drainer
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Requests one socket may have generating at the same time
+WS_MAX_CONCURRENT = int(os.getenv("WS_MAX_CONCURRENT", "8"))
+# Requests one socket may have accepted (generating or waiting for a slot)
+WS_MAX_PENDING = int(os.getenv("WS_MAX_PENDING", "64"))
+
+# Runs one request, sending its frames through the session
+Job = Callable[[], Awaitable[None]]
+
+
+class MultiplexSession:
+    """
+    Concurrent requests sharing one WebSocket.
+
+    Each request carries a client-chosen id. Every frame sent for it is a
+    JSON object tagged with that id, so frames of different requests can
+    interleave freely:
+
+        {"id": ..., "type": "chunk", "data": ...}       one streamed chunk
+        {"id": ..., "type": "response", "data": {...}}  a non-streamed body
+        {"id": ..., "type": "served_model", ...}        model fallback notice
+        {"id": ..., "type": "done", "trace_id": ...}    the request finished
+        {"id": ..., "type": "cancelled"}                after a cancel message
+        {"id": ..., "type": "error", "error": ...}      the request failed
+
+    At most `max_concurrent` requests generate at a time, the rest wait
+    for a slot. Writes go through the socket's send lock. Each request is
+    traced as its own span, including the wait for a slot. A request with
+    a deadline is dropped from that wait, or cancelled while generating,
+    once the deadline passes.
+    """
+
+    def __init__(self, websocket: WebSocket, max_concurrent: int = WS_MAX_CONCURRENT,
+                 max_pending: int = WS_MAX_PENDING):
+        self.websocket = websocket
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_pending = max_pending
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.closed = False
+
+    async def send_raw(self, payload: bytes):
+        if self.closed:
+            return
+        async with send_lock(self.websocket):
+            await self.websocket.send_text(payload.decode("utf-8"))
+
+    async def send(self, request_id: str, frame_type: str, **fields):
+        await self.send_raw(orjson.dumps({"id": request_id, "type": frame_type, **fields}))
+
+    async def _send_quietly(self, request_id: str, frame_type: str, **fields):
+        """send() for final frames, when the socket may already be gone."""
+        try:
+            await self.send(request_id, frame_type, **fields)
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            logger.debug("Could not send %s frame for %s: %s", frame_type, request_id, e)
+
+    async def submit(self, request_id: str, job: Job, traceparent: Optional[str] = None,
+                     deadline: Optional[float] = None):
+        """Start a request, or answer with an error frame if it cannot be accepted."""
+        if request_id in self.tasks:
+            await self.send(request_id, "error", error="A request with this id is already running")
+            return
+        if len(self.tasks) >= self.max_pending:
+            await self.send(request_id, "error", error="Too many concurrent requests on this socket")
+            return
+        self.tasks[request_id] = asyncio.create_task(
+            self._run(request_id, job, traceparent, deadline)
+        )
+
+    async def cancel(self, request_id: str) -> bool:
+        task = self.tasks.get(request_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def _run(self, request_id: str, job: Job, traceparent: Optional[str],
+                   deadline: Optional[float]):
+        with drainer.track(), tracing.span(
+            "websocket_endpoint.request", traceparent=traceparent, kind=tracing.KIND_SERVER,
+            **{"ws.request_id": request_id},
+        ) as request_span:
+            try:
+                await deadlines.wait_for(self.slots.acquire(), deadline, "waiting for a slot")
+                try:
+                    request_span.event("slot_acquired")
+                    await deadlines.wait_for(job(), deadline, "while generating")
+                finally:
+                    self.slots.release()
+                await self.send(request_id, "done", trace_id=request_span.trace_id)
+            except asyncio.CancelledError as e:
+                # Also reached on close(), where send() is a no-op
+                request_span.record_error(e)
+                await self._send_quietly(request_id, "cancelled")
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                request_span.record_error(e)
+                logger.warning("Multiplexed request %s failed: %s", request_id, e)
+                await self._send_quietly(request_id, "error", error=str(e))
+            finally:
+                self.tasks.pop(request_id, None)
+
+    async def close(self):
+        """Cancel everything still running, e.g. after the client went away."""
+        self.closed = True
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
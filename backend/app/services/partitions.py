@@ -0,0 +1,295 @@
+import os
+import re
+import uuid
+import asyncio
+import decimal
+import logging
+import importlib
+import datetime as dt
+
+from typing import List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from psycopg import errors, sql
+
+from backend.database import db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Partition size of the logs table: "month" or "day"
+PARTITION_INTERVAL = os.getenv("LOGS_PARTITION_INTERVAL", "month")
+# Partitions kept created ahead of the current one
+PARTITIONS_AHEAD = int(os.getenv("LOGS_PARTITIONS_AHEAD", "3"))
+# Partitions ending before now minus this are archived and dropped.
+# /usage_dashboard reads one month and /usage/timeseries reads the rollups.
+RETENTION = dt.timedelta(days=float(os.getenv("LOGS_RETENTION_DAYS", "180")))
+# Where aged partitions are exported as Parquet; empty drops them unexported
+ARCHIVE_DIR = os.getenv("LOGS_ARCHIVE_DIR", "archive/logs")
+ARCHIVE_COMPRESSION = os.getenv("LOGS_ARCHIVE_COMPRESSION", "zstd")
+ARCHIVE_BATCH_ROWS = int(os.getenv("LOGS_ARCHIVE_BATCH_ROWS", "50000"))
+MAINTENANCE_INTERVAL = float(os.getenv("LOGS_MAINTENANCE_INTERVAL", "3600"))
+# DETACH needs an exclusive lock on logs; give up rather than queue inserts behind it
+DETACH_LOCK_TIMEOUT = os.getenv("LOGS_DETACH_LOCK_TIMEOUT", "5s")
+
+_NAME_RE = re.compile(r"^logs_(\d{6}|\d{8})$")
+
+
+def _period_start(value: dt.datetime) -> dt.datetime:
+    value = value.astimezone(dt.timezone.utc)
+    if PARTITION_INTERVAL == "day":
+        return dt.datetime(value.year, value.month, value.day, tzinfo=dt.timezone.utc)
+    return dt.datetime(value.year, value.month, 1, tzinfo=dt.timezone.utc)
+
+
+def _period_end(start: dt.datetime, interval: str = PARTITION_INTERVAL) -> dt.datetime:
+    if interval == "day":
+        return start + dt.timedelta(days=1)
+    return (start + dt.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start: dt.datetime) -> str:
+    return "logs_" + start.strftime("%Y%m%d" if PARTITION_INTERVAL == "day" else "%Y%m")
+
+
+def partition_range(name: str) -> Optional[Tuple[dt.datetime, dt.datetime]]:
+    """[start, end) of a partition from its name, None if it is not one of ours."""
+    match = _NAME_RE.match(name)
+    if not match:
+        return None
+    digits = match.group(1)
+    if len(digits) == 8:
+        start = dt.datetime.strptime(digits, "%Y%m%d").replace(tzinfo=dt.timezone.utc)
+        return start, _period_end(start, "day")
+    start = dt.datetime.strptime(digits, "%Y%m").replace(tzinfo=dt.timezone.utc)
+    return start, _period_end(start, "month")
+
+
+async def _attach_from_default(conn, name: str, start: dt.datetime, end: dt.datetime):
+    """
+    Create partition `name` when logs_default already holds rows of its
+    range (Postgres refuses a plain CREATE then): build it detached, move
+    the rows over and attach it, in one transaction.
+    """
+    table = sql.Identifier(name)
+    bounds = (sql.Literal(start), sql.Literal(end))
+    async with conn.transaction():
+        await conn.execute(
+            sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(DETACH_LOCK_TIMEOUT))
+        )
+        await conn.execute(
+            sql.SQL("CREATE TABLE {} (LIKE logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(table)
+        )
+        moved = await conn.execute(
+            sql.SQL(
+                "WITH moved AS (DELETE FROM logs_default"
+                " WHERE timestamp >= {} AND timestamp < {} RETURNING *)"
+                " INSERT INTO {} SELECT * FROM moved"
+            ).format(*bounds, table)
+        )
+        await conn.execute(
+            sql.SQL("ALTER TABLE logs ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+                table, *bounds
+            )
+        )
+    logger.warning("Moved %d rows from logs_default into new partition %s", moved.rowcount, name)
+
+
+async def ensure_partitions(now: dt.datetime):
+    """Create the current partition and PARTITIONS_AHEAD more, so inserts never miss."""
+    writer = await db.get_psql_writer()
+    start = _period_start(now)
+    async with writer.connection() as conn:
+        for _ in range(PARTITIONS_AHEAD + 1):
+            end = _period_end(start)
+            name = partition_name(start)
+            try:
+                async with conn.transaction():
+                    await conn.execute(
+                        sql.SQL(
+                            "CREATE TABLE IF NOT EXISTS {} PARTITION OF logs"
+                            " FOR VALUES FROM ({}) TO ({})"
+                        ).format(sql.Identifier(name), sql.Literal(start), sql.Literal(end))
+                    )
+            except errors.InvalidObjectDefinition:
+                # Overlaps a partition of the other interval (after switching
+                # LOGS_PARTITION_INTERVAL), which already covers these rows
+                logger.debug("Partition for %s already covered", start)
+            except errors.CheckViolation:
+                # Rows of this range landed in logs_default while it was missing
+                try:
+                    await _attach_from_default(conn, name, start, end)
+                except errors.LockNotAvailable:
+                    logger.warning("Could not lock logs to create %s, retrying next run", name)
+            start = end
+        await conn.commit()
+
+
+async def _tables(conn) -> Tuple[List[str], List[str]]:
+    """Names of the attached partitions of logs and of our detached leftovers."""
+    async with conn.cursor() as cursor:
+        await cursor.execute(
+            """
+            SELECT c.relname, i.inhparent IS NOT NULL
+            FROM pg_class c
+            LEFT JOIN pg_inherits i ON i.inhrelid = c.oid AND i.inhparent = 'logs'::regclass
+            WHERE c.relkind = 'r' AND c.relname ~ '^logs_[0-9]+$'
+                AND c.relnamespace = 'public'::regnamespace
+            """
+        )
+        rows = await cursor.fetchall()
+    attached = [name for name, is_attached in rows if is_attached]
+    detached = [name for name, is_attached in rows if not is_attached]
+    return attached, detached
+
+
+def _arrow_type(pa, type_code: int):
+    """Arrow type for a Postgres column OID; anything unlisted is kept as text."""
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1700: pa.float64(),  # numeric (token counts, spending)
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+    }.get(type_code, pa.string())
+
+
+def _arrow_value(value, as_text: bool):
+    if value is None:
+        return None
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if as_text and not isinstance(value, str):
+        if isinstance(value, (dict, list)):
+            return orjson.dumps(value).decode()
+        return str(value)
+    return value
+
+
+async def archive_partition(name: str) -> bool:
+    """
+    Export a detached partition to ARCHIVE_DIR/<name>.parquet.
+
+    Rows are streamed through a server-side cursor in ARCHIVE_BATCH_ROWS
+    batches, so memory stays flat whatever the partition size. The file is
+    written under a temporary name and renamed once its row count matches.
+
+    Returns:
+        bool: True if the partition is safe to drop.
+    """
+    if not ARCHIVE_DIR:
+        return True
+    try:
+        pa = importlib.import_module("pyarrow")
+        pq = importlib.import_module("pyarrow.parquet")
+    except ImportError:
+        logger.error(
+            "pyarrow is not installed: %s stays detached (not queryable, not dropped) until it"
+            " can be archived. Install pyarrow, or set LOGS_ARCHIVE_DIR= to drop unarchived",
+            name,
+        )
+        return False
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"{name}.parquet")
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    written = 0
+    writer = None
+    session = await db.get_psql_writer()
+    try:
+        async with session.connection() as conn:
+            async with conn.cursor(name=f"archive_{name}") as cursor:
+                await cursor.execute(sql.SQL("SELECT * FROM {}").format(sql.Identifier(name)))
+                schema = pa.schema(
+                    [(column.name, _arrow_type(pa, column.type_code)) for column in cursor.description]
+                )
+                text_columns = [field.type == pa.string() for field in schema]
+                writer = await asyncio.to_thread(
+                    pq.ParquetWriter, tmp_path, schema, compression=ARCHIVE_COMPRESSION
+                )
+                while True:
+                    rows = await cursor.fetchmany(ARCHIVE_BATCH_ROWS)
+                    if not rows:
+                        break
+                    columns = [
+                        [_arrow_value(row[index], text_columns[index]) for row in rows]
+                        for index in range(len(schema))
+                    ]
+                    batch = pa.Table.from_arrays(
+                        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                        schema=schema,
+                    )
+                    await asyncio.to_thread(writer.write_table, batch)
+                    written += len(rows)
+                await asyncio.to_thread(writer.close)
+                writer = None
+
+                async with conn.cursor() as check:
+                    await check.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(name)))
+                    (expected,) = await check.fetchone()
+            await conn.commit()
+
+        if written != expected:
+            raise RuntimeError(f"archived {written} rows of {name}, expected {expected}")
+        os.replace(tmp_path, path)
+        logger.info("Archived %s (%d rows) to %s", name, written, path)
+        return True
+    except Exception as e:                                                                           # pylint: disable=broad-exception-caught
+        logger.exception(
+            "Archiving %s failed, it stays detached (not queryable, not dropped) until a later"
+            " run archives it: %s", name, e,
+        )
+        if writer is not None:
+            await asyncio.to_thread(writer.close)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+async def expire_partitions(now: dt.datetime):
+    """Detach, archive and drop the partitions that ended before the retention cutoff."""
+    cutoff = now - RETENTION
+    writer = await db.get_psql_writer()
+    async with writer.connection() as conn:
+        attached, detached = await _tables(conn)
+        await conn.commit()
+
+        for name in attached:
+            bounds = partition_range(name)
+            if bounds is None or bounds[1] > cutoff:
+                continue
+            try:
+                async with conn.transaction():
+                    await conn.execute(
+                        sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(DETACH_LOCK_TIMEOUT))
+                    )
+                    await conn.execute(
+                        sql.SQL("ALTER TABLE logs DETACH PARTITION {}").format(sql.Identifier(name))
+                    )
+                detached.append(name)
+                logger.info("Detached partition %s", name)
+            except errors.LockNotAvailable:
+                logger.warning("Could not lock logs to detach %s, retrying next run", name)
+
+    # Detached tables left by an earlier failed run are picked up here too
+    for name in sorted(detached):
+        if partition_range(name) is None or not await archive_partition(name):
+            continue
+        async with writer.connection() as conn:
+            await conn.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            await conn.commit()
+        logger.info("Dropped partition %s", name)
+
+
+async def maintain():
+    """Scheduled job: partitions ahead, retention behind."""
+    now = dt.datetime.now(dt.timezone.utc)
+    await ensure_partitions(now)
+    await expire_partitions(now)
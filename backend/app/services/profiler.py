@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import hmac
+import random
+import asyncio
+import logging
+import threading
+
+from collections import Counter
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Lets a single request be profiled with "X-Profile: <ADMIN_TOKEN>"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# Longest stack kept per sample, counted from the innermost frame
+PROFILE_MAX_DEPTH = 64
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def folded_stack(frame, root: Optional[str] = None) -> str:
+    """A stack in the folded format flamegraph.pl and speedscope read: root;...;leaf."""
+    labels: List[str] = []
+    while frame is not None and len(labels) < PROFILE_MAX_DEPTH:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    if root:
+        labels.append(root)
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack from a background thread.
+
+    Nothing runs while it is off: the sampling thread only exists while a
+    time window is open or a profiled request is in flight. Samples taken
+    while the loop is running a profiled request's task are rooted under
+    that request's label; all others go under "loop" (which includes the
+    loop idling in select).
+    """
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.window_until = 0.0
+        self.sample_rate = 0.0
+        self.sample_until = 0.0
+        self.interval = PROFILE_INTERVAL
+        # id(task) -> label, for requests being profiled right now
+        self.marked: Dict[int, str] = {}
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Remember which thread runs the event loop. Call from that thread."""
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+
+    # --- Control ---
+    def start_window(self, duration: float, interval: Optional[float] = None):
+        """Profile everything on the loop for `duration` seconds."""
+        self.interval = interval or PROFILE_INTERVAL
+        self.window_until = time.monotonic() + duration
+        self._ensure_thread()
+
+    def start_sampling(self, rate: float, duration: float):
+        """Profile a `rate` fraction of requests for the next `duration` seconds."""
+        self.sample_rate = max(0.0, min(1.0, rate))
+        self.sample_until = time.monotonic() + duration
+
+    def stop(self):
+        self.window_until = 0.0
+        self.sample_rate = 0.0
+        self.sample_until = 0.0
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.samples = 0
+
+    def should_sample_request(self) -> bool:
+        """Whether a new request falls into the sampled fraction. Cheap when off."""
+        if not self.sample_rate:
+            return False
+        if time.monotonic() > self.sample_until:
+            self.sample_rate = 0.0
+            return False
+        return random.random() < self.sample_rate
+
+    def mark(self, task: asyncio.Task, label: str):
+        self.marked[id(task)] = label
+        self._ensure_thread()
+
+    def unmark(self, task: asyncio.Task):
+        self.marked.pop(id(task), None)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.marked) or time.monotonic() < self.window_until
+
+    # --- Sampling ---
+    def _ensure_thread(self):
+        if self.loop_thread_id is None:
+            return
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+
+    def _current_task_label(self) -> str:
+        # Called from the sampler thread; the loop is passed explicitly, so
+        # no running loop is needed here
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        if task is not None:
+            label = self.marked.get(id(task))
+            if label:
+                return label
+        return "loop"
+
+    def _run(self):
+        while self.active:
+            frame = sys._current_frames().get(self.loop_thread_id)                                   # pylint: disable=protected-access
+            if frame is not None:
+                stack = folded_stack(frame, self._current_task_label())
+                with self.lock:
+                    self.counts[stack] += 1
+                    self.samples += 1
+            del frame
+            time.sleep(self.interval)
+
+    def folded(self) -> str:
+        """All samples so far, one "stack count" line each."""
+        with self.lock:
+            items = self.counts.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            "running": self.thread is not None and self.thread.is_alive(),
+            "window_remaining": max(0.0, self.window_until - now),
+            "sample_rate": self.sample_rate if now < self.sample_until else 0.0,
+            "sampling_remaining": max(0.0, self.sample_until - now) if self.sample_rate else 0.0,
+            "profiled_requests_in_flight": len(self.marked),
+            "samples": self.samples,
+            "stacks": len(self.counts),
+            "interval_ms": self.interval * 1000,
+        }
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilingMiddleware:
+    """
+    Marks the requests to profile: a sampled fraction while sampling is on,
+    plus any request carrying "X-Profile: <ADMIN_TOKEN>". While sampling
+    is off this costs a scan of the request headers when ADMIN_TOKEN is
+    set, and one attribute check otherwise.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        profiler.mark(task, f"{scope['method']} {scope['path']}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.unmark(task)
+
+    @staticmethod
+    def _wanted(scope) -> bool:
+        if profiler.should_sample_request():
+            return True
+        if ADMIN_TOKEN:
+            expected = ADMIN_TOKEN.encode()
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    return hmac.compare_digest(value, expected)
+        return False
@@ -0,0 +1,145 @@
+import os
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from psycopg_pool import PoolTimeout
+
+from backend.database import db
+from backend.app.services import backend_metrics
+from backend.app.services.connections import manager
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Connections opened up front so the first requests do not pay for them
+REDIS_WARM_CONNECTIONS = int(os.getenv("REDIS_WARM_CONNECTIONS", "8"))
+PSQL_OPEN_TIMEOUT = float(os.getenv("PSQL_OPEN_TIMEOUT", "30"))
+WARMUP_RETRY_DELAY = float(os.getenv("WARMUP_RETRY_DELAY", "2"))
+UPSTREAM_WARM_TIMEOUT = float(os.getenv("UPSTREAM_WARM_TIMEOUT", "5"))
+
+
+class Readiness:
+    """
+    Which startup steps have finished. The gateway is ready to take
+    traffic only once every one of them has, and until it starts draining.
+    """
+
+    def __init__(self, checks: List[str]):
+        self.checks: Dict[str, bool] = {name: False for name in checks}
+        self.draining = False
+
+    def mark(self, name: str, ok: bool = True):
+        if self.checks.get(name) != ok:
+            logger.info("Readiness check %s: %s", name, "ready" if ok else "not ready")
+        self.checks[name] = ok
+
+    @property
+    def ready(self) -> bool:
+        return all(self.checks.values()) and not self.draining
+
+    def as_dict(self) -> dict:
+        return {"ready": self.ready, "draining": self.draining, "checks": dict(self.checks)}
+
+
+state = Readiness(["redis", "postgres", "upstream", "caches"])
+
+# Loaders for in-process caches, run once the stores are reachable
+_cache_loaders: List[Callable[[], Awaitable[None]]] = []
+
+_warmup_task: Optional[asyncio.Task] = None
+
+
+def register_cache_loader(loader: Callable[[], Awaitable[None]]):
+    """Register a coroutine function that fills a hot cache before the gateway reports ready."""
+    _cache_loaders.append(loader)
+
+
+async def _warm_redis():
+    db.redis_client = Redis(host="localhost", port=6379, db=0, decode_responses=True)
+    while True:
+        try:
+            # Concurrent pings fill the connection pool, not just one connection
+            await asyncio.gather(*(db.redis_client.ping() for _ in range(REDIS_WARM_CONNECTIONS)))
+            print("Successfully connected to Redis.")
+            break
+        except (RedisError, OSError) as e:
+            logger.warning("Redis not reachable yet, retrying: %s", e)
+            await asyncio.sleep(WARMUP_RETRY_DELAY)
+
+    # WebSocket delivery across workers goes through Redis pub/sub
+    await manager.start(db.redis_client)
+    state.mark("redis")
+
+
+async def _warm_postgres(conninfo: str):
+    if db.PSQL_REPLICA_CONN_STRING:
+        # Opens in the background; reads fall back to the primary until it is up
+        replica = db.make_psql_pool(db.PSQL_REPLICA_CONN_STRING, "replica")
+        await replica.open(wait=False)
+        db.psql_replica_pool = replica
+
+    while True:
+        pool = db.make_psql_pool(conninfo, "primary")
+        try:
+            # Returns once min_size connections are open; closes the pool on timeout
+            await pool.open(wait=True, timeout=PSQL_OPEN_TIMEOUT)
+            db.psql_pool = pool
+            print("PostgreSQL connection pool created.")
+            break
+        except PoolTimeout as e:
+            logger.warning("PostgreSQL pool not filled in time, retrying: %s", e)
+            await asyncio.sleep(WARMUP_RETRY_DELAY)
+    state.mark("postgres")
+
+
+async def _warm_upstream():
+    """Open keep-alive connections to every replica and take a first load snapshot."""
+    try:
+        await asyncio.wait_for(backend_metrics.scrape_all(), timeout=UPSTREAM_WARM_TIMEOUT)
+    except (asyncio.TimeoutError, httpx.HTTPError) as e:
+        # Replicas being down must not keep the gateway itself out of rotation
+        logger.warning("Upstream pre-warm incomplete: %r", e)
+    backend_metrics.start()
+    state.mark("upstream")
+
+
+async def _warm_caches():
+    for loader in _cache_loaders:
+        try:
+            await loader()
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            logger.exception("Cache loader %s failed: %s", loader.__name__, e)
+    state.mark("caches")
+
+
+async def _run(conninfo: str):
+    await asyncio.gather(_warm_redis(), _warm_postgres(conninfo), _warm_upstream())
+    await _warm_caches()
+    logger.info("Gateway warmed up and ready")
+
+
+def start(conninfo: str):
+    """
+    Warm everything up in the background. Startup returns at once, /livez
+    answers immediately and /readyz turns green when the warm-up is done.
+    """
+    global _warmup_task                                                                              # pylint: disable=global-statement
+    _warmup_task = asyncio.create_task(_run(conninfo))
+
+
+async def stop():
+    global _warmup_task                                                                              # pylint: disable=global-statement
+    if _warmup_task is not None and not _warmup_task.done():
+        _warmup_task.cancel()
+        try:
+            await _warmup_task
+        except asyncio.CancelledError:
+            pass
+    _warmup_task = None
@@ -0,0 +1,111 @@
+import os
+import hashlib
+
+from typing import Any, Awaitable, Callable
+
+import orjson
+from fastapi import Request
+from fastapi.responses import Response
+from redis.asyncio import Redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Upper bound on how long a cached body is served
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+# Usage rows reach Postgres through the logs_buffer consumer some time after
+# their version bump. For this long after a bump, bodies are only cached for
+# this long, so one built before the rows landed is not served for the full TTL.
+RESPONSE_CACHE_SETTLE_SECONDS = int(os.getenv("RESPONSE_CACHE_SETTLE_SECONDS", "15"))
+
+# Version counters, bumped whenever the data behind a cached view changes
+USAGE_VERSION_KEY = "usage_version:{user_id}"
+# /usage/timeseries reads the rollups, which only change when the rollup job
+# commits; it bumps this one counter (shared by all users) after each run
+ROLLUP_VERSION_KEY = "usage_rollup_version"
+# users.balance is written by the balance sync, which bumps the billing
+# version after its commit; the billing view lags Redis by one sync interval.
+BILLING_VERSION_KEY = "billing_version:{user_id}"
+
+
+def settling_key(version_key: str) -> str:
+    """Set (with RESPONSE_CACHE_SETTLE_SECONDS expiry) when a bump precedes the data."""
+    return f"{version_key}:settling"
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:24] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag (RFC 9110 13.1.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == wanted
+        for candidate in if_none_match.split(",")
+    )
+
+
+async def bump_version(redis: Redis, key_template: str, user_id: str):
+    """Invalidate every cached view built on `key_template` for this user."""
+    await redis.incr(key_template.format(user_id=user_id))
+
+
+async def cached_json(
+    request: Request,
+    redis: Redis,
+    name: str,
+    user_id: str,
+    version_key: str,
+    compute: Callable[[], Awaitable[Any]],
+) -> Response:
+    """
+    Serve a per-user JSON view from Redis with ETag/If-None-Match support.
+
+    The cached body is valid as long as the user's version counter has not
+    moved, and kept only briefly while the last bump is still settling
+    (its data may not all be readable yet). A matching If-None-Match gets
+    a 304 and a cache hit never touches Postgres; only a miss calls
+    `compute`.
+
+    Args:
+        request (Request): The incoming request (for If-None-Match).
+        redis (Redis): Redis client.
+        name (str): Name of the view, part of the cache key.
+        user_id (str): The user the view belongs to.
+        version_key (str): Template of the user's version counter key.
+        compute (Callable): Coroutine function building the response content on a miss.
+
+    Returns:
+        Response: 200 with the body and ETag, or 304.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    cache_key = f"response_cache:{name}:{user_id}"
+    counter = version_key.format(user_id=user_id)
+    version, settling = await redis.mget(counter, settling_key(counter))
+    version = version or "0"
+
+    cached = await redis.hgetall(cache_key)
+    if cached and cached.get("version") == version:
+        etag = cached["etag"]
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(
+            content=cached["body"], media_type="application/json", headers={"ETag": etag}
+        )
+
+    body = orjson.dumps(await compute())
+    etag = _etag(body)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(cache_key, mapping={"version": version, "etag": etag, "body": body})
+        pipe.expire(cache_key, RESPONSE_CACHE_SETTLE_SECONDS if settling else RESPONSE_CACHE_TTL)
+        await pipe.execute()
+
+    # Same content as the client already holds, even though the version moved
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
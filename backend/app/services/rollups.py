@@ -0,0 +1,183 @@
+import os
+import math
+import logging
+import datetime as dt
+
+from typing import Optional, Sequence
+
+from dotenv import load_dotenv
+
+from backend.database import db
+from backend.app.services.response_cache import ROLLUP_VERSION_KEY
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Upper bin edges of the latency histograms; the last bin is open-ended.
+# Changing them invalidates existing rollups (rebuild them from the logs).
+LATENCY_BOUNDS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "300"))
+# Logs reach Postgres through the logs_buffer consumer; hours this far back
+# are recomputed on every run so late rows are picked up
+ROLLUP_LATENESS = dt.timedelta(seconds=float(os.getenv("USAGE_ROLLUP_LATENESS", "3600")))
+# Largest slice of logs aggregated in one statement (backfills)
+ROLLUP_CHUNK = dt.timedelta(days=1)
+
+# Most points /usage/timeseries returns, however wide the range
+TIMESERIES_MAX_POINTS = int(os.getenv("USAGE_TIMESERIES_MAX_POINTS", "500"))
+GRANULARITIES = {"hour": dt.timedelta(hours=1), "day": dt.timedelta(days=1)}
+
+_HIST_EXPR = "ARRAY[" + ", ".join(
+    f"COUNT(*) FILTER (WHERE width_bucket(latency_ms, '{{{','.join(map(str, LATENCY_BOUNDS_MS))}}}'::real[]) = {i})"
+    for i in range(len(LATENCY_BOUNDS_MS) + 1)
+) + "]"
+
+ROLLUP_HOURLY = f"""
+INSERT INTO usage_rollup_hourly
+    (user_id, model, bucket, requests, total_tokens, spending, latency_hist)
+SELECT
+    user_id,
+    model,
+    date_trunc('hour', timestamp, 'UTC'),
+    COUNT(*),
+    COALESCE(SUM(total_tokens), 0),
+    COALESCE(SUM(spending), 0),
+    {_HIST_EXPR}
+FROM logs
+WHERE timestamp >= %(start)s AND timestamp < %(end)s
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, bucket, model) DO UPDATE SET
+    requests = EXCLUDED.requests,
+    total_tokens = EXCLUDED.total_tokens,
+    spending = EXCLUDED.spending,
+    latency_hist = EXCLUDED.latency_hist
+"""
+
+ROLLUP_DAILY = """
+INSERT INTO usage_rollup_daily
+    (user_id, model, bucket, requests, total_tokens, spending, latency_hist)
+SELECT
+    user_id,
+    model,
+    date_trunc('day', bucket, 'UTC'),
+    SUM(requests),
+    SUM(total_tokens),
+    SUM(spending),
+    hist_sum(latency_hist)
+FROM usage_rollup_hourly
+WHERE bucket >= %(start)s AND bucket < %(end)s
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, bucket, model) DO UPDATE SET
+    requests = EXCLUDED.requests,
+    total_tokens = EXCLUDED.total_tokens,
+    spending = EXCLUDED.spending,
+    latency_hist = EXCLUDED.latency_hist
+"""
+
+
+def floor_time(value: dt.datetime, step: dt.timedelta) -> dt.datetime:
+    """Round `value` down to a multiple of `step` since the Unix epoch (UTC)."""
+    epoch = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+    return epoch + ((value - epoch) // step) * step
+
+
+def plan_series(granularity: str, start: dt.datetime, end: dt.datetime):
+    """
+    Align a requested range to the rollup grid and pick the bucket width.
+
+    The width is a whole multiple of the granularity, chosen so the range
+    never yields more than TIMESERIES_MAX_POINTS buckets.
+
+    Returns:
+        tuple: (aligned start, aligned end, bucket width).
+    """
+    base = GRANULARITIES[granularity]
+    start = floor_time(start, base)
+    end = max(floor_time(end - dt.timedelta(microseconds=1), base) + base, start + base)
+    steps = (end - start) // base
+    step = base * math.ceil(steps / TIMESERIES_MAX_POINTS)
+    end = start + step * math.ceil((end - start) / step)
+    return start, end, step
+
+
+def histogram_percentile(counts: Optional[Sequence[int]], quantile: float) -> Optional[float]:
+    """
+    Estimate a latency percentile from a LATENCY_BOUNDS_MS histogram,
+    interpolating linearly inside the bin it falls in.
+
+    Args:
+        counts (list): Requests per bin.
+        quantile (float): Between 0 and 1.
+
+    Returns:
+        float: Latency in milliseconds, or None for an empty histogram.
+    """
+    total = sum(counts or ())
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(LATENCY_BOUNDS_MS):
+                return float(LATENCY_BOUNDS_MS[-1])
+            low = LATENCY_BOUNDS_MS[index - 1] if index else 0
+            high = LATENCY_BOUNDS_MS[index]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BOUNDS_MS[-1])
+
+
+def latency_percentiles(counts: Optional[Sequence[int]]) -> dict:
+    """p50/p90/p99 latency of one time bucket."""
+    return {
+        "latency_p50_ms": histogram_percentile(counts, 0.50),
+        "latency_p90_ms": histogram_percentile(counts, 0.90),
+        "latency_p99_ms": histogram_percentile(counts, 0.99),
+    }
+
+
+async def refresh_rollups(now: Optional[dt.datetime] = None):
+    """
+    Recompute every hourly (and the enclosing daily) bucket from the last
+    refresh point minus ROLLUP_LATENESS up to now. Buckets are recomputed
+    from scratch, so running twice is harmless.
+    """
+    now = now or dt.datetime.now(dt.timezone.utc)
+    writer = await db.get_psql_writer()
+    async with writer.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT refreshed_to FROM usage_rollup_state WHERE name = 'usage'"
+            )
+            row = await cursor.fetchone()
+            if row is None:
+                # First run: backfill from the oldest log
+                await cursor.execute("SELECT MIN(timestamp) FROM logs")
+                row = await cursor.fetchone()
+            await conn.commit()
+    if row is None or row[0] is None:
+        return
+    start = floor_time(min(row[0], now) - ROLLUP_LATENESS, dt.timedelta(hours=1))
+
+    while start < now:
+        end = min(start + ROLLUP_CHUNK, now)
+        days = {"start": floor_time(start, dt.timedelta(days=1)),
+                "end": floor_time(end, dt.timedelta(days=1)) + dt.timedelta(days=1)}
+        async with writer.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(ROLLUP_HOURLY, {"start": start, "end": end})
+                await cursor.execute(ROLLUP_DAILY, days)
+                await cursor.execute(
+                    """
+                    INSERT INTO usage_rollup_state (name, refreshed_to) VALUES ('usage', %s)
+                    ON CONFLICT (name) DO UPDATE SET refreshed_to = EXCLUDED.refreshed_to
+                    """,
+                    (end,),
+                )
+            await conn.commit()
+        start = end
+    # Cached time series were built from the rollups as they were before
+    await db.redis_client.incr(ROLLUP_VERSION_KEY)
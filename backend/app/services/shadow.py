@@ -0,0 +1,264 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+from typing import Deque, Dict, List, Optional, Set
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Mirrored requests in flight per worker; past that, sampled requests are not mirrored
+SHADOW_MAX_INFLIGHT = int(os.getenv("SHADOW_MAX_INFLIGHT", "16"))
+# A candidate slower than this is counted as an error
+SHADOW_TIMEOUT = float(os.getenv("SHADOW_TIMEOUT", "120"))
+# Latest measurements per side that percentiles are computed over
+SHADOW_WINDOW = int(os.getenv("SHADOW_WINDOW", "2000"))
+
+
+def _percentile(values: List[float], quantile: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))], 4)
+
+
+def _summary(values: Deque[float]) -> dict:
+    values = list(values)
+    return {"p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "n": len(values)}
+
+
+class Target:
+    """
+    A candidate deployment mirrored traffic of one production model goes to.
+
+    Attributes:
+        name (str): Label of the candidate in the stats, e.g. "vllm-0.8-awq".
+        urls (List[str]): Completion endpoints of the candidate's replicas.
+        model (str): Model name the candidate serves, if not the production one.
+        sample_rate (float): Fraction of the model's requests that are mirrored.
+    """
+
+    def __init__(self, name: str, urls: List[str], model: Optional[str] = None,
+                 sample_rate: float = 0.01):
+        self.name = name
+        self.urls = urls
+        self.model = model
+        self.sample_rate = sample_rate
+
+
+class Measurement:
+    """
+    One request as one side served it. Both sides are measured the same way:
+    time to the first streamed event, and generated tokens per second
+    (streamed events, or the usage of a non-streamed body).
+    """
+
+    __slots__ = ("side", "started", "first_at", "tokens", "finished")
+
+    def __init__(self, side: "Side"):
+        self.side = side
+        self.started = time.perf_counter()
+        self.first_at: Optional[float] = None
+        self.tokens = 0
+        self.finished = False
+
+    def chunk(self, chunk: bytes):
+        """Count the completion events in a raw SSE chunk."""
+        events = chunk.count(b"data: {")
+        if events and self.first_at is None:
+            self.first_at = time.perf_counter()
+        self.tokens += events
+
+    def body(self, content: bytes):
+        """Take the token count from a non-streamed response body."""
+        try:
+            usage = orjson.loads(content).get("usage") or {}
+            self.tokens = int(usage.get("completion_tokens") or 0)
+        except (orjson.JSONDecodeError, AttributeError, TypeError, ValueError):
+            pass
+
+    def done(self):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        side = self.side
+        side.requests += 1
+        side.latency.append(now - self.started)
+        if self.first_at is not None:
+            side.ttft.append(self.first_at - self.started)
+            # Decode rate after the first token, as TTFT is reported on its own
+            if self.tokens > 1 and now > self.first_at:
+                side.tokens_per_second.append((self.tokens - 1) / (now - self.first_at))
+        elif self.tokens and now > self.started:
+            side.tokens_per_second.append(self.tokens / (now - self.started))
+
+    def failed(self, error: str):
+        if self.finished:
+            return
+        self.finished = True
+        self.side.requests += 1
+        self.side.errors += 1
+        self.side.last_error = error[:300]
+
+
+class Side:
+    """Measurements of mirrored requests as served by production or the candidate."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.ttft: Deque[float] = deque(maxlen=SHADOW_WINDOW)
+        self.tokens_per_second: Deque[float] = deque(maxlen=SHADOW_WINDOW)
+        self.latency: Deque[float] = deque(maxlen=SHADOW_WINDOW)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else None,
+            "last_error": self.last_error,
+            "ttft": _summary(self.ttft),
+            "tokens_per_second": _summary(self.tokens_per_second),
+            "latency": _summary(self.latency),
+        }
+
+
+class Comparison:
+    """Production and candidate side by side, for one model and target."""
+
+    def __init__(self):
+        self.primary = Side()
+        self.shadow = Side()
+
+
+class ShadowMirror:
+    """
+    Mirrors a sample of production completions to candidate deployments.
+
+    The mirrored request is fired off on its own task and its own HTTP
+    client, so it shares neither connections nor the retry/breaker state
+    of the production path. Its response is read for timing and thrown
+    away, and it is never metered. Production's answer to the same
+    requests is measured alongside, so the two can be compared on the
+    exact same prompts. Requests are not mirrored while SHADOW_MAX_INFLIGHT
+    mirrored ones are still running.
+    """
+
+    def __init__(self, config: Dict[str, dict]):
+        self.targets: Dict[str, Target] = {
+            model: Target(
+                name=entry.get("name") or entry.get("model") or model,
+                urls=entry["urls"],
+                model=entry.get("model"),
+                sample_rate=float(entry.get("sample_rate", 0.01)),
+            )
+            for model, entry in config.items()
+        }
+        self.comparisons: Dict[str, Comparison] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.skipped = 0
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(SHADOW_TIMEOUT, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=SHADOW_MAX_INFLIGHT, max_keepalive_connections=SHADOW_MAX_INFLIGHT
+                ),
+            )
+        return self._client
+
+    def mirror(self, model: str, request_data: dict) -> Optional[Measurement]:
+        """
+        Maybe mirror a request to `model`'s candidate.
+
+        Args:
+            model (str): The production model serving the request.
+            request_data (dict): The upstream payload, copied, not modified.
+
+        Returns:
+            Optional[Measurement]: For the production side to record into,
+                or None if the request is not mirrored.
+        """
+        target = self.targets.get(model)
+        if target is None or random.random() >= target.sample_rate:
+            return None
+        if len(self.tasks) >= SHADOW_MAX_INFLIGHT:
+            self.skipped += 1
+            return None
+
+        comparison = self.comparisons.setdefault(f"{model} -> {target.name}", Comparison())
+        payload = dict(request_data)
+        if target.model:
+            payload["model"] = target.model
+        task = asyncio.create_task(self._shadow(target, payload, Measurement(comparison.shadow)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return Measurement(comparison.primary)
+
+    async def _shadow(self, target: Target, payload: dict, measurement: Measurement):
+        try:
+            async with self._get_client().stream(
+                "POST", random.choice(target.urls),
+                content=orjson.dumps(payload), headers={"Content-Type": "application/json"},
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    measurement.failed(f"HTTP {response.status_code}: {response.text[:200]}")
+                    return
+                if payload.get("stream") in (True, "True", "true"):
+                    async for chunk in response.aiter_raw():
+                        measurement.chunk(chunk)
+                else:
+                    measurement.body(await response.aread())
+            measurement.done()
+        except Exception as e:                                                                       # pylint: disable=broad-exception-caught
+            measurement.failed(repr(e))
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "targets": {
+                model: {"name": target.name, "model": target.model or model,
+                        "sample_rate": target.sample_rate}
+                for model, target in self.targets.items()
+            },
+            "inflight": len(self.tasks),
+            "skipped": self.skipped,
+            "comparisons": {
+                name: {"primary": comparison.primary.stats(), "shadow": comparison.shadow.stats()}
+                for name, comparison in self.comparisons.items()
+            },
+        }
+
+
+def _load_config() -> Dict[str, dict]:
+    raw = os.getenv("SHADOW_TARGETS")
+    path = os.getenv("SHADOW_TARGETS_FILE")
+    if raw:
+        return orjson.loads(raw)
+    if path:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    return {}
+
+
+shadow = ShadowMirror(_load_config())
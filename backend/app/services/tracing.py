@@ -0,0 +1,309 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import contextlib
+import contextvars
+
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "" (spans are not recorded), "file" (JSON lines) or "otlp" (OTLP/HTTP JSON)
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# Fraction of new traces recorded; incoming traceparent flags take precedence
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "1.0"))
+# Finished spans kept while the exporter catches up; the oldest are dropped
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "rainference-gateway")
+
+# OTLP span kinds
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+
+
+class Span:
+    """
+    One timed operation of a trace, modelled on OpenTelemetry spans.
+
+    Attributes:
+        trace_id (str): 32 hex chars, shared by the whole trace.
+        span_id (str): 16 hex chars.
+        parent_id (str, optional): span_id of the parent span.
+        sampled (bool): Whether the span is exported when it ends.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "sampled", "name", "kind",
+                 "start_ns", "end_ns", "attributes", "events", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool,
+                 kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.events: List[tuple] = []
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def event(self, name: str, **attributes):
+        """Mark a point in time inside the span, e.g. the first upstream byte."""
+        if self.sampled:
+            self.events.append((name, time.time_ns(), attributes))
+
+    def record_error(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.sampled:
+            exporter.add(self)
+
+    def traceparent(self) -> str:
+        """W3C trace context header naming this span as the parent."""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "events": [
+                {"name": name, "time_ns": at, "attributes": attrs} for name, at, attrs in self.events
+            ],
+            "error": self.error,
+        }
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def parse_traceparent(header: Optional[str]):
+    """(trace_id, parent span_id, sampled) from a W3C traceparent header, or None."""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def start_span(name: str, parent: Optional[Span] = None, traceparent: Optional[str] = None,
+               kind: int = KIND_INTERNAL, **attributes) -> Span:
+    """
+    Start a span without making it current; call `end()` on it.
+
+    It continues `parent`, else the span of the current context, else the
+    trace named by `traceparent`, else it starts a new (sampled or not) trace.
+    Use this where a context variable cannot be set and reset in the same
+    context, e.g. across the yields of an async generator.
+    """
+    parent = parent or _current.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes)
+    remote = parse_traceparent(traceparent)
+    if remote is not None:
+        trace_id, parent_id, sampled = remote
+        return Span(name, trace_id, parent_id, sampled and bool(TRACE_EXPORT), kind, attributes)
+    sampled = bool(TRACE_EXPORT) and random.random() < TRACE_SAMPLE_RATE
+    return Span(name, f"{random.getrandbits(128):032x}", None, sampled, kind, attributes)
+
+
+@contextlib.contextmanager
+def span(name: str, parent: Optional[Span] = None, traceparent: Optional[str] = None,
+         kind: int = KIND_INTERNAL, **attributes) -> Iterator[Span]:
+    """Run a block as a span that is current (the parent of spans started inside it)."""
+    current_span = start_span(name, parent, traceparent, kind, **attributes)
+    token = _current.set(current_span)
+    try:
+        yield current_span
+    except BaseException as e:
+        current_span.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        current_span.end()
+
+
+def outgoing_headers(parent: Optional[Span] = None) -> Dict[str, str]:
+    """Headers carrying the trace context to an upstream service."""
+    parent = parent or _current.get()
+    return {"traceparent": parent.traceparent()} if parent is not None else {}
+
+
+# --- Export ---
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def _otlp_span(s: Span) -> dict:
+    encoded = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": _otlp_attributes(s.attributes),
+        "events": [
+            {"name": name, "timeUnixNano": str(at), "attributes": _otlp_attributes(attrs)}
+            for name, at, attrs in s.events
+        ],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        encoded["parentSpanId"] = s.parent_id
+    return encoded
+
+
+class SpanExporter:
+    """Batches finished spans and writes them out from a background task."""
+
+    def __init__(self):
+        self.buffer: Deque[Span] = deque(maxlen=TRACE_BUFFER_SIZE)
+        self.task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.failed = 0
+
+    def add(self, finished: Span):
+        self.buffer.append(finished)
+
+    def start(self):
+        if TRACE_EXPORT and self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(512, len(self.buffer)))]
+            try:
+                if TRACE_EXPORT == "otlp":
+                    await self._post_otlp(batch)
+                elif TRACE_EXPORT == "file":
+                    await asyncio.to_thread(self._write_file, batch)
+                self.exported += len(batch)
+            except (OSError, httpx.HTTPError) as e:
+                self.failed += len(batch)
+                logger.warning("Dropped %d spans, export failed: %s", len(batch), e)
+
+    @staticmethod
+    def _write_file(batch: List[Span]):
+        with open(TRACE_FILE, "ab") as f:
+            f.write(b"".join(orjson.dumps(s.to_dict()) + b"\n" for s in batch))
+
+    @staticmethod
+    async def _post_otlp(batch: List[Span]):
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{
+                    "scope": {"name": "rainference"},
+                    "spans": [_otlp_span(s) for s in batch],
+                }],
+            }]
+        }
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            response = await client.post(
+                TRACE_OTLP_ENDPOINT,
+                content=orjson.dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await self.flush()
+
+
+exporter = SpanExporter()
+
+
+class TracingMiddleware:
+    """
+    Root span for every HTTP request, continuing an incoming traceparent.
+    It ends when the last byte of the response is sent, streaming
+    included, and its trace id is returned in the X-Trace-Id header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        with span(f"{scope['method']} {scope['path']}", traceparent=traceparent,
+                  kind=KIND_SERVER, **{"http.method": scope["method"],
+                                       "http.target": scope["path"]}) as root:
+            trace_header = (b"x-trace-id", root.trace_id.encode())
+
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    root.set("http.status_code", message["status"])
+                    message = {**message, "headers": [*message.get("headers", []), trace_header]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
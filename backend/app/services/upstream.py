@@ -0,0 +1,545 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+import httpx
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+from backend.app.services import deadlines, tracing
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Completion endpoints of the vLLM replicas, comma separated.
+# KUBE_SERVER_URL is still honoured for single-replica setups.
+UPSTREAM_URLS: List[str] = [
+    url.strip()
+    for url in (os.getenv("KUBE_SERVER_URLS") or os.getenv("KUBE_SERVER_URL") or "").split(",")
+    if url.strip()
+]
+
+# Retries (only ever before the first byte reaches the client)
+RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))
+RETRY_BACKOFF_BASE = float(os.getenv("UPSTREAM_RETRY_BACKOFF_BASE", "0.1"))
+RETRY_BACKOFF_MAX = float(os.getenv("UPSTREAM_RETRY_BACKOFF_MAX", "2.0"))
+RETRYABLE_STATUS = {500, 502, 503, 504}
+
+# Hedging of short non-streaming calls
+HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MAX_TOKENS = int(os.getenv("UPSTREAM_HEDGE_MAX_TOKENS", "256"))
+HEDGE_MIN_SAMPLES = 20
+
+# Circuit breaking
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "15"))
+
+# Load-aware routing, fed by the backend_metrics scraper
+KV_CACHE_HIGH_WATERMARK = float(os.getenv("KV_CACHE_HIGH_WATERMARK", "0.9"))
+WAITING_WEIGHT = float(os.getenv("ROUTING_WAITING_WEIGHT", "4"))
+LOAD_STALE_AFTER = float(os.getenv("ROUTING_LOAD_STALE_AFTER", "10"))
+
+# Timeouts
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "300"))
+
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker.
+
+    Closed: traffic flows. After `failure_threshold` consecutive failures the
+    breaker opens and the backend is ejected. Once `cooldown` has passed and
+    the backend_metrics scraper sees /health pass, it becomes half-open, and
+    a single request probes the backend; success closes the breaker, failure
+    opens it for another cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def probe_due(self) -> bool:
+        """True if the breaker is open and its cooldown has passed."""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        """Whether a request may be sent to the backend right now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            return not self.probe_in_flight
+        return False
+
+    def half_open(self):
+        self.state = self.HALF_OPEN
+        self.probe_in_flight = False
+
+    def on_send(self):
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def release_probe(self):
+        """Free the half-open slot of a probe that ended without a verdict (e.g. cancelled)."""
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Circuit opened after %d failures", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class Backend:
+    """A single vLLM replica and what the gateway knows about it."""
+
+    def __init__(self, url: str):
+        self.url = url
+        parts = urlsplit(url)
+        self.base_url = f"{parts.scheme}://{parts.netloc}"
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+        self.inflight = 0
+        # Durations of successful non-streaming calls, for the hedging threshold
+        self.latencies: Deque[float] = deque(maxlen=256)
+        # Latest backend_metrics.LoadSnapshot, None until the first scrape
+        self.load = None
+        # Set while the replica's prefix cache is being warmed; avoided meanwhile
+        self.warming = False
+
+    def fresh_load(self):
+        """The load snapshot if it is recent enough to route on, else None."""
+        if self.load is None or self.load.age() > LOAD_STALE_AFTER:
+            return None
+        return self.load
+
+    def load_score(self) -> float:
+        """
+        Lower is better. Queued sequences weigh more than running ones, and the
+        gateway's own in-flight count covers requests sent since the last scrape.
+        """
+        load = self.fresh_load()
+        if load is None:
+            return float(self.inflight)
+        return max(load.running, self.inflight) + WAITING_WEIGHT * load.waiting
+
+    def near_kv_exhaustion(self) -> bool:
+        load = self.fresh_load()
+        return load is not None and load.kv_cache_usage >= KV_CACHE_HIGH_WATERMARK
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+
+# url -> Backend, created on first use
+backends: Dict[str, Backend] = {}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_backend(url: str) -> Backend:
+    if url not in backends:
+        backends[url] = Backend(url)
+    return backends[url]
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared upstream client, so connections to the replicas are reused across requests."""
+    global _client                                                                                   # pylint: disable=global-statement
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+        )
+    return _client
+
+
+async def close_client():
+    global _client                                                                                   # pylint: disable=global-statement
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def pick_backend(
+    urls: Optional[List[str]] = None, exclude: Optional[Set[str]] = None
+) -> Optional[Backend]:
+    """
+    Choose the backend for the next attempt.
+
+    Backends whose breaker is open, or that failed their last /health
+    scrape, are skipped; the scraper lets one back in half-open once its
+    cooldown has run out and /health passes again, so picking a backend
+    never waits on the network. Replicas whose prefix cache
+    is being warmed are passed over while others are available. Replicas
+    close to KV-cache exhaustion (where vLLM starts preempting and recomputing sequences)
+    are only used when nothing else is left, and among the rest the one
+    with the lowest engine load wins. Already-tried backends are avoided
+    when there is any alternative.
+    """
+    candidates = [get_backend(url) for url in (urls or UPSTREAM_URLS)]
+    allowed = [
+        b for b in candidates
+        if b.breaker.allow() and (b.fresh_load() is None or b.fresh_load().healthy)
+    ]
+    # Replicas still warming up only take traffic no other replica can
+    allowed = [b for b in allowed if not b.warming] or allowed
+    fresh = [b for b in allowed if not exclude or b.url not in exclude]
+    pool = fresh or allowed
+    if not pool:
+        return None
+    roomy = [b for b in pool if not b.near_kv_exhaustion()]
+    pool = roomy or pool
+    random.shuffle(pool)
+    return min(pool, key=lambda b: b.load_score())
+
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+class _RetryableError(Exception):
+    """An attempt failed in a way another attempt may fix."""
+
+
+def _upstream_error(response: httpx.Response) -> HTTPException:
+    return HTTPException(
+        status_code=response.status_code,
+        detail=f"Error from Kubernetes server: {response.text[:500]}",
+    )
+
+
+def _timeouts(deadline: Optional[float]) -> dict:
+    """Per-request timeouts capped to the remaining deadline, or the client defaults."""
+    if deadline is None:
+        return {}
+    return {"timeout": httpx.Timeout(
+        deadlines.cap(deadline, READ_TIMEOUT), connect=deadlines.cap(deadline, CONNECT_TIMEOUT)
+    )}
+
+
+def _can_meet(backend: Backend, deadline: Optional[float]) -> bool:
+    """False when the replica's recent queue wait alone would use up the remaining budget."""
+    if deadline is None:
+        return True
+    load = backend.fresh_load()
+    return load is None or load.queue_wait is None or load.queue_wait < deadlines.remaining(deadline)
+
+
+def _check_backoff(deadline: Optional[float], delay: float):
+    """Give up rather than sleep past the deadline before the next attempt."""
+    left = deadlines.remaining(deadline)
+    if left is not None and left <= delay + deadlines.DEADLINE_SLACK:
+        raise deadlines.DeadlineExceeded("while retrying upstream")
+
+
+def _attempt_span(backend: Backend, parent: Optional[tracing.Span], attempt: int) -> tracing.Span:
+    """Client span of one upstream attempt, with the replica's queue as last scraped."""
+    attempt_span = tracing.start_span(
+        "upstream.attempt", parent, kind=tracing.KIND_CLIENT,
+        **{"upstream.url": backend.url, "upstream.attempt": attempt,
+           "upstream.inflight": backend.inflight},
+    )
+    load = backend.fresh_load()
+    if load is not None:
+        attempt_span.set("vllm.waiting", load.waiting)
+        attempt_span.set("vllm.running", load.running)
+        attempt_span.set("vllm.kv_cache_usage", load.kv_cache_usage)
+    return attempt_span
+
+
+def _request_extensions(attempt_span: tracing.Span) -> dict:
+    """httpx trace hook adding connect/TLS/header timings to a sampled attempt span."""
+    if not attempt_span.sampled:
+        return {}
+
+    async def trace(event: str, _info: dict):
+        if event.endswith(".complete") and event.split(".")[1] in (
+            "connect_tcp", "start_tls", "send_request_headers", "receive_response_headers"
+        ):
+            attempt_span.event(event)
+
+    return {"trace": trace}
+
+
+async def _attempt_post(
+    backend: Backend, payload: dict, parent: Optional[tracing.Span] = None, attempt: int = 0,
+    deadline: Optional[float] = None,
+) -> httpx.Response:
+    attempt_span = _attempt_span(backend, parent, attempt)
+    backend.inflight += 1
+    backend.breaker.on_send()
+    started = time.monotonic()
+    try:
+        try:
+            response = await get_client().post(
+                backend.url, json=payload, headers=tracing.outgoing_headers(attempt_span),
+                extensions=_request_extensions(attempt_span), **_timeouts(deadline),
+            )
+        except httpx.TransportError as e:
+            if isinstance(e, httpx.TimeoutException) and deadlines.expired(deadline):
+                # The client's budget ran out, not the replica
+                raise deadlines.DeadlineExceeded("waiting for upstream") from e
+            backend.breaker.record_failure()
+            raise _RetryableError(f"{backend.url}: {e!r}") from e
+        finally:
+            backend.inflight -= 1
+            backend.breaker.release_probe()
+        attempt_span.set("http.status_code", response.status_code)
+
+        if response.status_code in RETRYABLE_STATUS:
+            backend.breaker.record_failure()
+            raise _RetryableError(f"{backend.url}: HTTP {response.status_code}")
+
+        # Anything else means the replica is up, even a 4xx for a bad request
+        backend.breaker.record_success()
+        if response.status_code != 200:
+            raise _upstream_error(response)
+        backend.latencies.append(time.monotonic() - started)
+        return response
+    except BaseException as e:
+        attempt_span.record_error(e)
+        raise
+    finally:
+        attempt_span.end()
+
+
+async def _hedged_post(
+    primary: Backend, payload: dict, urls: Optional[List[str]], tried: Set[str],
+    parent: Optional[tracing.Span] = None, attempt: int = 0, deadline: Optional[float] = None,
+) -> Tuple[Backend, httpx.Response]:
+    """
+    Send to `primary`; if it has not answered within its latency percentile,
+    send the same request to a second backend and take whichever answers first.
+    """
+    threshold = primary.latency_percentile(HEDGE_PERCENTILE)
+    first = asyncio.create_task(_attempt_post(primary, payload, parent, attempt, deadline))
+    hedge: Optional[asyncio.Task] = None
+    try:
+        if threshold is None:
+            return primary, await first
+
+        done, _ = await asyncio.wait({first}, timeout=threshold)
+        if done:
+            return primary, first.result()
+
+        hedge_backend = await pick_backend(urls, exclude=tried | {primary.url})
+        if hedge_backend is None or hedge_backend.url == primary.url:
+            return primary, await first
+        tried.add(hedge_backend.url)
+        logger.info("Hedging request to %s after %.3fs", hedge_backend.url, threshold)
+
+        hedge = asyncio.create_task(_attempt_post(hedge_backend, payload, parent, attempt, deadline))
+        tasks = {first: primary, hedge: hedge_backend}
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return tasks[task], task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # asyncio.wait does not pass the caller's cancellation on; the losing
+        # or orphaned attempt would otherwise keep its upstream slot
+        for task in (first, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def post(
+    payload: dict, urls: Optional[List[str]] = None, parent: Optional[tracing.Span] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[Backend, httpx.Response]:
+    """
+    Send a non-streaming request with retries, optional hedging and circuit breaking.
+
+    Args:
+        payload (dict): The request body for vLLM.
+        urls (list, optional): Backends to choose from, defaults to all upstreams.
+        parent (tracing.Span, optional): Span the attempts are traced under,
+            defaults to the current one.
+        deadline (float, optional): The client's deadline (time.monotonic()).
+            Timeouts are capped to it, and the request is shed once it
+            cannot be met.
+
+    Returns:
+        Tuple[Backend, httpx.Response]: The backend that answered and its 200 response.
+
+    Raises:
+        HTTPException: 4xx from upstream as is, 503 when no backend is available,
+            502 once the retries are exhausted, 504 (DeadlineExceeded) when the
+            deadline passes or cannot be met.
+    """
+    tried: Set[str] = set()
+    last_error = "no attempt made"
+    hedge = HEDGE_ENABLED and int(payload.get("max_tokens") or 0) <= HEDGE_MAX_TOKENS
+
+    for attempt in range(RETRY_ATTEMPTS):
+        deadlines.check(deadline, "before reaching upstream")
+        backend = await pick_backend(urls, exclude=tried)
+        if backend is None:
+            raise HTTPException(status_code=503, detail="No healthy upstream available")
+        if not _can_meet(backend, deadline):
+            raise deadlines.DeadlineExceeded("in the upstream queue")
+        tried.add(backend.url)
+        try:
+            if hedge:
+                return await _hedged_post(backend, payload, urls, tried, parent, attempt, deadline)
+            return backend, await _attempt_post(backend, payload, parent, attempt, deadline)
+        except _RetryableError as e:
+            last_error = str(e)
+            logger.warning("Upstream attempt %d failed: %s", attempt + 1, last_error)
+        if attempt + 1 < RETRY_ATTEMPTS:
+            delay = _backoff(attempt)
+            _check_backoff(deadline, delay)
+            await asyncio.sleep(delay)
+
+    raise HTTPException(status_code=502, detail=f"Upstream unavailable: {last_error}")
+
+
+async def stream(
+    payload: dict, urls: Optional[List[str]] = None, parent: Optional[tracing.Span] = None,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Stream a request from upstream, retrying on another backend only until
+    the first byte has been received. After that a failure ends the stream.
+
+    Args:
+        payload (dict): The request body for vLLM.
+        urls (list, optional): Backends to choose from, defaults to all upstreams.
+        parent (tracing.Span, optional): Span the attempts are traced under,
+            defaults to the current one.
+        deadline (float, optional): The client's deadline (time.monotonic()).
+            The upstream request is closed, which makes vLLM abort the
+            generation, once it passes.
+
+    Yields:
+        bytes: Raw chunks from the upstream response.
+
+    Raises:
+        HTTPException: Same as `post`, raised before the first chunk is yielded,
+            except DeadlineExceeded, which can also end the stream midway.
+    """
+    tried: Set[str] = set()
+    last_error = "no attempt made"
+
+    for attempt in range(RETRY_ATTEMPTS):
+        deadlines.check(deadline, "before reaching upstream")
+        backend = await pick_backend(urls, exclude=tried)
+        if backend is None:
+            raise HTTPException(status_code=503, detail="No healthy upstream available")
+        if not _can_meet(backend, deadline):
+            raise deadlines.DeadlineExceeded("in the upstream queue")
+        tried.add(backend.url)
+
+        started = False
+        # Ended explicitly: a generator cannot own the current-span context
+        attempt_span = _attempt_span(backend, parent, attempt)
+        backend.inflight += 1
+        backend.breaker.on_send()
+        try:
+            async with get_client().stream(
+                "POST", backend.url, json=payload, headers=tracing.outgoing_headers(attempt_span),
+                extensions=_request_extensions(attempt_span), **_timeouts(deadline),
+            ) as response:
+                attempt_span.set("http.status_code", response.status_code)
+                if response.status_code in RETRYABLE_STATUS:
+                    backend.breaker.record_failure()
+                    raise _RetryableError(f"{backend.url}: HTTP {response.status_code}")
+                if response.status_code != 200:
+                    backend.breaker.record_success()
+                    await response.aread()
+                    raise _upstream_error(response)
+
+                async for chunk in response.aiter_bytes():
+                    if not started:
+                        started = True
+                        attempt_span.event("first_chunk")
+                        backend.breaker.record_success()
+                    yield chunk
+                    # Leaving the block closes the connection, and vLLM aborts the request
+                    deadlines.check(deadline, "while streaming")
+            backend.breaker.record_success()
+            return
+        except httpx.TransportError as e:
+            attempt_span.record_error(e)
+            if isinstance(e, httpx.TimeoutException) and deadlines.expired(deadline):
+                # The client's budget ran out, not the replica
+                raise deadlines.DeadlineExceeded("waiting for upstream") from e
+            backend.breaker.record_failure()
+            if started:
+                logger.error("Upstream stream from %s broke mid-response: %r", backend.url, e)
+                raise HTTPException(status_code=502, detail="Upstream stream interrupted") from e
+            last_error = f"{backend.url}: {e!r}"
+        except _RetryableError as e:
+            attempt_span.record_error(e)
+            last_error = str(e)
+        except BaseException as e:
+            attempt_span.record_error(e)
+            raise
+        finally:
+            attempt_span.end()
+            backend.inflight -= 1
+            backend.breaker.release_probe()
+
+        logger.warning("Upstream stream attempt %d failed: %s", attempt + 1, last_error)
+        if attempt + 1 < RETRY_ATTEMPTS:
+            delay = _backoff(attempt)
+            _check_backoff(deadline, delay)
+            await asyncio.sleep(delay)
+
+    raise HTTPException(status_code=502, detail=f"Upstream unavailable: {last_error}")
+
+
+async def prime(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Pull the first chunk before a StreamingResponse is created, so retries
+    happen and errors surface as a proper status code instead of a 200
+    followed by a dropped connection.
+
+    Returns:
+        AsyncIterator[bytes]: The same chunks, starting with the first one.
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b""
+
+    async def replay():
+        if first:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return replay()
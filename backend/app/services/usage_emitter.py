@@ -0,0 +1,267 @@
+import os
+import glob
+import uuid
+import fcntl
+import asyncio
+import logging
+import threading
+
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+
+from backend.database import db
+from backend.app.services.response_cache import (
+    RESPONSE_CACHE_SETTLE_SECONDS, USAGE_VERSION_KEY, settling_key
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Redis list the usage consumer drains into Postgres
+LOGS_BUFFER_KEY = "logs_buffer"
+
+USAGE_FLUSH_BATCH = int(os.getenv("USAGE_FLUSH_BATCH", "500"))
+# How long a record may wait for a batch to fill up
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "0.05"))
+# Records go here while Redis is unreachable, and are replayed from here
+USAGE_SPOOL_DIR = os.getenv("USAGE_SPOOL_DIR", "spool/usage")
+USAGE_SPOOL_RETRY_INTERVAL = float(os.getenv("USAGE_SPOOL_RETRY_INTERVAL", "5"))
+# A batch Redis has not acknowledged by then goes to the spool
+USAGE_PUSH_TIMEOUT = float(os.getenv("USAGE_PUSH_TIMEOUT", "2"))
+
+# (user_id, serialized record)
+Record = Tuple[str, bytes]
+
+
+class Spool:
+    """
+    Append-only files holding usage records Redis did not take.
+
+    Each worker appends to its own `*.jsonl` file, locked with flock while
+    it is open. To replay, the file is sealed (closed and renamed to
+    `*.replay`); replay progress is checkpointed in a `*.offset` file, so a
+    crash mid-replay re-sends at most one batch. Files left behind by a dead
+    worker are unlocked and get sealed and replayed by any other worker.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.file = None
+        self.path: Optional[str] = None
+        # append and seal run in worker threads
+        self.lock = threading.Lock()
+
+    def append(self, records: List[Record]):
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                name = f"usage-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+                self.path = os.path.join(self.directory, name)
+                self.file = open(self.path, "ab")                                                    # pylint: disable=consider-using-with
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.file.write(b"".join(payload + b"\n" for _, payload in records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def seal(self):
+        """Close the active file and hand it to the replayer."""
+        with self.lock:
+            if self.file is None:
+                return
+            os.replace(self.path, self.path[: -len(".jsonl")] + ".replay")
+            self.file.close()
+            self.file = None
+            self.path = None
+
+    def seal_orphans(self):
+        """Seal spool files whose worker is gone (nobody holds their lock)."""
+        for path in glob.glob(os.path.join(self.directory, "*.jsonl")):
+            if path == self.path:
+                continue
+            try:
+                with open(path, "ab") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.replace(path, path[: -len(".jsonl")] + ".replay")
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+    def pending(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "*.replay")))
+
+
+def _read_batch(path: str, offset: int, limit: int) -> Tuple[List[Record], int]:
+    """Up to `limit` complete records of a spool file from `offset`, and the next offset."""
+    records: List[Record] = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(records) < limit:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break  # end of file, or a write torn by a crash
+            offset += len(line)
+            payload = line.rstrip(b"\n")
+            try:
+                records.append((str(orjson.loads(payload)["user_id"]), payload))
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                logger.error("Skipping unreadable usage record in %s: %r", path, payload[:200])
+    return records, offset
+
+
+def _read_offset(path: str) -> int:
+    try:
+        with open(path + ".offset", "rb") as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_offset(path: str, offset: int):
+    tmp = path + ".offset.tmp"
+    with open(tmp, "wb") as f:
+        f.write(str(offset).encode())
+    os.replace(tmp, path + ".offset")
+
+
+class UsageEmitter:
+    """
+    Ships usage records to the `logs_buffer` Redis list off the request path.
+
+    `emit` only appends to an in-memory queue. A background task sends the
+    queue to Redis in pipelined batches, bumping each user's usage version
+    in the same round trip. If Redis fails, the batch is written to the disk
+    spool instead and replayed once Redis answers again, so a record is
+    only ever lost if the disk is.
+    """
+
+    def __init__(self, spool_dir: str = USAGE_SPOOL_DIR):
+        self.queue: Deque[Record] = deque()
+        self.wakeup = asyncio.Event()
+        self.spool = Spool(spool_dir)
+        self.flush_task: Optional[asyncio.Task] = None
+        self.replay_task: Optional[asyncio.Task] = None
+        self.spooled = 0
+        self.replayed = 0
+
+    def emit(self, record: dict):
+        """Queue one usage record. Never blocks and never raises on Redis trouble."""
+        self.queue.append((str(record["user_id"]), orjson.dumps(record)))
+        if len(self.queue) >= USAGE_FLUSH_BATCH:
+            self.wakeup.set()
+
+    def start(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+            self.replay_task = asyncio.create_task(self._replay_loop())
+
+    async def stop(self):
+        """Stop the background tasks and flush whatever is still queued."""
+        for task in (self.flush_task, self.replay_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.flush_task = self.replay_task = None
+        await self.flush()
+        await asyncio.to_thread(self.spool.seal)
+
+    async def _push(self, records: List[Record]):
+        redis = db.redis_client
+        if redis is None:
+            raise RedisError("Redis client not initialized")
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(LOGS_BUFFER_KEY, *(payload for _, payload in records))
+            # Invalidates the cached usage views of everyone in the batch. The
+            # rows reach Postgres only once the consumer has written them, so
+            # views rebuilt meanwhile are cached briefly, not for the full TTL.
+            for user_id in {user_id for user_id, _ in records}:
+                counter = USAGE_VERSION_KEY.format(user_id=user_id)
+                pipe.incr(counter)
+                pipe.set(settling_key(counter), 1, ex=RESPONSE_CACHE_SETTLE_SECONDS)
+            await pipe.execute()
+
+    async def flush(self):
+        """Send everything queued so far, spooling any batch Redis refuses."""
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(USAGE_FLUSH_BATCH, len(self.queue)))]
+            try:
+                await asyncio.wait_for(self._push(batch), timeout=USAGE_PUSH_TIMEOUT)
+            except asyncio.CancelledError:
+                # Put the batch back so stop() still delivers it
+                self.queue.extendleft(reversed(batch))
+                raise
+            except (RedisError, OSError, asyncio.TimeoutError) as e:
+                logger.warning("Spooling %d usage records, Redis unavailable: %s", len(batch), e)
+                await asyncio.to_thread(self.spool.append, batch)
+                self.spooled += len(batch)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if db.redis_client is None:
+                continue  # still warming up; keep the records queued
+            try:
+                await self.flush()
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.exception("Usage flush failed: %s", e)
+
+    async def _replay_file(self, path: str):
+        with open(path, "rb") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is on it
+            offset = await asyncio.to_thread(_read_offset, path)
+            while True:
+                records, next_offset = await asyncio.to_thread(
+                    _read_batch, path, offset, USAGE_FLUSH_BATCH
+                )
+                if records:
+                    await asyncio.wait_for(self._push(records), timeout=USAGE_PUSH_TIMEOUT)
+                    self.replayed += len(records)
+                if next_offset == offset:
+                    break
+                offset = next_offset
+                await asyncio.to_thread(_write_offset, path, offset)
+            os.remove(path)
+            if os.path.exists(path + ".offset"):
+                os.remove(path + ".offset")
+        logger.info("Replayed usage spool %s", path)
+
+    async def _replay_loop(self):
+        while True:
+            await asyncio.sleep(USAGE_SPOOL_RETRY_INTERVAL)
+            try:
+                if db.redis_client is None:
+                    continue
+                await asyncio.to_thread(self.spool.seal_orphans)
+                if self.spool.file is not None:
+                    await db.redis_client.ping()
+                    await asyncio.to_thread(self.spool.seal)
+                for path in self.spool.pending():
+                    await self._replay_file(path)
+            except (RedisError, OSError, asyncio.TimeoutError) as e:
+                logger.debug("Usage spool replay postponed: %s", e)
+            except Exception as e:                                                                   # pylint: disable=broad-exception-caught
+                logger.exception("Usage spool replay failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "spool_files": len(self.spool.pending()) + (1 if self.spool.file else 0),
+        }
+
+
+emitter = UsageEmitter()
@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from typing import Callable, Deque, Dict, Hashable, List, Set, Tuple
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+from backend.app.services import upstream
+from backend.app.services.chat_template import RenderedPrompt
+from backend.app.services.model_registry import registry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Hottest prefixes sent to a replica that (re)joins; 0 turns warmup off
+WARMUP_TOP_K = int(os.getenv("WARMUP_TOP_K", "20"))
+# Distinct prefixes tracked per worker; the tracker's error is at most requests / this
+WARMUP_TRACK = int(os.getenv("WARMUP_TRACK", "256"))
+# Counts are halved this often, so the ranking follows what is hot now
+WARMUP_HALF_LIFE = float(os.getenv("WARMUP_HALF_LIFE", "600"))
+# Prefixes shorter than this take no longer to prefill than to warm
+WARMUP_MIN_PREFIX_CHARS = int(os.getenv("WARMUP_MIN_PREFIX_CHARS", "512"))
+# Longer prefixes are not tracked, so the tracker's memory stays bounded
+WARMUP_MAX_PREFIX_CHARS = int(os.getenv("WARMUP_MAX_PREFIX_CHARS", "65536"))
+# Warmup requests in flight to one replica at a time
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+# Per warmup request
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "30"))
+# The replica takes normal traffic again after this long, warm or not
+WARMUP_MAX_SECONDS = float(os.getenv("WARMUP_MAX_SECONDS", "60"))
+
+
+class HeavyHitters:
+    """
+    Space-Saving counter of the most frequent keys in a stream.
+
+    At most `capacity` keys are counted. An unseen key takes the place
+    of the least counted one and inherits its count, which is kept as
+    the new key's error bound; any key seen more than total / capacity
+    times is guaranteed to be tracked. Each key carries a payload, built
+    only when the key enters the table.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # key -> [count, error]
+        self.counts: Dict[Hashable, List[float]] = {}
+        self.payloads: Dict[Hashable, object] = {}
+
+    def offer(self, key: Hashable, payload: Callable[[], object]):
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += 1
+            return
+        error = 0.0
+        if len(self.counts) >= self.capacity:
+            evicted = min(self.counts, key=lambda k: self.counts[k][0])
+            error = self.counts.pop(evicted)[0]
+            del self.payloads[evicted]
+        self.counts[key] = [error + 1, error]
+        self.payloads[key] = payload()
+
+    def decay(self):
+        for entry in self.counts.values():
+            entry[0] /= 2
+            entry[1] /= 2
+
+    def top(self, n: int) -> List[Tuple[Hashable, float, float]]:
+        """The `n` most counted keys as (key, count, error), most counted first."""
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in ranked[:n]]
+
+
+class PrefixWarmer:
+    """
+    Warms the prefix cache of replicas that just joined with the system
+    prompts most requests start with.
+
+    Every rendered chat prompt is counted by (model, hash of its system
+    and tool prefix). When the backend scraper sees a replica turn
+    healthy, or its engine restart, the replica is marked as warming, so
+    routing passes it over while other replicas are available, and the
+    top WARMUP_TOP_K prefixes of the models it serves are each sent as a
+    one-token completion. vLLM's automatic prefix caching keeps their KV
+    blocks, so the first real requests skip the prefill of the shared
+    prefix. Warming ends when the requests are done, or after
+    WARMUP_MAX_SECONDS.
+    """
+
+    def __init__(self):
+        self.tracker = HeavyHitters(WARMUP_TRACK)
+        self.decayed_at = time.monotonic()
+        self.observed = 0
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.runs = 0
+        self.warmed = 0
+        self.failed = 0
+        self.recent: Deque[dict] = deque(maxlen=20)
+
+    def observe(self, model: str, rendered: RenderedPrompt):
+        """Count a rendered prompt's prefix towards the hot set of `model`."""
+        if not WARMUP_TOP_K:
+            return
+        if not WARMUP_MIN_PREFIX_CHARS <= rendered.prefix_len <= WARMUP_MAX_PREFIX_CHARS:
+            return
+        self.observed += 1
+        now = time.monotonic()
+        if now - self.decayed_at >= WARMUP_HALF_LIFE:
+            self.decayed_at = now
+            self.tracker.decay()
+        self.tracker.offer(
+            (model, rendered.prefix_hash), lambda: rendered.prompt[: rendered.prefix_len]
+        )
+
+    def hot(self, models: Set[str]) -> List[Tuple[str, str]]:
+        """(model, prefix) of the hottest prefixes of `models`."""
+        return [
+            (key[0], self.tracker.payloads[key])
+            for key, _, _ in self.tracker.top(len(self.tracker.counts))
+            if key[0] in models
+        ][:WARMUP_TOP_K]
+
+    def on_ready(self, backend: upstream.Backend):
+        """backend_metrics hook: a replica came up or restarted with an empty cache."""
+        if backend.url in self.tasks:
+            return
+        prefixes = self.hot(set(registry.models_on(backend.url)))
+        if not prefixes:
+            return
+        backend.warming = True
+        task = asyncio.create_task(self._warm(backend, prefixes))
+        self.tasks[backend.url] = task
+        task.add_done_callback(lambda _: self.tasks.pop(backend.url, None))
+
+    async def _warm(self, backend: upstream.Backend, prefixes: List[Tuple[str, str]]):
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+        results: List[bool] = []
+
+        async def send(model: str, prefix: str):
+            async with semaphore:
+                results.append(await self._send(backend, model, prefix))
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(send(model, prefix) for model, prefix in prefixes)),
+                timeout=WARMUP_MAX_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Warmup of %s cut short after %.0fs", backend.base_url, WARMUP_MAX_SECONDS)
+        finally:
+            backend.warming = False
+            warmed = sum(results)
+            self.runs += 1
+            self.warmed += warmed
+            self.failed += len(results) - warmed
+            self.recent.append({
+                "backend": backend.url,
+                "prefixes": len(prefixes),
+                "warmed": warmed,
+                "seconds": round(time.perf_counter() - started, 3),
+                "at": int(time.time()),
+            })
+        logger.info(
+            "Warmed %d/%d hot prefixes on %s in %.1fs",
+            warmed, len(prefixes), backend.base_url, time.perf_counter() - started,
+        )
+
+    async def _send(self, backend: upstream.Backend, model: str, prefix: str) -> bool:
+        payload = {
+            "model": model,
+            "prompt": prefix,
+            "max_tokens": 1,
+            "temperature": 0,
+            # The rendered template already starts with the BOS token
+            "add_special_tokens": False,
+        }
+        try:
+            response = await upstream.get_client().post(
+                backend.url,
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=WARMUP_TIMEOUT,
+            )
+            if response.status_code != 200:
+                logger.warning(
+                    "Warmup request to %s failed: HTTP %d", backend.base_url, response.status_code
+                )
+                return False
+            return True
+        except httpx.HTTPError as e:
+            logger.warning("Warmup request to %s failed: %r", backend.base_url, e)
+            return False
+
+    async def stop(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "top_k": WARMUP_TOP_K,
+            "observed": self.observed,
+            "tracked": len(self.tracker.counts),
+            "hot": [
+                {"model": key[0], "prefix_hash": key[1], "count": round(count, 1),
+                 "error": round(error, 1), "chars": len(self.tracker.payloads[key])}
+                for key, count, error in self.tracker.top(WARMUP_TOP_K)
+            ],
+            "warming": sorted(self.tasks),
+            "runs": self.runs,
+            "warmed": self.warmed,
+            "failed": self.failed,
+            "recent": list(self.recent),
+        }
+
+
+warmer = PrefixWarmer()
@@ -0,0 +1,57 @@
+-- Hourly and daily usage rollups behind /usage/timeseries.
+-- Requires PostgreSQL 14+ (date_bin).
+
+-- Request latency, recorded by the gateway with every usage log
+ALTER TABLE logs ADD COLUMN IF NOT EXISTS latency_ms real;
+CREATE INDEX IF NOT EXISTS logs_timestamp_idx ON logs (timestamp);
+
+-- Element-wise sum of latency histograms, so buckets can be merged
+CREATE OR REPLACE FUNCTION hist_add(a integer[], b integer[]) RETURNS integer[]
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT CASE
+        WHEN a IS NULL THEN b
+        WHEN b IS NULL THEN a
+        ELSE ARRAY(
+            SELECT COALESCE(x, 0) + COALESCE(y, 0)
+            FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+            ORDER BY i
+        )
+    END
+$$;
+
+CREATE OR REPLACE AGGREGATE hist_sum(integer[]) (
+    SFUNC = hist_add,
+    STYPE = integer[],
+    COMBINEFUNC = hist_add,
+    PARALLEL = SAFE
+);
+
+-- latency_hist[i] counts requests in the i-th bin of
+-- backend.app.services.rollups.LATENCY_BOUNDS_MS
+CREATE TABLE IF NOT EXISTS usage_rollup_hourly (
+    user_id      text        NOT NULL,
+    model        text        NOT NULL,
+    bucket       timestamptz NOT NULL,
+    requests     bigint      NOT NULL,
+    total_tokens bigint      NOT NULL,
+    spending     numeric     NOT NULL,
+    latency_hist integer[]   NOT NULL,
+    PRIMARY KEY (user_id, bucket, model)
+);
+
+CREATE TABLE IF NOT EXISTS usage_rollup_daily (
+    user_id      text        NOT NULL,
+    model        text        NOT NULL,
+    bucket       timestamptz NOT NULL,
+    requests     bigint      NOT NULL,
+    total_tokens bigint      NOT NULL,
+    spending     numeric     NOT NULL,
+    latency_hist integer[]   NOT NULL,
+    PRIMARY KEY (user_id, bucket, model)
+);
+
+-- How far the logs have been rolled up
+CREATE TABLE IF NOT EXISTS usage_rollup_state (
+    name         text        PRIMARY KEY,
+    refreshed_to timestamptz NOT NULL
+);
@@ -0,0 +1,80 @@
+-- Turn logs into a table range-partitioned by month on "timestamp".
+-- Later partitions are created (and old ones archived and dropped) by
+-- backend.app.services.partitions; partitions are named logs_YYYYMM, or
+-- logs_YYYYMMDD when LOGS_PARTITION_INTERVAL=day.
+--
+-- Existing rows are copied into the new partitions inside this migration,
+-- so run it in a maintenance window on a large table.
+
+-- Month arithmetic below must not shift partition bounds across DST changes
+SET LOCAL TIME ZONE 'UTC';
+
+DO $$
+DECLARE
+    part_start timestamptz;
+    horizon    timestamptz;
+    col        record;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'logs'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE logs RENAME TO logs_unpartitioned;
+    -- Indexes are recreated below: on a partitioned table a unique index
+    -- must include the partition key, so the log_id key cannot be copied
+    CREATE TABLE logs (LIKE logs_unpartitioned INCLUDING ALL EXCLUDING INDEXES)
+        PARTITION BY RANGE (timestamp);
+
+    part_start := date_trunc('month', COALESCE((SELECT MIN(timestamp) FROM logs_unpartitioned), NOW()), 'UTC');
+    horizon := date_trunc('month', NOW(), 'UTC') + INTERVAL '3 months';
+    WHILE part_start < horizon LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF logs FOR VALUES FROM (%L) TO (%L)',
+            'logs_' || to_char(part_start AT TIME ZONE 'UTC', 'YYYYMM'),
+            part_start,
+            part_start + INTERVAL '1 month'
+        );
+        part_start := part_start + INTERVAL '1 month';
+    END LOOP;
+
+    INSERT INTO logs OVERRIDING SYSTEM VALUE SELECT * FROM logs_unpartitioned;
+
+    -- serial columns: hand their sequences over before the old table goes
+    FOR col IN
+        SELECT seq.relname AS sequence_name, att.attname AS column_name
+        FROM pg_depend dep
+        JOIN pg_class seq ON seq.oid = dep.objid AND seq.relkind = 'S'
+        JOIN pg_attribute att ON att.attrelid = dep.refobjid AND att.attnum = dep.refobjsubid
+        WHERE dep.refobjid = 'logs_unpartitioned'::regclass AND dep.deptype = 'a'
+    LOOP
+        EXECUTE format('ALTER SEQUENCE %I OWNED BY logs.%I', col.sequence_name, col.column_name);
+    END LOOP;
+
+    -- identity columns got fresh sequences: continue after the copied ids
+    FOR col IN
+        SELECT attname AS column_name
+        FROM pg_attribute
+        WHERE attrelid = 'logs'::regclass AND attidentity <> ''
+    LOOP
+        EXECUTE format(
+            'SELECT setval(pg_get_serial_sequence(''logs'', %L), COALESCE(MAX(%I), 0) + 1, false) FROM logs',
+            col.column_name, col.column_name
+        );
+    END LOOP;
+
+    DROP TABLE logs_unpartitioned;
+END
+$$;
+
+-- Replaces the primary key on log_id: ON CONFLICT (log_id, timestamp)
+-- keeps re-sent usage records (the emitter's spool replay) from doubling up
+CREATE UNIQUE INDEX IF NOT EXISTS logs_log_id_timestamp_key ON logs (log_id, timestamp);
+
+-- Catches rows outside the created range (partition maintenance behind,
+-- or a skewed clock) instead of failing the insert; the maintenance job
+-- moves them into their partition once it creates it
+CREATE TABLE IF NOT EXISTS logs_default PARTITION OF logs DEFAULT;
+
+-- Created on the parent, so every partition gets its own small index
+CREATE INDEX IF NOT EXISTS logs_timestamp_idx ON logs (timestamp);
+CREATE INDEX IF NOT EXISTS logs_user_id_timestamp_idx ON logs (user_id, timestamp);
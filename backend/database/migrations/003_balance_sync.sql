@@ -0,0 +1,41 @@
+-- Write-behind balance sync (backend.app.services.balances).
+-- Redis holds the live balance; the gateway copies it into users.balance
+-- in batches, tagged with the Redis-side version of the balance so an
+-- older snapshot never overwrites a newer one.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS balance_version bigint NOT NULL DEFAULT 0;
+
+-- Every payment credited to a balance, once per payment
+CREATE TABLE IF NOT EXISTS balance_credits (
+    payment_id text        PRIMARY KEY,
+    user_id    text        NOT NULL,
+    amount     numeric     NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS balance_credits_user_id_idx ON balance_credits (user_id);
+
+-- Ledger identity checked by the gateway for settled accounts:
+--   balance = opening_balance + credits - spending
+-- Existing balances are taken as correct, so the opening balance is
+-- whatever makes the identity hold today. Spending is summed the way the
+-- check does (queries.BALANCE_LEDGER): from the hourly rollups up to their
+-- refresh point, and from the raw logs after it, whose older partitions
+-- may already have been archived and dropped.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS opening_balance numeric;
+WITH rolled AS (
+    SELECT COALESCE(
+        (SELECT refreshed_to FROM usage_rollup_state WHERE name = 'usage'),
+        '-infinity'::timestamptz
+    ) AS refreshed_to
+)
+UPDATE users AS u
+SET opening_balance = u.balance
+    + COALESCE((
+        SELECT SUM(h.spending) FROM usage_rollup_hourly AS h, rolled
+        WHERE h.user_id = u.user_id AND h.bucket < rolled.refreshed_to
+    ), 0)
+    + COALESCE((
+        SELECT SUM(l.spending) FROM logs AS l, rolled
+        WHERE l.user_id = u.user_id AND l.timestamp >= rolled.refreshed_to
+    ), 0)
+WHERE u.opening_balance IS NULL;
@@ -0,0 +1,110 @@
+# Fixed hot queries, sent as server-side prepared statements by PsqlSession.
+
+USER_PROFILE = """
+SELECT user_id, user_name, llm_api_token, bearer_token, fname, lname, email, balance
+FROM users WHERE user_id = %s
+"""
+
+USER_API_KEY = """
+SELECT llm_api_token, fname, user_name
+FROM users
+WHERE user_id = %s
+"""
+
+USER_BALANCE = """
+SELECT balance
+FROM users
+WHERE user_id = %s
+"""
+
+USER_TOKEN_AND_BALANCE = """
+SELECT llm_api_token, balance, balance_version
+FROM users
+WHERE user_id = %s
+"""
+
+USER_BY_EMAIL = """
+SELECT user_id, llm_api_token, bearer_token
+FROM users
+WHERE email = %s
+"""
+
+# Write-behind balance flush; a snapshot only lands if it is newer than
+# the one already stored
+BALANCE_SYNC = """
+UPDATE users AS u
+SET balance = v.balance, balance_version = v.version
+FROM unnest(%s::text[], %s::numeric[], %s::bigint[]) AS v(user_id, balance, version)
+WHERE u.user_id = v.user_id AND u.balance_version < v.version
+"""
+
+# Balance next to what the ledger says it should be: opening balance plus
+# credits minus spending. Spending comes from the hourly rollups up to
+# their refresh point and from the raw logs after it.
+BALANCE_LEDGER = """
+WITH rolled AS (
+    SELECT COALESCE(
+        (SELECT refreshed_to FROM usage_rollup_state WHERE name = 'usage'),
+        '-infinity'::timestamptz
+    ) AS refreshed_to
+)
+SELECT
+    u.user_id,
+    u.balance,
+    u.opening_balance
+    + COALESCE((SELECT SUM(c.amount) FROM balance_credits AS c WHERE c.user_id = u.user_id), 0)
+    - COALESCE((
+        SELECT SUM(h.spending) FROM usage_rollup_hourly AS h, rolled
+        WHERE h.user_id = u.user_id AND h.bucket < rolled.refreshed_to
+    ), 0)
+    - COALESCE((
+        SELECT SUM(l.spending) FROM logs AS l, rolled
+        WHERE l.user_id = u.user_id AND l.timestamp >= rolled.refreshed_to
+    ), 0)
+FROM users AS u
+WHERE u.user_id = ANY(%s) AND u.opening_balance IS NOT NULL
+"""
+
+USAGE_LAST_MONTH = """
+SELECT
+    model,
+    SUM(total_tokens) AS total_tokens,
+    SUM(spending) AS total_spending
+FROM logs
+WHERE user_id = %s
+    AND timestamp >= NOW() - INTERVAL '1 month'
+GROUP BY model
+ORDER BY total_tokens DESC;
+"""
+
+# Dense, downsampled usage series from a rollup table. Buckets of width
+# %(step)s start at %(start)s; empty ones come back as zeros.
+_USAGE_TIMESERIES = """
+WITH agg AS (
+    SELECT
+        date_bin(%(step)s, bucket, %(start)s) AS bucket,
+        SUM(requests) AS requests,
+        SUM(total_tokens) AS total_tokens,
+        SUM(spending) AS spending,
+        hist_sum(latency_hist) AS latency_hist
+    FROM {table}
+    WHERE user_id = %(user_id)s
+        AND bucket >= %(start)s AND bucket < %(end)s
+        AND (%(model)s::text IS NULL OR model = %(model)s::text)
+    GROUP BY 1
+)
+SELECT
+    series.bucket,
+    COALESCE(agg.requests, 0),
+    COALESCE(agg.total_tokens, 0),
+    COALESCE(agg.spending, 0),
+    agg.latency_hist
+FROM generate_series(%(start)s, %(end)s - %(step)s, %(step)s) AS series(bucket)
+LEFT JOIN agg USING (bucket)
+ORDER BY series.bucket;
+"""
+
+USAGE_TIMESERIES = {
+    "hour": _USAGE_TIMESERIES.format(table="usage_rollup_hourly"),
+    "day": _USAGE_TIMESERIES.format(table="usage_rollup_daily"),
+}
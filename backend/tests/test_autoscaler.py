@@ -0,0 +1,108 @@
+import math
+
+from backend.app.services.autoscaler import (
+    AutoscalerConfig,
+    LoadObservation,
+    ScalerState,
+    _dump_state,
+    _load_state,
+    compute_desired_replicas,
+)
+
+# One replica does 1000 tokens/s at full utilization, or carries 10 queued requests
+CONFIG = AutoscalerConfig(
+    min_replicas=1,
+    max_replicas=8,
+    target_queue_per_replica=10.0,
+    target_utilization=1.0,
+    default_capacity_tps=1000.0,
+    tolerance=0.1,
+    startup_seconds=240.0,
+    scale_down_stabilization=300.0,
+    scale_down_cooldown=300.0,
+    scale_down_step=1,
+)
+
+
+def run(trace, desired=1, config=CONFIG):
+    """Feed (timestamp, demand_tps, queue_depth) points; the recommendation after each."""
+    state = ScalerState(desired=desired)
+    recommendations = []
+    for timestamp, demand_tps, queue_depth in trace:
+        observation = LoadObservation(
+            timestamp=timestamp, queue_depth=queue_depth, demand_tps=demand_tps, ready_replicas=0
+        )
+        state = compute_desired_replicas(observation, state, config)
+        recommendations.append(state.desired)
+    return recommendations
+
+
+def test_ramp_up_follows_demand():
+    trace = [(t * 15.0, 500.0 + 250.0 * t, 0.0) for t in range(13)]
+    recommendations = run(trace)
+    assert recommendations == sorted(recommendations)
+    # 500 .. 3500 tokens/s at 1000 per replica
+    assert recommendations[0] == 1
+    assert recommendations[-1] == 4
+
+
+def test_ramp_up_is_capped_at_max_replicas():
+    assert run([(0.0, 50_000.0, 0.0)]) == [8]
+
+
+def test_small_fluctuations_inside_tolerance_are_ignored():
+    trace = [(t * 15.0, 2000.0 + (150.0 if t % 2 else -150.0), 0.0) for t in range(40)]
+    assert set(run(trace, desired=2)) == {2}
+
+
+def test_spike_scales_up_once_while_replicas_start():
+    # A queue spike needs 5 replicas; it is seen again and again while they boot
+    trace = [(t * 15.0, 1000.0, 50.0) for t in range(10)]
+    recommendations = run(trace, desired=2)
+    assert recommendations == [5] * 10
+
+
+def test_scale_down_waits_for_the_stabilization_window():
+    trace = [(t * 15.0, 1000.0, 0.0) for t in range(30)]
+    recommendations = run(trace, desired=4)
+    # Low since t=0, first scale-down once 300s have passed
+    assert recommendations[:20] == [4] * 20
+    assert recommendations[20] == 3
+
+
+def test_scale_downs_respect_the_cooldown():
+    trace = [(t * 15.0, 500.0, 0.0) for t in range(80)]
+    recommendations = run(trace, desired=4)
+    changes = [i * 15.0 for i in range(1, len(recommendations))
+               if recommendations[i] != recommendations[i - 1]]
+    assert all(later - earlier >= CONFIG.scale_down_cooldown
+               for earlier, later in zip(changes, changes[1:]))
+    # One replica at a time
+    assert all(a - b in (0, 1) for a, b in zip(recommendations, recommendations[1:]))
+
+
+def test_no_scale_down_while_new_replicas_warm_up():
+    config = AutoscalerConfig(**{**CONFIG.__dict__, "startup_seconds": 600.0})
+    # Spike to 6 replicas, then the load drops right away
+    trace = [(0.0, 6000.0, 0.0)] + [(t * 15.0, 1000.0, 0.0) for t in range(1, 60)]
+    recommendations = run(trace, config=config)
+    assert recommendations[0] == 6
+    # Stable after 315s, but the new replicas have not had 600s to come up
+    first_down = next(i for i, desired in enumerate(recommendations) if desired < 6)
+    assert first_down * 15.0 >= config.startup_seconds
+
+
+def test_scale_down_bounded_by_recent_peak():
+    # A brief burst inside the window keeps the recommendation up
+    trace = [(t * 15.0, 4000.0 if t == 15 else 500.0, 0.0) for t in range(30)]
+    recommendations = run(trace, desired=4)
+    assert set(recommendations) == {4}
+
+
+def test_state_survives_a_round_trip_through_redis():
+    state = ScalerState(desired=3, last_scale_up=120.0, recent=((100.0, 2.5), (115.0, 3.1)))
+    loaded, capacity = _load_state(_dump_state(state, 1234.5).decode())
+    assert loaded == state
+    assert capacity == 1234.5
+    assert math.isinf(loaded.last_scale_down)
+    assert _load_state(None) == (None, None)
@@ -0,0 +1,221 @@
+import asyncio
+import os
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+from psycopg_pool import AsyncConnectionPool
+
+from backend.app.routers import payments
+from backend.app.services import balances
+from backend.app.services.balances import (
+    BALANCE_CHECK_KEY,
+    BALANCE_DIRTY_KEY,
+    BALANCE_SYNCING_KEY,
+    BalanceSync,
+)
+from backend.app.services.response_cache import BILLING_VERSION_KEY
+from backend.database import db, queries
+
+fakeredis = pytest.importorskip("fakeredis")
+# fakeredis runs the Lua scripts through lupa
+pytest.importorskip("lupa")
+
+# The Postgres tests need a scratch database; they only create temporary tables
+TEST_PSQL_CONN_STRING = os.getenv("TEST_PSQL_CONN_STRING")
+needs_postgres = pytest.mark.skipif(not TEST_PSQL_CONN_STRING, reason="TEST_PSQL_CONN_STRING not set")
+
+SCHEMA = """
+CREATE TEMP TABLE users (
+    user_id         text    PRIMARY KEY,
+    llm_api_token   text,
+    balance         numeric,
+    balance_version bigint  NOT NULL DEFAULT 0
+);
+CREATE TEMP TABLE balance_credits (
+    payment_id text        PRIMARY KEY,
+    user_id    text        NOT NULL,
+    amount     numeric     NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT NOW()
+);
+"""
+
+
+def run(scenario, monkeypatch, postgres=False):
+    """Run `scenario(redis, pool)` on a fresh fake Redis and, if asked, a one-connection pool."""
+    async def main():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        monkeypatch.setattr(db, "redis_client", redis)
+        if not postgres:
+            return await scenario(redis, None)
+        # A single connection, so every session sees the temporary tables
+        pool = AsyncConnectionPool(TEST_PSQL_CONN_STRING, min_size=1, max_size=1, open=False)
+        await pool.open(wait=True)
+        try:
+            async with pool.connection() as conn:
+                await conn.execute(SCHEMA)
+            monkeypatch.setattr(db, "psql_pool", pool)
+            return await scenario(redis, pool)
+        finally:
+            await pool.close()
+
+    return asyncio.run(main())
+
+
+class _RecordingWriter:
+    """Stands in for the Postgres writer: records each BALANCE_SYNC batch."""
+
+    def __init__(self, fail_first: bool = False):
+        self.batches = []
+        self.fail_first = fail_first
+
+    async def execute(self, query, params):
+        assert query == queries.BALANCE_SYNC
+        if self.fail_first:
+            self.fail_first = False
+            raise ConnectionError("connection lost")
+        user_ids, amounts, versions = params
+        self.batches.append(dict(zip(user_ids, zip(amounts, versions))))
+        return len(user_ids)
+
+
+async def _seed(redis, token, user_id, balance):
+    await redis.hset(f"llm_api_token:{token}", mapping={"user_id": user_id, "balance": balance, "version": 0})
+
+
+def test_unknown_tokens_are_not_charged(monkeypatch):
+    async def scenario(redis, _):
+        assert await balances.debit("nobody", 1.0) is None
+        assert not await redis.exists("llm_api_token:nobody")
+        assert not await redis.exists(BALANCE_DIRTY_KEY)
+
+    run(scenario, monkeypatch)
+
+
+def test_debit_bumps_the_version_and_marks_the_token_dirty(monkeypatch):
+    async def scenario(redis, _):
+        await _seed(redis, "t1", "u1", "10")
+        assert await balances.debit("t1", 0.25) == Decimal("9.75")
+        assert await balances.debit("t1", 0.25) == Decimal("9.5")
+        assert await redis.hget("llm_api_token:t1", "version") == "2"
+        assert await redis.smembers(BALANCE_DIRTY_KEY) == {"t1"}
+
+    run(scenario, monkeypatch)
+
+
+def test_a_payment_is_credited_once(monkeypatch):
+    async def scenario(redis, _):
+        # No balance in Redis yet: seeded from the Postgres row
+        seed = ("u1", Decimal("5"), 3)
+        assert await balances.credit(redis, "t1", 10.0, "cs_1", seed) == (Decimal("15"), 4)
+        # Stripe retrying the webhook
+        assert await balances.credit(redis, "t1", 10.0, "cs_1", seed) == (Decimal("15"), 4)
+        assert await balances.credit(redis, "t1", 2.5, "cs_2", seed) == (Decimal("17.5"), 5)
+        assert await redis.hget("llm_api_token:t1", "user_id") == "u1"
+
+    run(scenario, monkeypatch)
+
+
+def test_sync_flushes_the_dirty_set(monkeypatch):
+    writer = _RecordingWriter()
+
+    async def get_writer():
+        return writer
+
+    monkeypatch.setattr(db, "psql_pool", object())
+    monkeypatch.setattr(db, "get_psql_writer", get_writer)
+
+    async def scenario(redis, _):
+        await _seed(redis, "t1", "u1", "10")
+        await _seed(redis, "t2", "u2", "10")
+        await balances.debit("t1", 1.0)
+        await balances.debit("t2", 2.0)
+        await BalanceSync().sync()
+
+        assert writer.batches == [{"u1": (Decimal("9"), 1), "u2": (Decimal("8"), 1)}]
+        assert not await redis.exists(BALANCE_DIRTY_KEY, BALANCE_SYNCING_KEY)
+        assert set(await redis.zrange(BALANCE_CHECK_KEY, 0, -1)) == {"u1", "u2"}
+        assert await redis.get(BILLING_VERSION_KEY.format(user_id="u1")) == "1"
+
+    run(scenario, monkeypatch)
+
+
+def test_an_interrupted_flush_is_replayed_before_new_changes(monkeypatch):
+    writer = _RecordingWriter(fail_first=True)
+
+    async def get_writer():
+        return writer
+
+    monkeypatch.setattr(db, "psql_pool", object())
+    monkeypatch.setattr(db, "get_psql_writer", get_writer)
+
+    async def scenario(redis, _):
+        sync = BalanceSync()
+        await _seed(redis, "t1", "u1", "10")
+        await balances.debit("t1", 1.0)
+        with pytest.raises(ConnectionError):
+            await sync.sync()
+        # The crashed flush left its tokens behind; a newer change waits its turn
+        assert await redis.smembers(BALANCE_SYNCING_KEY) == {"t1"}
+        await _seed(redis, "t2", "u2", "10")
+        await balances.debit("t2", 2.0)
+
+        await sync.sync()
+        assert writer.batches == [{"u1": (Decimal("9"), 1)}]
+        assert await redis.smembers(BALANCE_DIRTY_KEY) == {"t2"}
+
+        await sync.sync()
+        assert writer.batches[1] == {"u2": (Decimal("8"), 1)}
+        assert not await redis.exists(BALANCE_DIRTY_KEY, BALANCE_SYNCING_KEY)
+
+    run(scenario, monkeypatch)
+
+
+@needs_postgres
+def test_balance_sync_only_takes_newer_snapshots(monkeypatch):
+    async def scenario(_, pool):
+        writer = db.PsqlSession(read_only=False)
+        async with pool.connection() as conn:
+            await conn.execute("INSERT INTO users VALUES ('u1', 't1', 10, 5)")
+
+        stale = await writer.execute(queries.BALANCE_SYNC, (["u1"], [Decimal("7")], [4]))
+        replay = await writer.execute(queries.BALANCE_SYNC, (["u1"], [Decimal("7")], [5]))
+        newer = await writer.execute(queries.BALANCE_SYNC, (["u1"], [Decimal("8")], [6]))
+        assert (stale, replay, newer) == (0, 0, 1)
+        assert await writer.fetchone("SELECT balance, balance_version FROM users") == (Decimal("8"), 6)
+
+    run(scenario, monkeypatch, postgres=True)
+
+
+@needs_postgres
+def test_a_replayed_webhook_credits_nothing(monkeypatch):
+    event = {
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": "cs_1", "amount_total": 1000, "metadata": {"user_id": "u1"}}},
+    }
+    stripe = SimpleNamespace(
+        Webhook=SimpleNamespace(construct_event=lambda payload, signature, secret: event),
+        error=SimpleNamespace(SignatureVerificationError=ValueError),
+    )
+    monkeypatch.setattr(payments, "get_stripe", lambda: stripe)
+    monkeypatch.setenv("STRIPE_ENDPOINT_SECRET", "whsec_test")
+
+    async def body():
+        return b"{}"
+
+    request = SimpleNamespace(body=body, headers={"Stripe-Signature": "t=1,v1=sig"})
+
+    async def scenario(redis, _):
+        writer = db.PsqlSession(read_only=False)
+        async with db.psql_pool.connection() as conn:
+            await conn.execute("INSERT INTO users VALUES ('u1', 't1', 5, 0)")
+
+        first = await payments.stripe_webhook(request, redis, writer)
+        replay = await payments.stripe_webhook(request, redis, writer)
+        assert first["message"].startswith("Payment of 10.0 USD")
+        assert replay["message"] == "Payment already credited"
+        assert await writer.fetchone("SELECT balance FROM users") == (Decimal("15"),)
+        assert await writer.fetchone("SELECT COUNT(*) FROM balance_credits") == (1,)
+        assert await redis.hget("llm_api_token:t1", "balance") == "15"
+
+    run(scenario, monkeypatch, postgres=True)
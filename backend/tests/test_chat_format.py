@@ -0,0 +1,138 @@
+import orjson
+
+from backend.app.services.chat_format import (
+    ChatStreamTranslator,
+    completion_to_chat,
+    parse_tool_calls,
+)
+
+
+def _event(text, finish_reason=None):
+    return b"data: " + orjson.dumps({
+        "id": "cmpl-1", "object": "text_completion", "created": 1, "model": "m",
+        "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": finish_reason}],
+    }) + b"\n\n"
+
+
+def test_completion_body_becomes_a_chat_completion():
+    body = orjson.dumps({
+        "id": "cmpl-abc", "object": "text_completion", "created": 1, "model": "m",
+        "choices": [{"index": 0, "text": "Hello", "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+    })
+    chat = orjson.loads(completion_to_chat(body))
+    assert chat["object"] == "chat.completion"
+    assert chat["id"] == "chatcmpl-abc"
+    assert chat["choices"][0]["message"] == {"role": "assistant", "content": "Hello"}
+    assert chat["usage"]["total_tokens"] == 4
+
+
+def test_error_bodies_pass_through():
+    body = b'{"object": "error", "message": "bad request"}'
+    assert completion_to_chat(body) == body
+
+
+def test_stream_split_mid_event_is_translated_whole():
+    stream = _event("Hi") + _event(" there", "stop") + b"data: [DONE]\n\n"
+    translator = ChatStreamTranslator()
+    out = b"".join(translator.feed(stream[i:i + 17]) for i in range(0, len(stream), 17))
+    out += translator.flush()
+
+    events = [event for event in out.split(b"\n\n") if event]
+    assert events[-1] == b"data: [DONE]"
+    first, second = (orjson.loads(event[6:]) for event in events[:2])
+    assert first["object"] == "chat.completion.chunk"
+    assert first["choices"][0]["delta"] == {"role": "assistant", "content": "Hi"}
+    assert second["choices"][0]["delta"] == {"content": " there"}
+    assert second["choices"][0]["finish_reason"] == "stop"
+
+
+def _stream(translator, *events):
+    out = b"".join(translator.feed(event) for event in events) + translator.flush()
+    events = [event for event in out.split(b"\n\n") if event and event != b"data: [DONE]"]
+    return [orjson.loads(event[6:]) for event in events]
+
+
+def test_tool_calls_are_parsed_in_each_template_syntax():
+    text = '{"name": "f", "parameters": {"x": 1}}; {"name": "g"}'
+    content, calls = parse_tool_calls(text, "llama3")
+    assert content is None
+    assert [call["function"] for call in calls] == [
+        {"name": "f", "arguments": '{"x":1}'}, {"name": "g", "arguments": "{}"},
+    ]
+    assert all(call["type"] == "function" and call["id"].startswith("call_") for call in calls)
+
+    text = 'Checking.\n<tool_call>\n{"name": "f", "arguments": {"x": 1}}\n</tool_call>'
+    content, calls = parse_tool_calls(text, "chatml")
+    assert content == "Checking."
+    assert calls[0]["function"] == {"name": "f", "arguments": '{"x":1}'}
+
+
+def test_text_that_is_not_a_call_stays_content():
+    for text, template in [
+        ("The answer is 4.", "llama3"),
+        ('{"name": "f"} and then some', "llama3"),
+        ('{"arguments": {}}', "llama3"),
+        ("<tool_call>\nnot json\n</tool_call>", "chatml"),
+        ('<tool_call>{"name": "f"}</tool_call> trailing text', "chatml"),
+    ]:
+        assert parse_tool_calls(text, template) == (text, [])
+
+
+def test_completion_body_with_a_call_has_tool_calls():
+    body = orjson.dumps({
+        "id": "cmpl-abc", "object": "text_completion", "created": 1, "model": "m",
+        "choices": [
+            {"index": 0, "text": '{"name": "f", "parameters": {}}', "finish_reason": "stop"}
+        ],
+    })
+    choice = orjson.loads(completion_to_chat(body, "llama3"))["choices"][0]
+    assert choice["finish_reason"] == "tool_calls"
+    assert choice["message"]["content"] is None
+    assert choice["message"]["tool_calls"][0]["function"] == {"name": "f", "arguments": "{}"}
+    # Without tools offered, the same text is plain content
+    message = orjson.loads(completion_to_chat(body))["choices"][0]["message"]
+    assert message["content"].startswith("{") and "tool_calls" not in message
+
+
+def test_streamed_llama_call_is_sent_as_one_tool_calls_delta():
+    chunks = _stream(
+        ChatStreamTranslator("llama3"),
+        _event(" "),
+        _event('{"name": "f", '),
+        _event('"parameters": {"x": 1}}'),
+        _event("", "stop"),
+        b"data: [DONE]\n\n",
+    )
+    assert len(chunks) == 1
+    choice = chunks[0]["choices"][0]
+    assert choice["finish_reason"] == "tool_calls"
+    assert choice["delta"]["role"] == "assistant" and choice["delta"]["content"] is None
+    call = choice["delta"]["tool_calls"][0]
+    assert call["index"] == 0 and call["function"] == {"name": "f", "arguments": '{"x":1}'}
+
+
+def test_streamed_plain_llama_text_is_not_held_back():
+    translator = ChatStreamTranslator("llama3")
+    first = orjson.loads(translator.feed(_event("Hello"))[6:])
+    assert first["choices"][0]["delta"] == {"role": "assistant", "content": "Hello"}
+
+
+def test_streamed_chatml_text_then_call():
+    chunks = _stream(
+        ChatStreamTranslator("chatml"),
+        _event("Let me check.<tool"), _event('_call>{"name": "f", "arguments": {}}'),
+        _event("</tool_call>", "stop"),
+    )
+    deltas = [chunk["choices"][0]["delta"] for chunk in chunks]
+    assert deltas[0] == {"role": "assistant", "content": "Let me check."}
+    assert deltas[-1]["tool_calls"][0]["function"] == {"name": "f", "arguments": "{}"}
+    assert chunks[-1]["choices"][0]["finish_reason"] == "tool_calls"
+
+
+def test_streamed_text_that_fails_to_parse_is_sent_as_content():
+    chunks = _stream(ChatStreamTranslator("llama3"), _event('{"not": '), _event("a call", "length"))
+    choice = chunks[-1]["choices"][0]
+    assert choice["delta"]["content"] == '{"not": a call'
+    assert choice["finish_reason"] == "length"
+    assert "tool_calls" not in choice["delta"]
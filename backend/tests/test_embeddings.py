@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from backend.app.services import embeddings
+from backend.app.services.embeddings import (
+    _ENTRY_OVERHEAD,
+    EmbeddingBatcher,
+    VectorCache,
+    apportion,
+    pack,
+)
+
+
+def _entry(floats):
+    return (1, pack([0.5] * floats))
+
+
+def test_apportioned_tokens_add_up_to_the_batch_usage():
+    assert apportion(10, [1, 1, 1]) == [4, 3, 3]
+    assert apportion(7, [3, 0, 5]) == [3, 0, 4]
+    assert apportion(5, [0, 0]) == [3, 2]
+    for total in range(50):
+        assert sum(apportion(total, [7, 13, 1, 29])) == total
+
+
+def test_cache_counts_vector_bytes_and_overhead():
+    cache = VectorCache(max_bytes=10_000)
+    cache.put(b"a", _entry(100))
+    assert cache.size == 400 + _ENTRY_OVERHEAD
+    # Replacing an entry does not count it twice
+    cache.put(b"a", _entry(200))
+    assert cache.size == 800 + _ENTRY_OVERHEAD
+    assert cache.stats()["entries"] == 1
+
+
+def test_cache_evicts_least_recently_used_first():
+    cost = 400 + _ENTRY_OVERHEAD
+    cache = VectorCache(max_bytes=3 * cost)
+    for key in (b"a", b"b", b"c"):
+        cache.put(key, _entry(100))
+    cache.get(b"a")
+    cache.put(b"d", _entry(100))
+    assert list(cache.entries) == [b"c", b"a", b"d"]
+    assert cache.size == 3 * cost
+    # Larger than the whole cache: not stored, nothing evicted for it
+    cache.put(b"e", _entry(10_000))
+    assert b"e" not in cache.entries and len(cache.entries) == 3
+
+
+@pytest.fixture
+def upstream_calls(monkeypatch):
+    """Record the embedding batches sent upstream; each vector is [len(input)]."""
+    calls = []
+
+    async def post(payload, urls=None, parent=None, deadline=None):
+        calls.append(payload["input"])
+        if "fail" in payload["input"]:
+            raise RuntimeError("replica went away")
+        body = {
+            "data": [
+                {"index": i, "embedding": [float(len(text))]} for i, text in enumerate(payload["input"])
+            ],
+            "usage": {"prompt_tokens": 10},
+        }
+        return None, SimpleNamespace(content=orjson.dumps(body))
+
+    monkeypatch.setattr(embeddings.upstream, "post", post)
+    monkeypatch.setattr(embeddings, "EMBEDDING_BATCH_WINDOW", 0.001)
+    return calls
+
+
+def test_concurrent_requests_share_one_batch_of_unique_inputs(upstream_calls):
+    async def scenario():
+        batcher = EmbeddingBatcher(VectorCache())
+        first, second = await asyncio.gather(
+            batcher.embed("m", ["aa", "bbbb", "aa"]),
+            batcher.embed("m", ["bbbb", "c"]),
+        )
+        assert upstream_calls == [["aa", "bbbb", "c"]]
+        assert [embeddings.unpack(vector) for _, vector in first] == [[2.0], [4.0], [2.0]]
+        assert [embeddings.unpack(vector) for _, vector in second] == [[4.0], [1.0]]
+        # The batch's 10 tokens split by length, 2:4:1
+        assert [tokens for tokens, _ in first + second] == [3, 6, 3, 6, 1]
+
+        # Cached now: no second upstream call
+        await batcher.embed("m", ["c", "aa"])
+        assert len(upstream_calls) == 1
+        assert not batcher.pending
+
+    asyncio.run(scenario())
+
+
+def test_a_failed_batch_fails_every_request_waiting_on_it(upstream_calls):
+    async def scenario():
+        batcher = EmbeddingBatcher(VectorCache())
+        results = await asyncio.gather(
+            batcher.embed("m", ["fail", "x"]),
+            batcher.embed("m", ["x"]),
+            return_exceptions=True,
+        )
+        assert len(upstream_calls) == 1
+        assert all(isinstance(result, HTTPException) for result in results)
+        assert {result.status_code for result in results} == {502}
+        # Nothing cached or left pending, so a retry goes upstream again
+        assert not batcher.pending and not batcher.cache.entries
+        await batcher.embed("m", ["x"])
+        assert upstream_calls[-1] == ["x"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+import orjson
+
+from backend.app.services.fastjson import HEAD_BYTES, extract_usage_fields
+
+USAGE = {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15}
+
+
+def _body(text, usage=USAGE, **extra):
+    return orjson.dumps({
+        "id": "cmpl-1", "object": "text_completion", "created": 1700000000, "model": "m",
+        "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": "stop"}],
+        "usage": usage, **extra,
+    })
+
+
+def test_fields_come_from_the_head_and_the_tail():
+    assert extract_usage_fields(_body("Hello")) == {
+        "id": "cmpl-1", "model": "m", "created": 1700000000, "usage": USAGE,
+    }
+
+
+def test_usage_inside_the_text_is_not_mistaken_for_the_real_one():
+    text = 'Reply with {"usage": {"total_tokens": 999}} and {"id": "x"} }}'
+    fields = extract_usage_fields(_body(text))
+    assert fields["usage"] == USAGE
+    assert fields["id"] == "cmpl-1"
+
+
+def test_nested_usage_objects_are_read_whole():
+    usage = {**USAGE, "prompt_tokens_details": {"cached_tokens": 8, "nested": {"a": {}}}}
+    assert extract_usage_fields(_body("Hi", usage))["usage"] == usage
+
+
+def test_null_or_missing_usage_is_empty():
+    assert extract_usage_fields(_body("Hi", None))["usage"] == {}
+    body = orjson.dumps({"id": "cmpl-1", "model": "m", "choices": []})
+    assert extract_usage_fields(body)["usage"] == {}
+
+
+def test_choices_are_never_decoded():
+    # Invalid JSON in the middle is skipped, so it cannot have been parsed
+    body = _body("PLACEHOLDER").replace(b'"PLACEHOLDER"', b'"unterminated \\')
+    assert extract_usage_fields(body)["usage"] == USAGE
+
+
+def test_other_layouts_fall_back_to_a_full_decode():
+    # The identifying fields come after a long prompt echo, outside the head
+    body = orjson.dumps({
+        "prompt": "x" * (2 * HEAD_BYTES),
+        "id": "cmpl-2", "model": "m", "created": 5, "usage": USAGE,
+    })
+    assert extract_usage_fields(body) == {"id": "cmpl-2", "model": "m", "created": 5, "usage": USAGE}
+    # A usage that is not an object cannot be sliced out
+    body = orjson.dumps({"id": "cmpl-3", "model": "m", "usage": [1, 2]})
+    assert extract_usage_fields(body) == {"id": "cmpl-3", "model": "m", "created": None, "usage": [1, 2]}
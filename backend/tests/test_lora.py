@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.app.services import lora, upstream
+from backend.app.services.backend_metrics import LoadSnapshot
+from backend.app.services.lora import Adapter, AdapterRegistry
+
+URLS = ["http://a:8000/v1/completions", "http://b:8000/v1/completions"]
+
+
+class _Response:
+    status_code = 200
+    text = ""
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    """Fresh replicas, picked by fewest queued requests; load/unload calls are recorded."""
+    replicas = {url: upstream.Backend(url) for url in URLS}
+    for backend in replicas.values():
+        backend.load = LoadSnapshot(healthy=True)
+
+    async def pick_backend(urls=None, exclude=None):
+        return min((replicas[url] for url in urls), key=lambda b: b.load.waiting, default=None)
+
+    posts = []
+
+    async def post(self, url, path, body, deadline):
+        posts.append((url, path, body["lora_name"]))
+        return _Response()
+
+    monkeypatch.setattr(upstream, "get_backend", replicas.__getitem__)
+    monkeypatch.setattr(upstream, "pick_backend", pick_backend)
+    monkeypatch.setattr(AdapterRegistry, "_post", post)
+    monkeypatch.setattr(lora.db, "redis_client", None)
+    monkeypatch.setattr(lora, "LORA_MAX_PER_REPLICA", 2)
+    replicas["posts"] = posts
+    return replicas
+
+
+def _registry(*names):
+    return AdapterRegistry({name: {"base": "base", "path": f"/adapters/{name}"} for name in names})
+
+
+def test_cold_adapter_is_loaded_and_released(backends):
+    registry = _registry("x")
+    placed = asyncio.run(registry.place(registry.get("x"), URLS))
+    assert len(placed) == 1
+    assert backends["posts"] == [(placed[0], "/v1/load_lora_adapter", "x")]
+    assert registry.inflight == {(placed[0], "x"): 1}
+    registry.release("x", placed)
+    assert not registry.inflight
+
+
+def test_saturated_holders_spread_to_another_replica(backends):
+    registry = _registry("x")
+    registry.resident = {URLS[0]: {"x"}}
+    backends[URLS[0]].load = LoadSnapshot(healthy=True, waiting=lora.LORA_SPREAD_WAITING + 1)
+    placed = asyncio.run(registry.place(registry.get("x"), URLS))
+    assert placed == URLS
+    assert registry.inflight == {(URLS[0], "x"): 1, (URLS[1], "x"): 1}
+
+
+def test_all_holders_saturated_places_each_replica_once(backends):
+    registry = _registry("x")
+    registry.resident = {url: {"x"} for url in URLS}
+    for url in URLS:
+        backends[url].load = LoadSnapshot(healthy=True, waiting=lora.LORA_SPREAD_WAITING + 1)
+    adapter = registry.get("x")
+
+    first = asyncio.run(registry.place(adapter, URLS))
+    second = asyncio.run(registry.place(adapter, URLS))
+    assert sorted(first) == sorted(URLS)
+    assert not backends["posts"]
+    assert registry.inflight == {(URLS[0], "x"): 2, (URLS[1], "x"): 2}
+
+    # The first request ending leaves the second one counted everywhere
+    registry.release("x", first)
+    assert registry.inflight == {(URLS[0], "x"): 1, (URLS[1], "x"): 1}
+    registry.release("x", second)
+    assert not registry.inflight
+
+
+def test_least_recently_used_idle_adapter_is_evicted(backends):
+    registry = _registry("old", "recent", "new")
+    url = URLS[0]
+    registry.resident = {url: {"old", "recent"}, URLS[1]: {"a", "b"}}
+    registry.used_written = {(url, "old"): 100.0, (url, "recent"): 200.0}
+    asyncio.run(registry._load(url, registry.get("new"), None))
+    assert registry.resident[url] == {"recent", "new"}
+    assert (url, "/v1/unload_lora_adapter", "old") in backends["posts"]
+    assert registry.evictions == 1
+
+
+def test_adapters_in_flight_are_never_evicted(backends):
+    registry = _registry("old", "recent", "new")
+    url = URLS[0]
+    registry.resident = {url: {"old", "recent"}}
+    registry.used_written = {(url, "old"): 100.0, (url, "recent"): 200.0}
+    # "old" has a request of this worker in flight, "recent" one of another worker
+    registry.inflight[(url, "old")] = 1
+    backends[url].load = LoadSnapshot(healthy=True, active_adapters=frozenset({"recent"}))
+    assert asyncio.run(registry._victim(url)) is None
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(registry._load(url, registry.get("new"), None))
+    assert error.value.status_code == 503
+    assert registry.resident[url] == {"old", "recent"}
+
+
+def test_failed_placement_releases_the_holders(backends):
+    registry = _registry("x", "a", "b")
+    registry.resident = {URLS[0]: {"x"}, URLS[1]: {"a", "b"}}
+    backends[URLS[0]].load = LoadSnapshot(healthy=True, waiting=lora.LORA_SPREAD_WAITING + 1)
+    registry.inflight[(URLS[1], "a")] = 1
+    registry.inflight[(URLS[1], "b")] = 1
+    # Nowhere to load: the saturated holder is still used, and counted once
+    placed = asyncio.run(registry.place(registry.get("x"), URLS))
+    assert placed == [URLS[0]]
+    assert registry.inflight[(URLS[0], "x")] == 1
+
+    registry.release("x", placed)
+    registry.resident = {URLS[1]: {"a", "b"}}
+    with pytest.raises(HTTPException):
+        asyncio.run(registry.place(registry.get("x"), [URLS[1]]))
+    assert (URLS[1], "x") not in registry.inflight
@@ -0,0 +1,73 @@
+import datetime as dt
+
+import pytest
+
+from backend.app.services.rollups import (
+    LATENCY_BOUNDS_MS,
+    TIMESERIES_MAX_POINTS,
+    histogram_percentile,
+    latency_percentiles,
+    plan_series,
+)
+
+HOUR = dt.timedelta(hours=1)
+DAY = dt.timedelta(days=1)
+
+
+def _at(day, hour=0, minute=0):
+    return dt.datetime(2024, 3, day, hour, minute, tzinfo=dt.timezone.utc)
+
+
+def _hist(**bins):
+    """A histogram with the given counts, e.g. _hist(b1=10) for 10 requests in bin 1."""
+    counts = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+    for name, count in bins.items():
+        counts[int(name[1:])] = count
+    return counts
+
+
+def test_unaligned_range_is_widened_to_whole_buckets():
+    assert plan_series("hour", _at(1, 10, 17), _at(1, 12, 5)) == (_at(1, 10), _at(1, 13), HOUR)
+    assert plan_series("day", _at(1, 10, 17), _at(3, 0, 1)) == (_at(1), _at(4), DAY)
+
+
+def test_aligned_end_is_exclusive():
+    assert plan_series("hour", _at(1, 10), _at(1, 12)) == (_at(1, 10), _at(1, 12), HOUR)
+
+
+def test_empty_range_still_yields_one_bucket():
+    assert plan_series("hour", _at(1, 10, 30), _at(1, 10, 30)) == (_at(1, 10), _at(1, 11), HOUR)
+
+
+def test_wide_ranges_are_downsampled():
+    start, end, step = plan_series("hour", _at(1), _at(1) + 60 * DAY)
+    assert step % HOUR == dt.timedelta(0) and step > HOUR
+    assert (end - start) // step <= TIMESERIES_MAX_POINTS
+    # The end moves out to a whole bucket, never in
+    assert end >= _at(1) + 60 * DAY and (end - start) % step == dt.timedelta(0)
+
+
+def test_empty_histograms_have_no_percentile():
+    assert histogram_percentile(None, 0.5) is None
+    assert histogram_percentile([], 0.5) is None
+    assert histogram_percentile(_hist(), 0.5) is None
+    assert latency_percentiles(None) == {
+        "latency_p50_ms": None, "latency_p90_ms": None, "latency_p99_ms": None
+    }
+
+
+def test_percentile_interpolates_inside_its_bin():
+    # Bin 1 covers 25-50 ms
+    assert histogram_percentile(_hist(b1=10), 0.5) == 37.5
+    # Bin 0 starts at 0 ms
+    assert histogram_percentile(_hist(b0=4), 0.25) == 6.25
+    # p90 of 9 fast and 1 slow request falls at the top of the fast bin
+    assert histogram_percentile(_hist(b2=9, b6=1), 0.9) == 100.0
+    # p99 is 90% of the way through the slow request's bin, 1000-2500 ms
+    assert histogram_percentile(_hist(b2=9, b6=1), 0.99) == pytest.approx(2350.0)
+
+
+def test_overflow_bucket_reports_the_last_bound():
+    overflow = f"b{len(LATENCY_BOUNDS_MS)}"
+    assert histogram_percentile(_hist(**{overflow: 3}), 0.5) == float(LATENCY_BOUNDS_MS[-1])
+    assert histogram_percentile(_hist(b0=99, **{overflow: 1}), 0.999) == float(LATENCY_BOUNDS_MS[-1])
@@ -0,0 +1,137 @@
+import asyncio
+import os
+
+import orjson
+import pytest
+
+from backend.app.services import usage_emitter
+from backend.app.services.usage_emitter import (
+    LOGS_BUFFER_KEY,
+    Spool,
+    UsageEmitter,
+    _read_batch,
+    _read_offset,
+)
+from backend.database import db
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def _record(n):
+    return orjson.dumps({"user_id": f"u{n}", "log_id": str(n)})
+
+
+def _write_spool(path, lines):
+    with open(path, "wb") as f:
+        f.write(b"".join(lines))
+
+
+def test_torn_final_line_is_left_for_later(tmp_path):
+    path = str(tmp_path / "usage.replay")
+    torn = _record(3)
+    _write_spool(path, [_record(1) + b"\n", _record(2) + b"\n", torn[:7]])
+
+    records, offset = _read_batch(path, 0, 10)
+    assert [user_id for user_id, _ in records] == ["u1", "u2"]
+    assert offset == len(_record(1)) + len(_record(2)) + 2
+
+    # Nothing complete past the offset yet
+    assert _read_batch(path, offset, 10) == ([], offset)
+    with open(path, "ab") as f:
+        f.write(torn[7:] + b"\n")
+    records, _ = _read_batch(path, offset, 10)
+    assert records == [("u3", torn)]
+
+
+def test_unreadable_records_are_skipped(tmp_path):
+    path = str(tmp_path / "usage.replay")
+    _write_spool(path, [b"not json\n", b'{"no_user": 1}\n', _record(1) + b"\n"])
+    records, offset = _read_batch(path, 0, 10)
+    assert records == [("u1", _record(1))]
+    assert offset == os.path.getsize(path)
+
+
+def test_batches_stop_at_the_limit(tmp_path):
+    path = str(tmp_path / "usage.replay")
+    _write_spool(path, [_record(n) + b"\n" for n in range(5)])
+    records, offset = _read_batch(path, 0, 2)
+    assert len(records) == 2
+    records, _ = _read_batch(path, offset, 10)
+    assert [user_id for user_id, _ in records] == ["u2", "u3", "u4"]
+
+
+def test_seal_orphans_skips_files_a_live_worker_holds(tmp_path):
+    directory = str(tmp_path)
+    live = Spool(directory)
+    live.append([("u1", _record(1))])
+    orphan = os.path.join(directory, "usage-1-dead.jsonl")
+    _write_spool(orphan, [_record(2) + b"\n"])
+
+    other = Spool(directory)
+    other.seal_orphans()
+    assert other.pending() == [orphan[: -len(".jsonl")] + ".replay"]
+    assert os.path.exists(live.path)
+
+    live.seal_orphans()
+    assert os.path.exists(live.path)
+    live.seal()
+    assert len(other.pending()) == 2
+
+
+def test_replay_resumes_from_the_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage_emitter, "USAGE_FLUSH_BATCH", 2)
+    path = str(tmp_path / "usage.replay")
+    _write_spool(path, [_record(n) + b"\n" for n in range(5)])
+
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        monkeypatch.setattr(db, "redis_client", redis)
+        emitter = UsageEmitter(str(tmp_path))
+        push = emitter._push
+        calls = 0
+
+        async def flaky_push(records):
+            nonlocal calls
+            calls += 1
+            if calls == 2:
+                raise ConnectionError("Redis went away")
+            await push(records)
+
+        emitter._push = flaky_push
+        with pytest.raises(ConnectionError):
+            await emitter._replay_file(path)
+        # The first batch is checkpointed, the second is sent again
+        assert _read_offset(path) == len(_record(0)) + len(_record(1)) + 2
+
+        await emitter._replay_file(path)
+        pushed = await redis.lrange(LOGS_BUFFER_KEY, 0, -1)
+        assert sorted(orjson.loads(payload)["log_id"] for payload in pushed) == [
+            "0", "1", "2", "3", "4"
+        ]
+        assert not os.path.exists(path)
+        assert not os.path.exists(path + ".offset")
+
+    asyncio.run(scenario())
+
+
+def test_a_push_that_times_out_is_spooled(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage_emitter, "USAGE_PUSH_TIMEOUT", 0.05)
+
+    async def scenario():
+        emitter = UsageEmitter(str(tmp_path))
+
+        async def hanging_push(records):
+            await asyncio.sleep(10)
+
+        emitter._push = hanging_push
+        emitter.emit({"user_id": "u1", "log_id": "1"})
+        emitter.emit({"user_id": "u2", "log_id": "2"})
+        await emitter.flush()
+        assert emitter.spooled == 2
+        assert not emitter.queue
+        emitter.spool.seal()
+        [spooled] = emitter.spool.pending()
+        records, _ = _read_batch(spooled, 0, 10)
+        assert [user_id for user_id, _ in records] == ["u1", "u2"]
+
+    asyncio.run(scenario())
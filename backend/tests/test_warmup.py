@@ -0,0 +1,63 @@
+from backend.app.services.warmup import HeavyHitters
+
+
+def _offer(counter, keys):
+    for key in keys:
+        counter.offer(key, lambda key=key: f"payload of {key}")
+
+
+def test_counts_are_exact_while_the_table_has_room():
+    counter = HeavyHitters(3)
+    _offer(counter, "abacab")
+    assert counter.top(3) == [("a", 3, 0), ("b", 2, 0), ("c", 1, 0)]
+    assert counter.payloads["a"] == "payload of a"
+
+
+def test_a_new_key_evicts_the_least_counted_and_inherits_its_count():
+    counter = HeavyHitters(2)
+    _offer(counter, "aaab")
+    _offer(counter, "c")
+    # "b" (count 1) made room; "c" may have been seen up to 1 time before
+    assert counter.top(2) == [("a", 3, 0), ("c", 2, 1)]
+    assert "b" not in counter.payloads
+
+
+def test_payloads_are_built_only_when_a_key_enters():
+    counter = HeavyHitters(2)
+    built = []
+    for _ in range(3):
+        counter.offer("a", lambda: built.append("a") or "prefix")
+    assert built == ["a"]
+
+
+def test_frequent_keys_survive_a_stream_of_rare_ones():
+    counter = HeavyHitters(4)
+    for i in range(200):
+        _offer(counter, ["hot", f"rare-{i}"] if i % 2 else ["hot", "warm", f"rare-{i}"])
+    top = [key for key, _, _ in counter.top(2)]
+    assert top == ["hot", "warm"]
+    # Every count over-estimates by at most its error
+    for key, count, error in counter.top(4):
+        assert count - error <= {"hot": 200, "warm": 100}.get(key, 1) <= count
+
+
+def test_decay_halves_counts_and_errors():
+    counter = HeavyHitters(1)
+    _offer(counter, "aaaa")
+    _offer(counter, "b")
+    counter.decay()
+    assert counter.top(1) == [("b", 2.5, 2.0)]
+    # A key that turns hot overtakes one that was hot earlier
+    counter = HeavyHitters(2)
+    _offer(counter, "a" * 8)
+    counter.decay()
+    counter.decay()
+    _offer(counter, "b" * 3)
+    assert [key for key, _, _ in counter.top(2)] == ["b", "a"]
+
+
+def test_top_is_bounded_by_n():
+    counter = HeavyHitters(5)
+    _offer(counter, "abcde")
+    assert len(counter.top(2)) == 2
+    assert len(counter.top(10)) == 5
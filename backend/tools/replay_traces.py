@@ -0,0 +1,193 @@
+"""
+Replay captured traffic (CAPTURE_SAMPLE_RATE) against a gateway, keeping
+the original arrival pattern:
+
+    python -m backend.tools.replay_traces captures/*.jsonl.gz \\
+        --url http://localhost:8000 --token <api_token> --speed 2
+
+Requests are sent at their recorded offsets from the first trace, divided
+by --speed (2 replays an hour of traffic in 30 minutes at twice the rate).
+With --lengths observed (the default), max_tokens is the number of tokens
+the original request generated, so output lengths follow production too.
+Traces captured with CAPTURE_CONTENT=none have no prompt text; they get a
+filler prompt of the recorded length. WebSocket traces are replayed over
+HTTP like the rest.
+"""
+import sys
+import gzip
+import time
+import asyncio
+import argparse
+
+from typing import Iterator, List, Optional
+
+import httpx
+import orjson
+
+
+def read_traces(paths: List[str]) -> List[dict]:
+    traces = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for line in f:
+                try:
+                    traces.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    continue  # a file cut short while being written
+    traces.sort(key=lambda trace: trace["ts"])
+    return traces
+
+
+def _filler(tokens: Optional[int], chars: Optional[int] = None) -> str:
+    """Roughly `tokens` tokens (or `chars` characters) of text."""
+    words = tokens if tokens else max(1, (chars or 4) // 4)
+    return " ".join("hello" for _ in range(words))
+
+
+def build_request(trace: dict, lengths: str) -> dict:
+    params = dict(trace.get("params") or {})
+    if lengths == "observed" and trace.get("completion_tokens"):
+        params["max_tokens"] = trace["completion_tokens"]
+    body = {k: v for k, v in params.items() if v is not None}
+    model = trace.get("requested_model") or trace.get("model")
+    if model:
+        body["model"] = model
+    body["stream"] = bool(trace.get("stream"))
+
+    messages = trace.get("messages")
+    if messages:
+        body["messages"] = [
+            {"role": (message or {}).get("role") or "user",
+             "content": _content((message or {}).get("content"))}
+            for message in messages
+        ]
+    else:
+        prompt = trace.get("prompt")
+        body["prompt"] = prompt if isinstance(prompt, str) and prompt else _filler(
+            trace.get("prompt_tokens"), prompt if isinstance(prompt, int) else None
+        )
+    return body
+
+
+def _content(content) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, int):
+        return _filler(None, content)
+    if isinstance(content, list):
+        return " ".join(
+            _content(part.get("text")) for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return ""
+
+
+def _percentile(values: List[float], quantile: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))], 1)
+
+
+class Results:
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.ttft: List[float] = []
+        self.latency: List[float] = []
+        self.lag: List[float] = []
+
+    def summary(self) -> dict:
+        return {
+            "sent": self.sent,
+            "errors": self.errors,
+            "ttft_ms": {"p50": _percentile(self.ttft, 0.5), "p95": _percentile(self.ttft, 0.95)},
+            "latency_ms": {"p50": _percentile(self.latency, 0.5), "p95": _percentile(self.latency, 0.95)},
+            # How late requests went out against the schedule; large values
+            # mean this machine could not keep up with the replay rate
+            "send_lag_ms": {"p50": _percentile(self.lag, 0.5), "max": max(self.lag, default=None)},
+        }
+
+
+async def send(client: httpx.AsyncClient, url: str, token: str, body: dict, results: Results):
+    started = time.perf_counter()
+    try:
+        async with client.stream(
+            "POST", f"{url}/v1/chat/completions",
+            content=orjson.dumps(body),
+            headers={"Authorization": token, "Content-Type": "application/json"},
+        ) as response:
+            first = None
+            async for _ in response.aiter_raw():
+                if first is None:
+                    first = time.perf_counter()
+            if response.status_code != 200:
+                results.errors += 1
+                return
+        if body["stream"] and first is not None:
+            results.ttft.append((first - started) * 1000)
+        results.latency.append((time.perf_counter() - started) * 1000)
+    except httpx.HTTPError:
+        results.errors += 1
+
+
+def schedule(traces: List[dict], speed: float) -> Iterator[tuple]:
+    """(seconds from start, trace) pairs, compressed or stretched by `speed`."""
+    start = traces[0]["ts"]
+    for trace in traces:
+        yield (trace["ts"] - start) / speed, trace
+
+
+async def replay(args: argparse.Namespace) -> int:
+    traces = read_traces(args.paths)
+    if args.limit:
+        traces = traces[: args.limit]
+    if not traces:
+        print("No traces found.", file=sys.stderr)
+        return 1
+    print(f"Replaying {len(traces)} requests spanning "
+          f"{(traces[-1]['ts'] - traces[0]['ts']) / args.speed:.0f}s at {args.speed}x")
+
+    results = Results()
+    tasks = set()
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(args.timeout, connect=10.0),
+        limits=httpx.Limits(max_connections=None),
+    ) as client:
+        began = time.monotonic()
+        for offset, trace in schedule(traces, args.speed):
+            delay = began + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            results.lag.append(max(0.0, -delay) * 1000)
+            results.sent += 1
+            task = asyncio.create_task(
+                send(client, args.url, args.token, build_request(trace, args.lengths), results)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    print(orjson.dumps(results.summary(), option=orjson.OPT_INDENT_2).decode())
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay captured gateway traffic.")
+    parser.add_argument("paths", nargs="+", help="capture-*.jsonl.gz files")
+    parser.add_argument("--url", default="http://localhost:8000", help="gateway base URL")
+    parser.add_argument("--token", required=True, help="API token to send the requests with")
+    parser.add_argument("--speed", type=float, default=1.0, help="arrival rate multiplier")
+    parser.add_argument("--lengths", choices=("observed", "original"), default="observed",
+                        help="max_tokens from the recorded output length, or as the client sent it")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-request timeout (s)")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    return asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())